@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import PrivateChat, Message
+from .models import ArchivedMessage, PrivateChat, Message
 
 admin.site.register(PrivateChat)
 admin.site.register(Message)
+admin.site.register(ArchivedMessage)
@@ -0,0 +1,146 @@
+import asyncio
+import atexit
+import logging
+import sys
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from .metrics import database_sync_to_async
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+def write_messages(messages):
+    """
+    Insert messages with a single bulk insert and update every affected conversation summary.
+    """
+    for message in messages:
+        message.render()
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+
+        messages_by_chat = defaultdict(list)
+        for message in messages:
+            messages_by_chat[message.chat_id].append(message)
+        for chat_messages in messages_by_chat.values():
+            chat_messages[0].chat.record_messages(chat_messages)
+
+def try_write(messages):
+    try:
+        write_messages(messages)
+    except Exception as error:
+        for message in messages:
+            # the insert may have set ids before the transaction was rolled back
+            message.pk = None
+            message._state.adding = True
+        return error
+    return None
+
+def write_batch(messages):
+    """
+    write_messages() with failures isolated: a failing batch is retried one chat at a time and the
+    messages of a failing chat one by one, so a bad row (e.g. for a chat deleted meanwhile) only fails itself.
+    Returns the error of every message, None for the ones that were written.
+    """
+    error = try_write(messages)
+    if error is None:
+        return [None] * len(messages)
+
+    indexes_by_chat = defaultdict(list)
+    for index, message in enumerate(messages):
+        indexes_by_chat[message.chat_id].append(index)
+    errors = [None] * len(messages)
+    for indexes in indexes_by_chat.values():
+        chat_error = error if len(indexes_by_chat) == 1 else try_write([messages[index] for index in indexes])
+        if chat_error is None:
+            continue
+        for index in indexes:
+            errors[index] = chat_error if len(indexes) == 1 else try_write([messages[index]])
+    return errors
+
+def log_failures(errors):
+    failed = [error for error in errors if error is not None]
+    if failed:
+        logger.error("Failed to write %d of %d buffered messages", len(failed), len(errors), exc_info=failed[0])
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer shared by all connections of the process.
+
+    Messages are flushed with one bulk insert once `max_size` of them are pending
+    or `max_delay` seconds after the first one arrived, whichever comes first.
+    """
+
+    def __init__(self, max_size=None, max_delay=None):
+        # None falls back to the settings, read on every call so they can be changed at runtime
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.timer = None
+        self.shutdown_hooks_installed = False
+
+    async def add(self, message):
+        """
+        Queue an unsaved message, returns a future resolved once it has been written.
+        """
+        self.install_shutdown_hooks()
+
+        future = asyncio.get_running_loop().create_future()
+        # mark failures as retrieved, callers that ack immediately never await the future
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.pending.append((message, future))
+
+        if len(self.pending) >= (self.max_size or settings.CHAT_WRITE_BEHIND_BATCH_SIZE):
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.max_delay or settings.CHAT_WRITE_BEHIND_DELAY, lambda: asyncio.ensure_future(self.flush())
+            )
+        return future
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        messages = [message for message, _ in batch]
+        errors = await database_sync_to_async(write_batch)(messages)
+        log_failures(errors)
+        for (message, future), error in zip(batch, errors):
+            # the sender may have been cancelled (disconnect) while waiting
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(message)
+            else:
+                future.set_exception(error)
+
+    def flush_sync(self):
+        """
+        Write whatever is still pending without an event loop, used at interpreter exit.
+        """
+        batch, self.pending = self.pending, []
+        if batch:
+            log_failures(write_batch([message for message, _ in batch]))
+
+    def install_shutdown_hooks(self):
+        if self.shutdown_hooks_installed:
+            return
+        self.shutdown_hooks_installed = True
+        atexit.register(self.flush_sync)
+
+        # daphne runs on twisted, flush before the reactor (and with it the event loop) stops;
+        # only look the reactor up if it is already running, importing it would install one
+        if "twisted.internet.reactor" in sys.modules:
+            from twisted.internet import defer, reactor
+            reactor.addSystemEventTrigger(
+                "before", "shutdown", lambda: defer.Deferred.fromFuture(asyncio.ensure_future(self.flush()))
+            )
+
+
+message_buffer = MessageBuffer()
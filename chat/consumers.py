@@ -1,74 +1,629 @@
+import asyncio
+import functools
 import json
+import logging
+import time
+import uuid
+import msgpack
+from collections import Counter, deque
+from dataclasses import dataclass
+from urllib.parse import parse_qs
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.utils import timezone
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import PrivateChat, Message
+from users.cache import get_cached_user
+from .buffer import message_buffer
+from .events import message_payload, read_receipt_event, room_group_name, user_group_name
+from .images import thumbnail_name_for
+from .metrics import MetricsConsumerMixin, database_sync_to_async, registry
+from .models import PREVIEW_LENGTH, PrivateChat, Message
+from .pagination import get_messages_after
+from .presence import TypingIndicator, get_presence
+from .ratelimit import TokenBucket, acheck_rate, take_token
+from .rendering import content_flags, render_content
 
+logger = logging.getLogger(__name__)
 
-class Chat(AsyncWebsocketConsumer):
-    async def connect(self):
-        # extract both usernames from url route
-        username1 = self.scope["url_route"]["kwargs"]["username"]
-        username2 = self.scope["url_route"]["kwargs"]["other_username"]
+# opt-in websocket subprotocol: binary frames holding {"v": PROTOCOL_VERSION, "frames": [...]},
+# the frames are the same dicts the JSON text protocol sends one per websocket frame
+MSGPACK_PROTOCOL = "chat.msgpack"
+PROTOCOL_VERSION = 1
+# frame fields the handlers treat as text, frames carrying anything else there are dropped
+STRING_FIELDS = ("type", "chat", "message", "image_name")
+# close code of sockets dropped by the "disconnect" outbox policy, clients reconnect and get a replay
+OUTBOX_OVERFLOW_CLOSE_CODE = 4008
+
+outbox_frames = registry.gauge("chat_outbox_frames", "Frames queued for websocket clients in this process.")
+outbox_overflows = registry.counter("chat_outbox_overflows_total", "Frames that did not fit in a full outbox.")
+outbox_dropped = registry.counter(
+    "chat_outbox_dropped_frames_total", "Frames discarded by the outbox policy, including coalesced ones.",
+)
+
+
+@dataclass
+class Room:
+    """
+    A conversation a socket takes part in.
+    """
+
+    chat: PrivateChat
+    other_user: User
+    group_name: str
+    typing: TypingIndicator = None
+
+
+class BaseChat(MetricsConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Conversation handling shared by the per-conversation and the per-user socket.
+
+    Group events carry the group name of their conversation as "room" so a socket
+    taking part in several conversations can tell them apart, see `frame()`.
+
+    Clients speak JSON text frames, or msgpack binary frames when they ask for the MSGPACK_PROTOCOL
+    subprotocol. Outgoing frames go through a per-connection outbox drained by a single task, msgpack
+    frames queued while the previous one is being sent are packed together. The outbox holds at most
+    CHAT_OUTBOX_LIMIT frames, overflows are handled by CHAT_OUTBOX_POLICY. send() returns once the server
+    has the frame, not the client: daphne buffers whatever a slow client has not read yet without a bound.
+    """
+
+    async def accept_client(self):
+        self.protocol = MSGPACK_PROTOCOL if MSGPACK_PROTOCOL in self.scope.get("subprotocols", []) else None
+        self.frame_bucket = TokenBucket(*settings.CHAT_RATE_LIMITS["connection"])
+        self.open_outbox()
+        await self.accept(subprotocol=self.protocol)
 
-        # create unique group name based on both usernames
-        self.group_name = self.create_group_name(username1, username2)
-        self.room_group_name = f"chat_{self.group_name}"
+    async def allow_frame(self, data):
+        """
+        Check an incoming frame against the connection's and the user's rate limits,
+        a refused frame is answered with a rate_limited frame saying when to retry.
+        """
+        wait = take_token("connection", self.frame_bucket) or await acheck_rate("frame", self.user)
+        if not wait:
+            return True
 
+        rejection = {"type": "rate_limited", "frame": data.get("type", "message"), "retry_after": round(wait, 3)}
+        if "chat" in data:
+            rejection["chat"] = data["chat"]
+        if "message" in data:
+            # the client puts the refused text back into its input
+            rejection["message"] = data["message"]
+        await self.send_payload(rejection)
+        return False
+
+    def decode(self, text_data, bytes_data):
+        """
+        Frames carried by an incoming websocket message, malformed ones are logged and dropped.
+        """
+        if bytes_data is None:
+            try:
+                frames = [json.loads(text_data)]
+            except (TypeError, ValueError) as error:
+                logger.warning("Dropped undecodable JSON message: %s", error)
+                return []
+        else:
+            try:
+                envelope = msgpack.unpackb(bytes_data, raw=False)
+            except (msgpack.UnpackException, ValueError) as error:
+                logger.warning("Dropped undecodable msgpack message: %s", error)
+                return []
+            if not isinstance(envelope, dict):
+                logger.warning("Dropped msgpack message that is not an envelope")
+                return []
+            if envelope.get("v") != PROTOCOL_VERSION:
+                logger.warning("Dropped frames of unsupported protocol version %r", envelope.get("v"))
+                return []
+            frames = envelope.get("frames")
+            if not isinstance(frames, list):
+                logger.warning("Dropped msgpack envelope without a list of frames")
+                return []
+
+        if not all(isinstance(frame, dict) for frame in frames):
+            logger.warning("Dropped message with frames that are not objects")
+            return []
+        valid = [frame for frame in frames if all(isinstance(frame.get(field, ""), str) for field in STRING_FIELDS)]
+        if len(valid) < len(frames):
+            logger.warning("Dropped %d frames with fields of the wrong type", len(frames) - len(valid))
+        return valid
+
+    def open_outbox(self):
+        self.outbox = deque()
+        self.outbox_open = True
+        self.flusher = None
+
+    async def send_payload(self, payload):
+        """
+        Queue a frame for the client, sent in the protocol it asked for.
+        """
+        if not self.outbox_open:
+            return
+        if len(self.outbox) >= settings.CHAT_OUTBOX_LIMIT:
+            await self.overflow(payload)
+            return
+        self.outbox.append(payload)
+        outbox_frames.inc()
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+            self.flusher.add_done_callback(self.flush_done)
+
+    async def overflow(self, payload):
+        """
+        Apply CHAT_OUTBOX_POLICY to a frame that does not fit in the full outbox:
+        "drop" discards it, "coalesce" replaces everything pending with one resync frame per
+        conversation and "disconnect" closes the socket. Clients catch up with a reload or,
+        after reconnecting, the replay of what they missed.
+        """
+        policy = settings.CHAT_OUTBOX_POLICY
+        outbox_overflows.inc(policy=policy)
+        if policy == "drop":
+            outbox_dropped.inc()
+            return
+
+        pending = [*self.outbox, payload]
+        outbox_frames.inc(-len(self.outbox))
+        outbox_dropped.inc(len(pending))
+        self.outbox.clear()
+        if policy == "disconnect":
+            self.close_outbox()
+            await self.close(code=OUTBOX_OVERFLOW_CLOSE_CODE)
+            return
+
+        missed = Counter()
+        for frame in pending:
+            # resync frames of an earlier overflow carry their own count
+            missed[frame.get("chat")] += frame["missed"] if frame.get("type") == "resync" else 1
+        for chat, count in missed.items():
+            resync = {"type": "resync", "missed": count}
+            self.outbox.append(resync if chat is None else {**resync, "chat": chat})
+        outbox_frames.inc(len(self.outbox))
+
+    async def flush(self):
+        try:
+            while self.outbox:
+                if self.protocol == MSGPACK_PROTOCOL:
+                    frames = list(self.outbox)
+                    self.outbox.clear()
+                    outbox_frames.inc(-len(frames))
+                    await self.send(bytes_data=msgpack.packb({"v": PROTOCOL_VERSION, "frames": frames}))
+                else:
+                    frame = self.outbox.popleft()
+                    outbox_frames.inc(-1)
+                    await self.send(text_data=json.dumps(frame))
+        except Exception:
+            # nothing would drain the outbox again, stop queueing for this socket
+            self.flusher = None
+            self.close_outbox()
+            raise
+
+    def flush_done(self, task):
+        # the flusher is never awaited, its failures would go unnoticed
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to send frames to %s", self.channel_name, exc_info=task.exception())
+
+    def close_outbox(self):
+        # frames still queued for a closed socket have nowhere to go
+        if not getattr(self, "outbox_open", False):
+            return
+        self.outbox_open = False
+        outbox_frames.inc(-len(self.outbox))
+        self.outbox.clear()
+        if self.flusher is not None:
+            self.flusher.cancel()
+
+    async def join_room(self, other_user):
         # fetch/create chat group from database
-        self.chat = await self.get_or_create_chat(username1, username2)
+        chat = await self.get_or_create_chat(self.user, other_user)
+        room = Room(chat, other_user, room_group_name(self.user.username, other_user.username))
+        room.typing = TypingIndicator(functools.partial(self.broadcast_typing, room))
 
         # add websocket connection to group
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.channel_layer.group_add(room.group_name, self.channel_name)
+        return room
 
-    async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+    async def replay(self, room, last_id):
+        """
+        Send the messages the client missed since `last_id`, the newest message it has. Replayed messages
+        can also arrive live as the room is already joined, clients drop duplicates by message id.
+        Gaps too large to replay get a resync frame, the client then reloads the conversation.
+        """
+        if not isinstance(last_id, int) or isinstance(last_id, bool) or last_id < 0:
+            return
+        messages = await self.get_messages_after(room.chat, last_id)
+        event = {"room": room.group_name}
+        if messages is None:
+            await self.send_frame(event, {"type": "resync"})
+            return
+        for message in messages:
+            await self.send_frame(event, {**message_payload(message), "replayed": True})
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data.get("message", "")
-        image_name = data.get("image_name", "")
-        image_url = data.get("image_url", "")
-        username = data["username"]
-        user = await self.get_user(username)
+    async def start_presence(self):
+        """
+        Register the connection with the presence backend, returns True if it is the user's only live one,
+        i.e. the user just came online.
+        """
+        # presence and typing never touch the database
+        self.presence = get_presence()
+        first = await self.presence.connect(self.user.id, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        return first
+
+    async def stop_presence(self, rooms):
+        if not hasattr(self, "presence"):
+            return
+        self.heartbeat_task.cancel()
+        for room in rooms:
+            await room.typing.stop()
+        if await self.presence.disconnect(self.user.id, self.channel_name):
+            for room in rooms:
+                await self.broadcast_presence(room, online=False)
+
+    async def heartbeat(self):
+        """
+        Keep the connection alive in the presence backend, it expires after PRESENCE_TTL without heartbeats.
+        """
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT)
+            try:
+                await self.presence.heartbeat(self.user.id, self.channel_name)
+            except Exception:
+                logger.warning("Presence heartbeat failed for %s", self.user.username, exc_info=True)
 
-        await self.save_message(self.chat, user, message, image_name)
+    async def broadcast_presence(self, room, online):
+        await self.channel_layer.group_send(room.group_name, {
+            "type": "presence_update", "room": room.group_name, "username": self.user.username,
+            "online": online, "last_seen": time.time(),
+        })
+
+    async def broadcast_typing(self, room, typing):
+        await self.channel_layer.group_send(room.group_name, {
+            "type": "user_typing", "room": room.group_name, "username": self.user.username, "typing": typing,
+        })
 
-        # display message to websocket group
-        await self.channel_layer.group_send(self.room_group_name, {
+    async def receive_frame(self, room, data):
+        """
+        Handle a typing or message frame sent to a conversation.
+        """
+        kind = data.get("type", "message")
+        if kind == "typing":
+            await room.typing.keystroke()
+            return
+        if kind == "read":
+            await self.receive_read(room, data.get("message_id"))
+            return
+        if kind != "message":
+            return
+
+        room.typing.reset()
+        message = data.get("message", "")
+        image = self.get_image_fields(data)
+
+        event = {
             "type": "send_message",
-            "username": username,
+            "room": room.group_name,
+            "username": self.user.username,
             "message": message,
-            "image_url": image_url
-        })
+            "image_url": default_storage.url(image["image"]) if image else "",
+        }
+        if image.get("thumbnail"):
+            event.update(
+                thumbnail_url=default_storage.url(image["thumbnail"]),
+                image_width=image["image_width"],
+                image_height=image["image_height"],
+            )
+
+        if settings.CHAT_BROADCAST_BEFORE_PERSIST:
+            event.update(message_html=render_content(message), has_mention=content_flags(message)["has_mention"])
+            await self.broadcast_and_persist(room, event, message, image)
+        else:
+            saved = await self.save_message(room, message, image)
+            if saved:
+                # rendered when the message was saved
+                event.update(message_id=saved.id, message_html=saved.content_html, has_mention=saved.has_mention)
+            else:
+                event.update(message_html=render_content(message), has_mention=content_flags(message)["has_mention"])
+
+            # display message to websocket group
+            await self.channel_layer.group_send(room.group_name, event)
+
+        await self.publish_conversation_update(room, event)
+
+    async def receive_read(self, room, message_id):
+        """
+        Move the user's read marker up to a message they have seen and tell the room.
+        """
+        if not isinstance(message_id, int) or isinstance(message_id, bool) or message_id <= 0:
+            return
+        marker = await self.mark_read(room.chat, message_id)
+        if marker is not None:
+            await self.channel_layer.group_send(room.group_name, read_receipt_event(room.group_name, self.user, marker))
+
+    async def publish_conversation_update(self, room, event):
+        """
+        Push the new conversation summary to both participants' per-user sockets, for their inbox.
+        """
+        update = {
+            "type": "conversation_updated",
+            "username": self.user.username,
+            "preview": event["message"][:PREVIEW_LENGTH],
+            "has_image": bool(event["image_url"]),
+            "timestamp": timezone.now().isoformat(),
+            "message_id": event.get("message_id"),
+        }
+        # the conversation is named after the other participant, only the recipient gets an unread message
+        await self.channel_layer.group_send(
+            user_group_name(room.other_user.id), {**update, "chat": self.user.username, "unread": True},
+        )
+        await self.channel_layer.group_send(
+            user_group_name(self.user.id), {**update, "chat": room.other_user.username, "unread": False},
+        )
+
+    def get_image_fields(self, data):
+        """
+        Message fields for the image uploaded through upload_image, if any.
+        """
+        image_name = data.get("image_name", "")
+        if not isinstance(image_name, str) or not image_name.startswith("chat_images/") or ".." in image_name:
+            return {}
+
+        # the size reported by upload_image, only used to reserve layout space
+        width, height = data.get("image_width"), data.get("image_height")
+        valid_size = all(
+            isinstance(value, int) and 0 < value <= settings.CHAT_IMAGE_FULL_SIZE for value in (width, height)
+        )
+        return {
+            "image": image_name,
+            "thumbnail": thumbnail_name_for(image_name),
+            "image_width": width if valid_size else None,
+            "image_height": height if valid_size else None,
+        }
+
+    async def broadcast_and_persist(self, room, event, message, image):
+        """
+        Fan the message out while it is being written, then tell the room whether the write succeeded.
+        """
+        event["client_id"] = str(uuid.uuid4())
+        sent, saved = await asyncio.gather(
+            self.channel_layer.group_send(room.group_name, event),
+            self.persist_message(room, message, image),
+            return_exceptions=True,
+        )
+
+        status = {"type": "message_status", "room": room.group_name, "client_id": event["client_id"]}
+        if isinstance(saved, Exception):
+            logger.error("Failed to store message in %s", room.group_name, exc_info=saved)
+            status.update(status="failed", message_id=None)
+        else:
+            status.update(status="persisted", message_id=saved.id)
+        await self.channel_layer.group_send(room.group_name, status)
+
+        if isinstance(sent, Exception):
+            raise sent
+
+    def frame(self, event, payload):
+        """
+        Outgoing frame for a group event, None drops it.
+        """
+        return payload
+
+    async def send_frame(self, event, payload):
+        payload = self.frame(event, payload)
+        if payload is not None:
+            await self.send_payload(payload)
 
     async def send_message(self, event):
         message = event["message"]
         username = event["username"]
         image_url = event["image_url"]
-        await self.send(
-            text_data=json.dumps({"username": username, "message": message, "image_url": image_url})
-        )
+        payload = {"username": username, "message": message, "image_url": image_url}
+        for key in ("message_html", "has_mention", "thumbnail_url", "image_width", "image_height", "message_id", "client_id"):
+            if key in event:
+                payload[key] = event[key]
+        await self.send_frame(event, payload)
+
+    async def message_status(self, event):
+        await self.send_frame(event, {
+            "type": "status", "client_id": event["client_id"], "status": event["status"], "message_id": event["message_id"],
+        })
+
+    async def presence_update(self, event):
+        if event["username"] != self.user.username:
+            await self.send_frame(event, {
+                "type": "presence", "username": event["username"], "online": event["online"], "last_seen": event["last_seen"],
+            })
+
+    async def user_typing(self, event):
+        if event["username"] != self.user.username:
+            await self.send_frame(event, {"type": "typing", "username": event["username"], "typing": event["typing"]})
+
+    async def read_receipt(self, event):
+        if event["username"] != self.user.username:
+            await self.send_frame(event, {"type": "read", "username": event["username"], "message_id": event["message_id"]})
 
     @database_sync_to_async
     def get_user(self, username):
-        return User.objects.get(username=username)
+        return get_cached_user(username)
 
     @database_sync_to_async
-    def get_or_create_chat(self, username1, username2):
-        user1 = User.objects.get(username=username1)
-        user2 = User.objects.get(username=username2)
+    def get_or_create_chat(self, user1, user2):
+        # no query at all once the pair is cached
+        return PrivateChat.between(user1, user2, fetch=False)
 
-        if user1.id < user2.id:
-            chat, _ = PrivateChat.objects.get_or_create(user1=user1, user2=user2)
-        else:
-            chat, _ = PrivateChat.objects.get_or_create(user1=user2, user2=user1)
-        return chat
+    async def save_message(self, room, message, image):
+        """
+        Store a message, returns None when write-behind acks before the write happens.
+        """
+        if settings.CHAT_WRITE_BEHIND and settings.CHAT_WRITE_BEHIND_ACK == "immediate":
+            await message_buffer.add(Message(chat=room.chat, user=self.user, content=message, **image))
+            return None
+        return await self.persist_message(room, message, image)
+
+    async def persist_message(self, room, message, image):
+        """
+        Store a message and wait for the write, whatever the ack mode.
+        """
+        if settings.CHAT_WRITE_BEHIND:
+            saved = await message_buffer.add(Message(chat=room.chat, user=self.user, content=message, **image))
+            return await saved
+        return await self.create_message(room.chat, message, image)
 
     @database_sync_to_async
-    def save_message(self, chat, user, message, image_name):
-        Message.objects.create(chat=chat, user=user, content=message, image=image_name)
+    def get_messages_after(self, chat, message_id):
+        return get_messages_after(chat, message_id)
+
+    @database_sync_to_async
+    def mark_read(self, chat, message_id):
+        return chat.mark_read(self.user, message_id)
+
+    @database_sync_to_async
+    def create_message(self, chat, message, image):
+        return chat.add_message(self.user, message, **image)
 
     def create_group_name(self, username1, username2):
-        return f"{username1}_{username2}" if username1 < username2 else f"{username2}_{username1}"
+        return room_group_name(username1, username2).removeprefix("chat_")
+
+
+class Chat(BaseChat):
+    """
+    Socket for a single conversation, ws/chat/<username>/<other_username>/.
+    """
+
+    async def connect(self):
+        # extract both usernames from url route
+        username1 = self.scope["url_route"]["kwargs"]["username"]
+        username2 = self.scope["url_route"]["kwargs"]["other_username"]
+
+        # the sender is the authenticated user, resolved once per connection
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated or self.user.username != username1 or username1 == username2:
+            await self.close()
+            return
+
+        other_user = await self.get_user(username2)
+        if other_user is None:
+            await self.close()
+            return
+
+        self.room = await self.join_room(other_user)
+        await self.accept_client()
+
+        # a reconnecting client passes the newest message it has as ?last_id=
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        if "last_id" in query:
+            try:
+                last_id = int(query["last_id"][0])
+            except ValueError:
+                logger.warning("Ignoring invalid last_id %r", query["last_id"][0])
+            else:
+                await self.replay(self.room, last_id)
+
+        if await self.start_presence():
+            await self.broadcast_presence(self.room, online=True)
+
+    async def disconnect(self, close_code):
+        self.close_outbox()
+        if hasattr(self, "room"):
+            await self.stop_presence([self.room])
+            await self.channel_layer.group_discard(self.room.group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        for data in self.decode(text_data, bytes_data):
+            if await self.allow_frame(data):
+                await self.receive_frame(self.room, data)
+
+
+class UserChat(BaseChat):
+    """
+    One socket per user multiplexing all of their conversations, ws/chat/.
+
+    The socket joins the user's personal group on connect, which delivers inbox updates,
+    and a conversation's group once the client sends {"type": "subscribe", "chat": "<other username>"}.
+    A reconnecting client adds "last_id", the newest message it has, to get the ones it missed replayed.
+    Frames for a conversation name it in "chat", in both directions.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # other username -> Room, and the reverse lookup for outgoing frames
+        self.rooms = {}
+        self.room_chats = {}
+        await self.channel_layer.group_add(user_group_name(self.user.id), self.channel_name)
+        await self.accept_client()
+        # rooms subscribed later only learn that the user came online if this connection did it
+        self.came_online = await self.start_presence()
+
+    async def disconnect(self, close_code):
+        self.close_outbox()
+        if not hasattr(self, "rooms"):
+            return
+        await self.stop_presence(list(self.rooms.values()))
+        for room in self.rooms.values():
+            await self.channel_layer.group_discard(room.group_name, self.channel_name)
+        await self.channel_layer.group_discard(user_group_name(self.user.id), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        for data in self.decode(text_data, bytes_data):
+            if await self.allow_frame(data):
+                await self.receive_data(data)
+
+    async def receive_data(self, data):
+        username = data.get("chat", "")
+        kind = data.get("type", "message")
+
+        if kind == "subscribe":
+            await self.subscribe(username, data.get("last_id"))
+        elif kind == "unsubscribe":
+            await self.unsubscribe(username)
+        elif username in self.rooms:
+            await self.receive_frame(self.rooms[username], data)
+        else:
+            await self.send_error(username, "Not subscribed.")
+
+    async def subscribe(self, username, last_id=None):
+        if username not in self.rooms:
+            other_user = None if username == self.user.username else await self.get_user(username)
+            if other_user is None:
+                await self.send_error(username, "Unknown user.")
+                return
+
+            room = await self.join_room(other_user)
+            self.rooms[username] = room
+            self.room_chats[room.group_name] = username
+            if self.came_online:
+                await self.broadcast_presence(room, online=True)
+        await self.send_payload({"type": "subscribed", "chat": username})
+        if last_id is not None:
+            await self.replay(self.rooms[username], last_id)
+
+    async def unsubscribe(self, username):
+        room = self.rooms.pop(username, None)
+        if room is not None:
+            del self.room_chats[room.group_name]
+            await room.typing.stop()
+            await self.channel_layer.group_discard(room.group_name, self.channel_name)
+
+    async def send_error(self, username, error):
+        await self.send_payload({"type": "error", "chat": username, "error": error})
+
+    def frame(self, event, payload):
+        # drop events of conversations unsubscribed from while they were in flight
+        username = self.room_chats.get(event.get("room"))
+        if username is None:
+            return None
+        return {**payload, "chat": username}
+
+    async def conversation_updated(self, event):
+        await self.send_payload({
+            "type": "conversation_updated",
+            "chat": event["chat"],
+            "username": event["username"],
+            "preview": event["preview"],
+            "has_image": event["has_image"],
+            "timestamp": event["timestamp"],
+            "message_id": event["message_id"],
+            "unread": event["unread"],
+        })
@@ -0,0 +1,33 @@
+def room_group_name(username1, username2):
+    """
+    Group of the conversation between two users, joined by every socket taking part in it.
+    """
+    return f"chat_{username1}_{username2}" if username1 < username2 else f"chat_{username2}_{username1}"
+
+def user_group_name(user_id):
+    """
+    Personal group every per-user socket of the user joins.
+    """
+    return f"user_{user_id}"
+
+def read_receipt_event(group_name, user, message_id):
+    return {"type": "read_receipt", "room": group_name, "username": user.username, "message_id": message_id}
+
+def message_payload(message):
+    """
+    Frame of a stored message, as send_message() would have delivered it live.
+    """
+    payload = {
+        "username": message.user.username,
+        "message": message.content,
+        "image_url": message.image.url if message.image else "",
+        "message_html": message.content_html,
+        "has_mention": message.has_mention,
+        "message_id": message.id,
+        "timestamp": message.timestamp.isoformat(),
+    }
+    if message.thumbnail:
+        payload.update(
+            thumbnail_url=message.thumbnail.url, image_width=message.image_width, image_height=message.image_height,
+        )
+    return payload
@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+# bump when templates/chat/message_body.html changes so stale fragments are not served
+FRAGMENT_VERSION = 2
+SIDES = ("own", "other")
+
+# image urls are signed and expire long before a fragment does, message_image.html is rendered
+# per request next to the cached body and never ends up in the cache
+
+def fragment_key(message_id, timestamp, side, chat_version=0):
+    # the timestamp guards against ids reused after a rollback or restore
+    return f"chat:message:{message_id}:{timestamp.timestamp():.6f}:{side}:c{chat_version}:v{FRAGMENT_VERSION}"
+
+def chat_version_key(chat_id):
+    return f"chat:fragments:{chat_id}:version"
+
+def chat_versions(cache, chat_ids):
+    """
+    Fragment version of every chat, bumped by invalidate_chat_fragments(), 0 until then.
+    """
+    keys = {chat_id: chat_version_key(chat_id) for chat_id in chat_ids}
+    versions = cache.get_many(keys.values())
+    return {chat_id: versions.get(key, 0) for chat_id, key in keys.items()}
+
+def attach_fragments(messages, user):
+    """
+    Set `message.body_html` to the rendered body of every message, as seen by `user`.
+    Cached bodies are fetched in one round trip (after one for the chat versions)
+    and only the missing ones are rendered.
+    """
+    cache = caches[settings.CHAT_FRAGMENT_CACHE]
+    versions = chat_versions(cache, {message.chat_id for message in messages})
+    keys = {
+        message.id: fragment_key(
+            message.id, message.timestamp, "own" if message.user_id == user.id else "other", versions[message.chat_id],
+        )
+        for message in messages
+    }
+    cached = cache.get_many(keys.values())
+
+    missing = {}
+    for message in messages:
+        key = keys[message.id]
+        if key not in cached:
+            cached[key] = missing[key] = render_to_string(
+                "chat/message_body.html", {"message": message, "own": message.user_id == user.id},
+            )
+        message.body_html = cached[key]
+
+    if missing:
+        cache.set_many(missing, settings.CHAT_FRAGMENT_CACHE_TIMEOUT)
+    return messages
+
+def invalidate_fragments(messages):
+    """
+    Drop the cached bodies of deleted messages, given as (chat id, id, timestamp) tuples.
+    """
+    cache = caches[settings.CHAT_FRAGMENT_CACHE]
+    versions = chat_versions(cache, {chat_id for chat_id, _, _ in messages})
+    keys = [
+        fragment_key(message_id, timestamp, side, versions[chat_id])
+        for chat_id, message_id, timestamp in messages for side in SIDES
+    ]
+    if keys:
+        cache.delete_many(keys)
+
+def invalidate_chat_fragments(chat_id):
+    """
+    Orphan every cached body of a chat at once by bumping its version, the old entries expire on their own.
+    """
+    cache = caches[settings.CHAT_FRAGMENT_CACHE]
+    key = chat_version_key(chat_id)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # evicted between add() and incr()
+        cache.set(key, 1, None)
@@ -0,0 +1,85 @@
+import io
+import logging
+import os
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+# exif orientations that rotate the image by 90 degrees
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+def bounded_size(width, height, bound):
+    """
+    Scale (width, height) down to fit in a bound x bound box, keeping the aspect ratio.
+    """
+    scale = min(1, bound / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def check_pixels(width, height):
+    # the byte size limit does not bound the decoded size of a well compressed image
+    if width * height > settings.CHAT_IMAGE_MAX_PIXELS:
+        raise Image.DecompressionBombError(f"Image of {width}x{height} pixels exceeds CHAT_IMAGE_MAX_PIXELS.")
+
+def read_size(file):
+    """
+    Displayed size of an uploaded image, read from its header only.
+    Raises PIL.UnidentifiedImageError for anything that is not an image
+    and PIL.Image.DecompressionBombError for images above CHAT_IMAGE_MAX_PIXELS.
+    """
+    image = Image.open(file)
+    width, height = image.size
+    check_pixels(width, height)
+    if image.getexif().get(0x0112) in ROTATED_ORIENTATIONS:
+        width, height = height, width
+    file.seek(0)
+    return width, height
+
+def variant_names(upload_name):
+    """
+    Names of the full size and thumbnail variants generated from an upload,
+    e.g. chat_images/uploads/<uuid>.png -> chat_images/<uuid>.webp, chat_images/<uuid>_thumb.webp
+    """
+    stem = os.path.splitext(os.path.basename(upload_name))[0]
+    extension = EXTENSIONS[settings.CHAT_IMAGE_FORMAT]
+    return f"chat_images/{stem}{extension}", f"chat_images/{stem}_thumb{extension}"
+
+def thumbnail_name_for(image_name):
+    """
+    Thumbnail of a full size variant, empty for images that did not go through the pipeline.
+    """
+    stem, extension = os.path.splitext(image_name)
+    if extension != EXTENSIONS[settings.CHAT_IMAGE_FORMAT] or stem.endswith("_thumb"):
+        return ""
+    return f"{stem}_thumb{extension}"
+
+def encode(image, size):
+    output = io.BytesIO()
+    resized = image.resize(size, Image.Resampling.LANCZOS) if size != image.size else image
+    if settings.CHAT_IMAGE_FORMAT == "JPEG" and resized.mode != "RGB":
+        resized = resized.convert("RGB")
+    resized.save(output, format=settings.CHAT_IMAGE_FORMAT, quality=80)
+    return ContentFile(output.getvalue())
+
+def process_upload(upload_name):
+    """
+    Re-encode an upload into bounded full size and thumbnail variants, then drop the original.
+    Runs in the background pool and only works on storage streams, so it works on S3 as well.
+    """
+    full_name, thumbnail_name = variant_names(upload_name)
+
+    with default_storage.open(upload_name) as file:
+        image = Image.open(file)
+        check_pixels(*image.size)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    full_size = bounded_size(*image.size, settings.CHAT_IMAGE_FULL_SIZE)
+    thumbnail_size = bounded_size(*image.size, settings.CHAT_IMAGE_THUMBNAIL_SIZE)
+    default_storage.save(full_name, encode(image, full_size))
+    default_storage.save(thumbnail_name, encode(image, thumbnail_size))
+    default_storage.delete(upload_name)
+    logger.debug("Processed %s into %s and %s", upload_name, full_name, thumbnail_name)
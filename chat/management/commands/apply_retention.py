@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.retention import archive_messages, sweep_orphaned_images
+
+
+class Command(BaseCommand):
+    help = "Archive old messages and delete chat images no message refers to, meant to run periodically."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--archive-after-days", type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+            help="Archive messages older than this, 0 disables archiving. Archived messages are no longer shown in chats.",
+        )
+        parser.add_argument(
+            "--grace-hours", type=int, default=settings.CHAT_ORPHAN_GRACE_HOURS,
+            help="Keep unreferenced images younger than this, their message may not be sent yet.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1_000, help="Messages or files per batch.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report the orphaned images.")
+
+    def handle(self, *args, **options):
+        if options["archive_after_days"] and not options["dry_run"]:
+            older_than = datetime.now(timezone.utc) - timedelta(days=options["archive_after_days"])
+            archived = archive_messages(older_than, batch_size=options["batch_size"])
+            self.stdout.write(f"Archived {archived} messages.")
+
+        deleted, reclaimed = sweep_orphaned_images(
+            grace=timedelta(hours=options["grace_hours"]), batch_size=options["batch_size"], dry_run=options["dry_run"],
+        )
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {deleted} orphaned images, {reclaimed} bytes reclaimed."))
@@ -0,0 +1,147 @@
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import F, Q
+from chat.models import PrivateChat, Message
+from chat.pagination import decode_cursor, get_messages_page
+
+USERNAME_PREFIX = "benchmark_user_"
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large dataset and compare query plans and timings of the chat hot paths with and without the indexes. "
+        "Runs in a throwaway test database created from the settings of --database, never in the database itself."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1_000_000, help="Number of messages to seed.")
+        parser.add_argument("--chats", type=int, default=1_000, help="Number of conversations to spread them over.")
+        parser.add_argument("--batch-size", type=int, default=10_000, help="Rows per bulk insert.")
+        parser.add_argument("--runs", type=int, default=20, help="Timed runs per query.")
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the test database and its data, the next run reuses them.",
+        )
+        parser.add_argument(
+            "--database", help="Alias whose settings the test database is created from, required when DEBUG is off.",
+        )
+
+    def handle(self, *args, **options):
+        self.db = options["database"]
+        if self.db is None:
+            if not settings.DEBUG:
+                raise CommandError("Refusing to run with DEBUG off, pass --database to name a scratch database.")
+            self.db = DEFAULT_DB_ALIAS
+        connection = connections[self.db]
+
+        # indexes are dropped and a lot of rows seeded, only ever in a database made for it
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=options["keep"],
+        )
+        try:
+            self.benchmark(connection, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keep"])
+
+    def benchmark(self, connection, options):
+        if not User.objects.using(self.db).filter(username__startswith=USERNAME_PREFIX).exists():
+            self.seed(options["messages"], options["chats"], options["batch_size"])
+
+        message_index = next(index for index in Message._meta.indexes if index.name == "chat_message_chat_ts_id_idx")
+        pair_constraint = next(
+            constraint for constraint in PrivateChat._meta.constraints if constraint.name == "unique_private_chat_users"
+        )
+
+        try:
+            # sqlite drops constraints by rebuilding the table from the model state
+            PrivateChat._meta.constraints = [c for c in PrivateChat._meta.constraints if c is not pair_constraint]
+            with connection.schema_editor() as editor:
+                editor.remove_index(Message, message_index)
+                editor.remove_constraint(PrivateChat, pair_constraint)
+            self.stdout.write(self.style.MIGRATE_HEADING("Without indexes"))
+            self.run_queries(options["runs"])
+        finally:
+            PrivateChat._meta.constraints = [*PrivateChat._meta.constraints, pair_constraint]
+            with connection.schema_editor() as editor:
+                editor.add_index(Message, message_index)
+                editor.add_constraint(PrivateChat, pair_constraint)
+
+        self.stdout.write(self.style.MIGRATE_HEADING("With indexes"))
+        self.run_queries(options["runs"])
+
+    def seed(self, message_count, chat_count, batch_size):
+        self.stdout.write(f"Seeding {message_count} messages in {chat_count} chats...")
+        # unusable passwords skip the (slow) password hashing
+        User.objects.using(self.db).bulk_create(
+            [User(username=f"{USERNAME_PREFIX}{i}", password="!") for i in range(chat_count + 1)]
+        )
+        users = list(User.objects.using(self.db).filter(username__startswith=USERNAME_PREFIX).order_by("id"))
+        PrivateChat.objects.using(self.db).bulk_create([PrivateChat(user1=users[0], user2=user) for user in users[1:]])
+        chats = list(PrivateChat.objects.using(self.db).filter(user1=users[0]).order_by("id"))
+
+        # spread messages over the past year so timestamps are realistic and mostly distinct
+        start = datetime.now(timezone.utc) - timedelta(days=365)
+        step = timedelta(days=365) / max(message_count, 1)
+        timestamp_field = Message._meta.get_field("timestamp")
+        timestamp_field.auto_now_add = False
+        try:
+            for offset in range(0, message_count, batch_size):
+                batch = []
+                for i in range(offset, min(offset + batch_size, message_count)):
+                    chat = chats[i % len(chats)]
+                    user_id = chat.user1_id if i % 2 else chat.user2_id
+                    batch.append(
+                        Message(chat=chat, user_id=user_id, content=f"Benchmark message {i}", timestamp=start + step * i)
+                    )
+                Message.objects.using(self.db).bulk_create(batch)
+                self.stdout.write(f"  {offset + len(batch)}/{message_count}")
+        finally:
+            timestamp_field.auto_now_add = True
+
+        for chat in chats:
+            latest = chat.messages.order_by("-timestamp", "-id").first()
+            if latest:
+                PrivateChat.objects.using(self.db).filter(id=chat.id).update(
+                    last_message=latest, last_message_preview=latest.content, last_message_timestamp=latest.timestamp,
+                )
+
+    def run_queries(self, runs):
+        user = User.objects.using(self.db).filter(username__startswith=USERNAME_PREFIX).order_by("id").first()
+        chat = PrivateChat.objects.using(self.db).filter(user1=user).order_by("id").last()
+        _, cursor = get_messages_page(chat, limit=1)
+
+        queries = {
+            "chat page (newest messages)": lambda: chat.messages.order_by("-timestamp", "-id")[:50],
+            "chat page (keyset cursor)": lambda: self.keyset_queryset(chat, cursor),
+            "latest message of a chat": lambda: chat.messages.order_by("-timestamp")[:1],
+            "chat by user pair": lambda: PrivateChat.objects.using(self.db).filter(
+                user1=chat.user1_id, user2=chat.user2_id,
+            ),
+            "inbox": lambda: PrivateChat.objects.using(self.db).filter(Q(user1=user) | Q(user2=user)).order_by(
+                F("last_message_timestamp").desc(nulls_last=True)
+            ),
+        }
+
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                list(queryset())
+                timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(self.style.SUCCESS(
+                f"{name}: median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms"
+            ))
+            self.stdout.write(queryset().explain())
+
+    def keyset_queryset(self, chat, cursor):
+        if not cursor:
+            return chat.messages.order_by("-timestamp", "-id")[:50]
+        timestamp, message_id = decode_cursor(cursor)
+        return chat.messages.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        ).order_by("-timestamp", "-id")[:50]
@@ -0,0 +1,59 @@
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from chat.models import PrivateChat, Message
+from chat.transfer import FORMATS, guess_format, write_records
+
+MESSAGE_FIELDS = ("id", "chat_id", "user__username", "content", "image", "thumbnail", "image_width", "image_height", "timestamp")
+
+
+class Command(BaseCommand):
+    help = "Stream the conversations of one user or the whole site to newline-delimited JSON or msgpack."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="File to write to, - for stdout.")
+        parser.add_argument("--user", help="Only export the conversations of this user.")
+        parser.add_argument("--format", choices=FORMATS, help="Defaults to msgpack for .msgpack files, jsonl otherwise.")
+        parser.add_argument("--chunk-size", type=int, default=2_000, help="Rows fetched per database round trip.")
+
+    def handle(self, *args, **options):
+        chats = PrivateChat.objects.all()
+        messages = Message.objects.all()
+        if options["user"]:
+            user = User.objects.filter(username=options["user"]).first()
+            if user is None:
+                raise CommandError(f"User {options['user']} does not exist.")
+            chats = chats.filter(Q(user1=user) | Q(user2=user))
+            messages = messages.filter(Q(chat__user1=user) | Q(chat__user2=user))
+
+        records = self.records(chats, messages, options["chunk_size"])
+        format = options["format"] or guess_format(options["output"])
+        if options["output"] == "-":
+            count = write_records(sys.stdout.buffer, records, format)
+        else:
+            with open(options["output"], "wb") as file:
+                count = write_records(file, records, format)
+
+        self.stderr.write(self.style.SUCCESS(f"Exported {count} records."))
+
+    def records(self, chats, messages, chunk_size):
+        # values() + iterator() use server-side cursors where available, memory stays constant
+        chats = chats.order_by("id").values_list("id", "user1__username", "user2__username")
+        for chat_id, user1, user2 in chats.iterator(chunk_size=chunk_size):
+            yield {"type": "chat", "id": chat_id, "user1": user1, "user2": user2}
+
+        for row in messages.order_by("id").values_list(*MESSAGE_FIELDS).iterator(chunk_size=chunk_size):
+            record = dict(zip(MESSAGE_FIELDS, row))
+            yield {
+                "type": "message",
+                "id": record["id"],
+                "chat": record["chat_id"],
+                "user": record["user__username"],
+                "content": record["content"],
+                "image": record["image"],
+                "thumbnail": record["thumbnail"],
+                "image_width": record["image_width"],
+                "image_height": record["image_height"],
+                "timestamp": record["timestamp"].isoformat(),
+            }
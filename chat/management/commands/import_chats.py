@@ -0,0 +1,135 @@
+import json
+import os
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from chat.models import PREVIEW_LENGTH, PrivateChat, Message
+from chat.transfer import FORMATS, guess_format, read_records
+
+
+class Command(BaseCommand):
+    help = (
+        "Load conversations written by export_chats. Chats are matched by their participants, missing users are "
+        "created without a usable password and imported messages count as read. Image files are not copied."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="File written by export_chats.")
+        parser.add_argument("--format", choices=FORMATS, help="Defaults to msgpack for .msgpack files, jsonl otherwise.")
+        parser.add_argument("--batch-size", type=int, default=1_000, help="Messages per bulk insert.")
+        parser.add_argument(
+            "--checkpoint", help="File recording the progress after each batch, an interrupted import resumes from it.",
+        )
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options["input"]):
+            raise CommandError(f"{options['input']} does not exist.")
+
+        checkpoint = options["checkpoint"]
+        skip = self.read_checkpoint(checkpoint)
+        if skip:
+            self.stdout.write(f"Resuming after {skip} messages.")
+
+        self.users = {}
+        self.chats = {}
+        touched = set()
+        imported = 0
+        seen = 0
+        batch = []
+
+        timestamp_field = Message._meta.get_field("timestamp")
+        timestamp_field.auto_now_add = False
+        try:
+            with open(options["input"], "rb") as file:
+                for record in read_records(file, options["format"] or guess_format(options["input"])):
+                    if record["type"] == "chat":
+                        # cheap and idempotent, replayed on resume to rebuild the id mapping
+                        self.chats[record["id"]] = PrivateChat.between(
+                            self.get_user(record["user1"]), self.get_user(record["user2"]),
+                        )
+                        continue
+
+                    seen += 1
+                    if seen <= skip:
+                        continue
+                    batch.append(self.build_message(record))
+                    if len(batch) >= options["batch_size"]:
+                        imported += self.write_batch(batch, touched, skip + imported, checkpoint)
+                        batch = []
+
+                if batch:
+                    imported += self.write_batch(batch, touched, skip + imported, checkpoint)
+        finally:
+            timestamp_field.auto_now_add = True
+
+        for chat_id in touched:
+            refresh_summary(chat_id)
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(f"Imported {imported} messages into {len(touched)} chats."))
+
+    def read_checkpoint(self, checkpoint):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as file:
+            return json.load(file)["messages"]
+
+    def get_user(self, username):
+        if username not in self.users:
+            user = User.objects.filter(username=username).first()
+            if user is None:
+                user = User(username=username)
+                user.set_unusable_password()
+                user.save()
+            self.users[username] = user
+        return self.users[username]
+
+    def build_message(self, record):
+        chat = self.chats.get(record["chat"])
+        if chat is None:
+            raise CommandError(f"Message {record['id']} belongs to chat {record['chat']} which is not in the file.")
+
+        message = Message(
+            chat=chat,
+            user=self.get_user(record["user"]),
+            content=record["content"],
+            image=record["image"],
+            thumbnail=record["thumbnail"],
+            image_width=record["image_width"],
+            image_height=record["image_height"],
+            timestamp=datetime.fromisoformat(record["timestamp"]),
+        )
+        message.render()
+        return message
+
+    def write_batch(self, batch, touched, done, checkpoint):
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+        touched.update(message.chat_id for message in batch)
+
+        # written after the commit, a crash in between re-imports at most one batch
+        if checkpoint:
+            with open(checkpoint, "w") as file:
+                json.dump({"messages": done + len(batch)}, file)
+        self.stdout.write(f"  {done + len(batch)} messages")
+        return len(batch)
+
+
+def refresh_summary(chat_id):
+    """
+    Point the conversation summary at its newest message and move both read markers up to it.
+    """
+    latest = Message.objects.filter(chat_id=chat_id).order_by("-timestamp", "-id").first()
+    if latest is None:
+        return
+    PrivateChat.objects.filter(id=chat_id).update(
+        last_message=latest,
+        last_message_preview=latest.content[:PREVIEW_LENGTH],
+        last_message_timestamp=latest.timestamp,
+        user1_unread_count=0,
+        user2_unread_count=0,
+        user1_last_read_id=latest.id,
+        user2_last_read_id=latest.id,
+    )
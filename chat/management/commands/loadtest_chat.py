@@ -0,0 +1,226 @@
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+from importlib import import_module
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from chat.models import PrivateChat
+
+USERNAME_PREFIX = "loadtest_user_"
+
+
+class QueryCounter:
+    """
+    Counts queries on every database connection of the process, including the consumer threads.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def uninstall(self, connection, **kwargs):
+        if self in connection.execute_wrappers:
+            connection.execute_wrappers.remove(self)
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive concurrent websocket conversations through the ASGI application and report latency and throughput "
+        "as JSON. Runs in a throwaway test database, with caches, presence, rate limits and the channel layer in memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=1_000, help="Concurrent conversations (two sockets each).")
+        parser.add_argument("--messages", type=int, default=10, help="Messages sent per conversation.")
+        parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per conversation.")
+        parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for a single frame.")
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the test database with the generated users, sessions and messages.",
+        )
+        parser.add_argument(
+            "--database", help="Alias whose settings the test database is created from, required when DEBUG is off.",
+        )
+
+    def handle(self, *args, **options):
+        alias = options["database"]
+        if alias is None:
+            if not settings.DEBUG:
+                raise CommandError("Refusing to run with DEBUG off, pass --database to name a scratch database.")
+            alias = DEFAULT_DB_ALIAS
+        elif alias != DEFAULT_DB_ALIAS:
+            raise CommandError(f"The chat consumers only use the {DEFAULT_DB_ALIAS!r} database.")
+
+        # imported here so the command can be listed without building the asgi application
+        from main.asgi import application
+
+        # users, sessions and messages are only ever written to a database made for it
+        creation = connections[alias].creation
+        old_name = creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=options["keep"])
+        try:
+            with override_settings(**self.isolated_settings()):
+                conversations = self.setup(options["conversations"])
+                report = asyncio.run(self.run(application, conversations, options))
+        finally:
+            creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keep"])
+
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def isolated_settings(self):
+        """
+        In-process stand-ins for everything shared through Redis: the test database reuses the ids
+        of real users, whose cached chats, presence, rate limits and user groups must not be touched.
+        """
+        return {
+            "CACHES": {
+                name: {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": f"loadtest_{name}"}
+                for name in settings.CACHES
+            },
+            "CHANNEL_LAYERS": {"default": {
+                "BACKEND": "channels.layers.InMemoryChannelLayer",
+                "CONFIG": {"capacity": settings.CHANNEL_LAYERS["default"]["CONFIG"]["capacity"]},
+            }},
+            "PRESENCE_REDIS_URL": "",
+            "RATE_LIMIT_REDIS_URL": "",
+        }
+
+    def setup(self, count):
+        """
+        Create two users, their chat and a signed-in session for each side of every conversation.
+        """
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        # unusable passwords skip the (slow) password hashing
+        User.objects.bulk_create([User(username=f"{USERNAME_PREFIX}{i}", password="!") for i in range(count * 2)])
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by("id"))
+
+        conversations = []
+        for sender, receiver in zip(users[::2], users[1::2]):
+            PrivateChat.objects.create(user1=sender, user2=receiver)
+            conversations.append((
+                (sender.username, receiver.username, self.create_session(sender)),
+                (receiver.username, sender.username, self.create_session(receiver)),
+            ))
+        return conversations
+
+    def create_session(self, user):
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    async def run(self, application, conversations, options):
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        # the consumers may reuse an already open connection in the database thread
+        await database_sync_to_async(lambda: counter.install(connection))()
+
+        try:
+            sockets = []
+            for start in range(0, len(conversations), 100):
+                sockets += await asyncio.gather(*(
+                    self.open_conversation(application, conversation, options["timeout"])
+                    for conversation in conversations[start:start + 100]
+                ))
+
+            counter.count = 0
+            started = time.perf_counter()
+            results = await asyncio.gather(
+                *(self.drive_conversation(sender, receiver, options) for sender, receiver in sockets),
+                return_exceptions=True,
+            )
+            duration = time.perf_counter() - started
+            queries = counter.count
+
+            await asyncio.gather(*(socket.disconnect() for pair in sockets for socket in pair), return_exceptions=True)
+        finally:
+            connection_created.disconnect(counter.install)
+            await database_sync_to_async(lambda: counter.uninstall(connection))()
+
+        latencies = [latency for result in results if isinstance(result, list) for latency in result]
+        errors = [repr(result) for result in results if isinstance(result, Exception)]
+        sent = len(conversations) * options["messages"]
+
+        return {
+            "conversations": len(conversations),
+            "messages_sent": sent,
+            "messages_delivered": len(latencies),
+            "errors": len(errors),
+            "first_errors": errors[:5],
+            "duration_seconds": round(duration, 3),
+            "messages_per_second": round(len(latencies) / duration, 2) if duration else 0,
+            "latency_ms": self.percentiles(latencies),
+            "queries_per_message": round(queries / sent, 2) if sent else 0,
+        }
+
+    async def open_conversation(self, application, conversation, timeout):
+        sockets = []
+        origin = f"http://{settings.ALLOWED_HOSTS[0]}".encode()
+        for username, other_username, session_key in conversation:
+            communicator = WebsocketCommunicator(application, f"/ws/chat/{username}/{other_username}/", headers=[
+                (b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode()), (b"origin", origin),
+            ])
+            connected, _ = await communicator.connect(timeout=timeout)
+            if not connected:
+                raise RuntimeError(f"Connection refused for {username}")
+            sockets.append(communicator)
+        return sockets
+
+    async def drive_conversation(self, sender, receiver, options):
+        """
+        Send messages at the configured rate and return the end-to-end latency of each, in ms.
+        """
+        sent_at = {}
+        interval = 1 / options["rate"]
+
+        async def send():
+            # spread the conversations over the first interval
+            await asyncio.sleep(random.uniform(0, interval))
+            for sequence in range(options["messages"]):
+                sent_at[str(sequence)] = time.perf_counter()
+                await sender.send_json_to({"message": str(sequence)})
+                await asyncio.sleep(interval)
+
+        async def receive(communicator, latencies):
+            received = 0
+            while received < options["messages"]:
+                data = await communicator.receive_json_from(timeout=options["timeout"])
+                # presence and typing frames carry a type, chat messages do not
+                if "type" in data:
+                    continue
+                received += 1
+                if latencies is not None:
+                    latencies.append((time.perf_counter() - sent_at[data["message"]]) * 1000)
+
+        latencies = []
+        # the sender gets its own echo as well, drain it so frames do not pile up
+        await asyncio.gather(send(), receive(receiver, latencies), receive(sender, None))
+        return latencies
+
+    def percentiles(self, latencies):
+        if len(latencies) < 2:
+            return {"p50": None, "p95": None, "p99": None, "max": max(latencies, default=None)}
+
+        cuts = statistics.quantiles(latencies, n=100)
+        return {
+            "p50": round(cuts[49], 2), "p95": round(cuts[94], 2), "p99": round(cuts[98], 2), "max": round(max(latencies), 2),
+        }
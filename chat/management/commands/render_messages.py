@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from chat.models import Message
+
+RENDERED_FIELDS = ["content_html", "has_link", "has_mention"]
+
+
+class Command(BaseCommand):
+    help = "Backfill the pre-rendered html and flags of messages stored before they existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1_000, help="Messages per bulk update.")
+        parser.add_argument("--all", action="store_true", help="Re-render every message, not only missing ones.")
+
+    def handle(self, *args, **options):
+        messages = Message.objects.exclude(content="")
+        if not options["all"]:
+            messages = messages.filter(content_html="")
+
+        # keyset batches, rows drop out of the filter as they are rendered
+        rendered = 0
+        last_id = 0
+        while True:
+            batch = list(messages.filter(id__gt=last_id).order_by("id").only("id", "content")[:options["batch_size"]])
+            if not batch:
+                break
+            for message in batch:
+                message.render()
+            Message.objects.bulk_update(batch, RENDERED_FIELDS)
+            rendered += len(batch)
+            last_id = batch[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered {rendered} messages."))
@@ -0,0 +1,229 @@
+import contextvars
+import functools
+import hmac
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse, HttpResponseForbidden
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@dataclass
+class Sample:
+    """
+    Cost of a single request or websocket event, filled in while it is being handled.
+    """
+    queries: int = 0
+    db_time: float = 0.0
+    pool_wait: float = 0.0
+
+
+# the sample of the request/event being handled, copied into sync_to_async threads
+current_sample = contextvars.ContextVar("current_sample", default=None)
+
+
+class Metric:
+    def __init__(self, registry, name, kind, help_text):
+        self.registry = registry
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.registry.lock:
+            buckets, total, count = self.values.get(key, ([0] * len(DURATION_BUCKETS), 0.0, 0))
+            buckets = [hits + (value <= bound) for hits, bound in zip(buckets, DURATION_BUCKETS)]
+            self.values[key] = (buckets, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+                continue
+
+            buckets, total, count = value
+            for bound, hits in zip(DURATION_BUCKETS, buckets):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {hits}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return "\n".join(lines)
+
+
+class Registry:
+    """
+    In-process metrics registry rendered in the Prometheus text format, one per worker process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def counter(self, name, help_text):
+        return self.register(name, "counter", help_text)
+
+    def gauge(self, name, help_text):
+        return self.register(name, "gauge", help_text)
+
+    def histogram(self, name, help_text):
+        return self.register(name, "histogram", help_text)
+
+    def register(self, name, kind, help_text):
+        if name not in self.metrics:
+            self.metrics[name] = Metric(self, name, kind, help_text)
+        return self.metrics[name]
+
+    def render(self):
+        with self.lock:
+            return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+handler_duration = registry.histogram(
+    "chat_handler_duration_seconds", "Total time spent handling a request or websocket event.",
+)
+handler_queries = registry.counter(
+    "chat_handler_db_queries_total", "Database queries run while handling requests or websocket events.",
+)
+handler_db_time = registry.counter(
+    "chat_handler_db_duration_seconds_total", "Time spent in database queries.",
+)
+handler_pool_wait = registry.counter(
+    "chat_handler_threadpool_wait_seconds_total", "Time database calls spent waiting for the sync thread pool.",
+)
+
+def record(kind, route, event, sample, duration):
+    labels = {"kind": kind, "route": route, "event": event}
+    handler_duration.observe(duration, **labels)
+    handler_queries.inc(sample.queries, **labels)
+    handler_db_time.inc(sample.db_time, **labels)
+    handler_pool_wait.inc(sample.pool_wait, **labels)
+
+    if settings.METRICS_LOG:
+        logger.info(json.dumps({
+            **labels,
+            "duration_ms": round(duration * 1000, 3),
+            "queries": sample.queries,
+            "db_ms": round(sample.db_time * 1000, 3),
+            "pool_wait_ms": round(sample.pool_wait * 1000, 3),
+        }))
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding the query to the current sample, if any.
+    """
+    sample = current_sample.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.db_time += time.perf_counter() - started
+
+def database_sync_to_async(func):
+    """
+    Drop-in for channels' database_sync_to_async that also records how long
+    the call waited for a free thread.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        submitted = time.perf_counter()
+
+        def run():
+            sample = current_sample.get()
+            if sample is not None:
+                sample.pool_wait += time.perf_counter() - submitted
+            return func(*args, **kwargs)
+
+        return await channels_database_sync_to_async(run)()
+    return wrapper
+
+
+class MetricsMiddleware:
+    """
+    Record query count, database time and total time of every request, labelled by url name.
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample = Sample()
+        token = current_sample.set(sample)
+        started = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            duration = time.perf_counter() - started
+            current_sample.reset(token)
+            match = request.resolver_match
+            record("http", match.view_name if match else "unresolved", request.method, sample, duration)
+
+
+class MetricsConsumerMixin:
+    """
+    Record query count, database and thread-pool wait time and total time of every event a consumer handles.
+    """
+
+    async def dispatch(self, message):
+        if not settings.METRICS_ENABLED:
+            return await super().dispatch(message)
+
+        sample = Sample()
+        token = current_sample.set(sample)
+        started = time.perf_counter()
+        try:
+            return await super().dispatch(message)
+        finally:
+            duration = time.perf_counter() - started
+            current_sample.reset(token)
+            record("websocket", type(self).__name__, message["type"], sample, duration)
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, protected by METRICS_TOKEN or restricted to staff when no token is set.
+    """
+    if settings.METRICS_TOKEN:
+        # constant time, bytes because compare_digest() refuses non-ascii str
+        authorization = request.headers.get("Authorization", "").encode()
+        if not hmac.compare_digest(authorization, f"Bearer {settings.METRICS_TOKEN}".encode()):
+            return HttpResponseForbidden()
+    elif not request.user.is_staff:
+        return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,63 @@
+# Generated by Django 6.0.5 on 2026-10-18 04:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_summaries(apps, schema_editor):
+    PrivateChat = apps.get_model('chat', 'PrivateChat')
+    Message = apps.get_model('chat', 'Message')
+
+    for chat in PrivateChat.objects.iterator():
+        latest = Message.objects.filter(chat=chat).order_by('-timestamp', '-id').first()
+        if latest:
+            chat.last_message = latest
+            chat.last_message_preview = latest.content[:100]
+            chat.last_message_timestamp = latest.timestamp
+            chat.save(update_fields=['last_message', 'last_message_preview', 'last_message_timestamp'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_message_image'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='user1_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='user2_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='privatechat',
+            index=models.Index(fields=['user1', '-last_message_timestamp'], name='chat_user1_last_message_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatechat',
+            index=models.Index(fields=['user2', '-last_message_timestamp'], name='chat_user2_last_message_idx'),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
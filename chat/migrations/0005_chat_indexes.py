@@ -0,0 +1,47 @@
+# Generated by Django 6.0.5 on 2026-10-18 04:18
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_duplicate_chats(apps, schema_editor):
+    PrivateChat = apps.get_model('chat', 'PrivateChat')
+    Message = apps.get_model('chat', 'Message')
+
+    duplicates = (
+        PrivateChat.objects.values('user1', 'user2')
+        .annotate(count=Count('id'), keep_id=Min('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        others = PrivateChat.objects.filter(user1=duplicate['user1'], user2=duplicate['user2']).exclude(id=duplicate['keep_id'])
+        Message.objects.filter(chat__in=others).update(chat_id=duplicate['keep_id'])
+        others.delete()
+
+        chat = PrivateChat.objects.get(id=duplicate['keep_id'])
+        latest = Message.objects.filter(chat=chat).order_by('-timestamp', '-id').first()
+        chat.last_message = latest
+        chat.last_message_preview = latest.content[:100] if latest else ''
+        chat.last_message_timestamp = latest.timestamp if latest else None
+        chat.save(update_fields=['last_message', 'last_message_preview', 'last_message_timestamp'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_privatechat_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'timestamp', 'id'], name='chat_message_chat_ts_id_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_chats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='privatechat',
+            constraint=models.UniqueConstraint(fields=('user1', 'user2'), name='unique_private_chat_users'),
+        ),
+    ]
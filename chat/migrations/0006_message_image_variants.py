@@ -0,0 +1,29 @@
+# Generated by Django 6.0.5 on 2026-10-18 04:33
+
+import chat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chat_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to=chat.models.chat_image_path),
+        ),
+    ]
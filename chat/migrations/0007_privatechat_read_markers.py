@@ -0,0 +1,34 @@
+# Generated by Django 6.0.5 on 2026-10-18 04:53
+
+from django.db import migrations, models
+
+
+def backfill_read_markers(apps, schema_editor):
+    PrivateChat = apps.get_model('chat', 'PrivateChat')
+
+    # participants without unread messages have seen everything so far
+    for prefix in ('user1', 'user2'):
+        PrivateChat.objects.filter(**{f'{prefix}_unread_count': 0}, last_message__isnull=False).update(
+            **{f'{prefix}_last_read_id': models.F('last_message_id')}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='privatechat',
+            name='user1_last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='user2_last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_markers, migrations.RunPython.noop),
+    ]
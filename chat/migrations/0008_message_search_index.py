@@ -0,0 +1,56 @@
+# Generated by Django 6.0.5 on 2026-10-18 05:02
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        # expression index, maintained by postgres on insert/update/delete, no table rewrite
+        schema_editor.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_message_search_idx "
+            "ON chat_message USING GIN (to_tsvector('simple'::regconfig, content))"
+        )
+    elif vendor == 'sqlite':
+        # external content fts5 table over chat_message, kept in sync by triggers
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE chat_message_fts USING fts5(content, content='chat_message', content_rowid='id')"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN "
+            "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN "
+            "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN "
+            "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+            "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+        schema_editor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS chat_message_search_idx")
+    elif vendor == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS chat_message_fts_{trigger}")
+        schema_editor.execute("DROP TABLE IF EXISTS chat_message_fts")
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('chat', '0007_privatechat_read_markers'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.5 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_html',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='has_link',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='has_mention',
+            field=models.BooleanField(default=False),
+        ),
+    ]
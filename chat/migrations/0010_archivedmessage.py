@@ -0,0 +1,32 @@
+# Generated by Django 6.0.5 on 2026-10-18 05:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_content_html'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('content', models.TextField(blank=True)),
+                ('image', models.CharField(blank=True, max_length=100)),
+                ('thumbnail', models.CharField(blank=True, max_length=100)),
+                ('timestamp', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='chat.privatechat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat', 'timestamp', 'id'], name='chat_archived_chat_ts_id_idx')],
+            },
+        ),
+    ]
@@ -1,8 +1,15 @@
 import os
 import uuid
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce, Greatest, Least
 from django.contrib.auth.models import User
 from datetime import datetime, timedelta, timezone
+from .rendering import content_flags, render_content
+
+PREVIEW_LENGTH = 100
 
 def chat_image_path(instance, filename):
     """
@@ -12,11 +19,179 @@ def chat_image_path(instance, filename):
     unique_filename = f"{uuid.uuid4()}{file_extension}"
     return f"chat_images/{unique_filename}"
 
+def chat_upload_path(filename):
+    """
+    Raw uploads waiting to be processed into the variants stored next to them in chat_images/.
+    """
+    return f"chat_images/uploads/{os.path.basename(chat_image_path(None, filename))}"
+
+def time_since(timestamp):
+    """
+    Human readable age of a timestamp, e.g. "5 minutes ago".
+    """
+    now_time = datetime.now(timezone.utc)
+    timediff = now_time - timestamp
+
+    if timediff < timedelta(minutes=1):
+        return f"{int(timediff.total_seconds())} seconds ago"
+    elif timediff < timedelta(hours=1):
+        return f"{int(timediff.total_seconds() // 60)} minutes ago"
+    elif timediff < timedelta(days=1):
+        return f"{int(timediff.total_seconds() // 3600)} hours ago"
+    else:
+        return f"{int(timediff.total_seconds() // 86400)} days ago"
+
 
 class PrivateChat(models.Model):
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chats_user1")
     user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chats_user2")
 
+    # denormalized conversation summary, kept up to date by add_message()/remove_message()
+    last_message = models.ForeignKey("Message", on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_timestamp = models.DateTimeField(null=True, blank=True)
+    user1_unread_count = models.PositiveIntegerField(default=0)
+    user2_unread_count = models.PositiveIntegerField(default=0)
+    # id of the newest message each participant has seen, only ever moves forward
+    user1_last_read_id = models.PositiveBigIntegerField(default=0)
+    user2_last_read_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user1", "user2"], name="unique_private_chat_users"),
+        ]
+        indexes = [
+            models.Index(fields=["user1", "-last_message_timestamp"], name="chat_user1_last_message_idx"),
+            models.Index(fields=["user2", "-last_message_timestamp"], name="chat_user2_last_message_idx"),
+        ]
+
+    @staticmethod
+    def pair_key(user1_id, user2_id):
+        return f"chat:pair:{user1_id}:{user2_id}"
+
+    @classmethod
+    def between(cls, user_a, user_b, fetch=True):
+        """
+        Fetch/create the chat between two users, the pair -> chat id mapping is cached.
+        With fetch=False a cache hit costs no query at all, the returned instance then only
+        has its id and participants set, which is all add_message()/mark_read() need.
+        """
+        user1, user2 = (user_a, user_b) if user_a.id < user_b.id else (user_b, user_a)
+        key = cls.pair_key(user1.id, user2.id)
+        chat_id = cache.get(key)
+        if chat_id is not None:
+            if not fetch:
+                chat = cls(id=chat_id, user1=user1, user2=user2)
+                chat._state.adding = False
+                return chat
+            chat = cls.objects.filter(id=chat_id).first()
+            if chat is not None:
+                return chat
+
+        chat, _ = cls.objects.get_or_create(user1=user1, user2=user2)
+        cache.set(key, chat.id, settings.USER_CACHE_TIMEOUT)
+        return chat
+
+    def unread_count_for(self, user):
+        return self.user1_unread_count if user.id == self.user1_id else self.user2_unread_count
+
+    def last_read_id_for(self, user):
+        return self.user1_last_read_id if user.id == self.user1_id else self.user2_last_read_id
+
+    def get_time_diff(self):
+        if self.last_message_timestamp:
+            return time_since(self.last_message_timestamp)
+        return "No messages yet"
+
+    def add_message(self, user, content="", image="", **fields):
+        """
+        Store a new message and update the conversation summary in the same transaction.
+        """
+        with transaction.atomic():
+            message = Message.objects.create(chat=self, user=user, content=content, image=image, **fields)
+            self.record_messages([message])
+        return message
+
+    def record_messages(self, new_messages):
+        """
+        Point the summary at the newest of the given (already stored) messages
+        and bump the recipients' unread counters.
+        """
+        latest = max(new_messages, key=lambda message: (message.timestamp, message.id))
+        sent_by_user1 = sum(1 for message in new_messages if message.user_id == self.user1_id)
+        sent_by_user2 = len(new_messages) - sent_by_user1
+
+        # concurrent senders may commit out of order, only move the summary forward
+        newer = Q(last_message_timestamp__isnull=True) | Q(last_message_timestamp__lte=latest.timestamp)
+        def if_newer(field, value, output_field):
+            return Case(When(newer, then=Value(value)), default=F(field), output_field=output_field)
+
+        PrivateChat.objects.filter(id=self.id).update(
+            last_message_id=if_newer("last_message_id", latest.id, models.BigIntegerField()),
+            last_message_preview=if_newer("last_message_preview", latest.content[:PREVIEW_LENGTH], models.CharField()),
+            last_message_timestamp=if_newer("last_message_timestamp", latest.timestamp, models.DateTimeField()),
+            user1_unread_count=F("user1_unread_count") + sent_by_user2,
+            user2_unread_count=F("user2_unread_count") + sent_by_user1,
+        )
+
+    def remove_message(self, message):
+        """
+        Delete a message and repair the conversation summary in the same transaction.
+        """
+        with transaction.atomic():
+            chat = PrivateChat.objects.select_for_update().get(id=self.id)
+            recipient = "user2" if message.user_id == chat.user1_id else "user1"
+            recipient_field = f"{recipient}_unread_count"
+            # anything past the recipient's read marker is still unread
+            was_unread = getattr(chat, recipient_field) and message.id > getattr(chat, f"{recipient}_last_read_id")
+
+            was_last = chat.last_message_id == message.id
+            message.delete()
+
+            updates = {}
+            if was_unread:
+                updates[recipient_field] = F(recipient_field) - 1
+            if was_last:
+                latest = chat.messages.order_by("-timestamp", "-id").first()
+                updates.update(
+                    last_message=latest,
+                    last_message_preview=latest.content[:PREVIEW_LENGTH] if latest else "",
+                    last_message_timestamp=latest.timestamp if latest else None,
+                )
+            if updates:
+                PrivateChat.objects.filter(id=chat.id).update(**updates)
+
+    def mark_read(self, user, message_id=None):
+        """
+        Move the read marker of the given participant forward, up to `message_id` or the last message,
+        with a single UPDATE. Returns the new marker, or None if there was nothing new to mark.
+        """
+        prefix = "user1" if user.id == self.user1_id else "user2"
+        marker_field, unread_field = f"{prefix}_last_read_id", f"{prefix}_unread_count"
+        last_message_id = Coalesce(F("last_message_id"), Value(0), output_field=models.BigIntegerField())
+
+        if message_id is None:
+            target = last_message_id
+            unread = Value(0)
+            pending = Q(**{f"{marker_field}__lt": last_message_id}) | Q(**{f"{unread_field}__gt": 0})
+        else:
+            # never past the last message, ids from the socket are not trusted further than that
+            target = Least(Value(message_id), last_message_id, output_field=models.BigIntegerField())
+            unread = Case(
+                When(last_message_id__lte=message_id, then=Value(0)), default=F(unread_field),
+                output_field=models.PositiveIntegerField(),
+            )
+            pending = Q(**{f"{marker_field}__lt": target})
+
+        updated = PrivateChat.objects.filter(pending, id=self.id).update(**{
+            marker_field: Greatest(F(marker_field), target, output_field=models.BigIntegerField()), unread_field: unread,
+        })
+        if not updated:
+            return None
+
+        self.refresh_from_db(fields=[marker_field, unread_field])
+        return getattr(self, marker_field)
+
     def __str__(self):
         return f"{self.user1.username} and {self.user2.username}"
 
@@ -24,23 +199,72 @@ class PrivateChat(models.Model):
 class Message(models.Model):
     content = models.TextField(blank=True)
     image = models.ImageField(upload_to=chat_image_path, blank=True)
+    thumbnail = models.ImageField(upload_to=chat_image_path, blank=True)
+    image_width = models.PositiveIntegerField(null=True, blank=True)
+    image_height = models.PositiveIntegerField(null=True, blank=True)
+    # rendered once on save, see render()
+    content_html = models.TextField(blank=True)
+    has_link = models.BooleanField(default=False)
+    has_mention = models.BooleanField(default=False)
     timestamp = models.DateTimeField(auto_now_add=True)
     chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name="messages")
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # serves every "messages of a chat in order" query, including keyset pagination
+            models.Index(fields=["chat", "timestamp", "id"], name="chat_message_chat_ts_id_idx"),
+        ]
+
+    def render(self):
+        """
+        Pre-render the content to sanitized html and set the flags used by templates,
+        bulk inserts have to call this themselves.
+        """
+        self.content_html = render_content(self.content) if self.content else ""
+        for flag, value in content_flags(self.content).items():
+            setattr(self, flag, value)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "content" in update_fields:
+            self.render()
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "content_html", "has_link", "has_mention"}
+        super().save(*args, **kwargs)
+
     def get_time_diff(self):
         if self.timestamp:
-            now_time = datetime.now(timezone.utc)
-            timediff = now_time - self.timestamp
-
-            if timediff < timedelta(minutes=1):
-                return f"{int(timediff.total_seconds())} seconds ago"
-            elif timediff < timedelta(hours=1):
-                return f"{int(timediff.total_seconds() // 60)} minutes ago"
-            elif timediff < timedelta(days=1):
-                return f"{int(timediff.total_seconds() // 3600)} hours ago"
-            else:
-                return f"{int(timediff.total_seconds() // 86400)} days ago"
+            return time_since(self.timestamp)
 
     def __str__(self):
         return f"{self.user.username}: {self.content[:20]}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    Messages moved out of the hot table by the retention command, only what is needed to read them back.
+    """
+    id = models.BigIntegerField(primary_key=True)  # id the message had in chat_message
+    chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name="archived_messages")
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    content = models.TextField(blank=True)
+    image = models.CharField(max_length=100, blank=True)
+    thumbnail = models.CharField(max_length=100, blank=True)
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "timestamp", "id"], name="chat_archived_chat_ts_id_idx"),
+        ]
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            id=message.id, chat_id=message.chat_id, user_id=message.user_id, content=message.content,
+            image=message.image.name or "", thumbnail=message.thumbnail.name or "", timestamp=message.timestamp,
+        )
+
+    def __str__(self):
+        return f"{self.user_id}: {self.content[:20]}"
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db.models import Q
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_MESSAGE_ID = 2**63 - 1
+
+def encode_cursor(message):
+    """
+    Opaque, url safe (timestamp, id) keyset cursor pointing at a message.
+    """
+    microseconds = (message.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{microseconds}_{message.id}"
+
+def decode_cursor(cursor):
+    """
+    Inverse of encode_cursor(), raises ValueError for malformed cursors.
+    """
+    microseconds, message_id = cursor.split("_")
+    message_id = int(message_id)
+    # a forged id the database could not even compare against
+    if not 0 <= message_id <= MAX_MESSAGE_ID:
+        raise ValueError(f"Message id out of range: {message_id}")
+    try:
+        return EPOCH + timedelta(microseconds=int(microseconds)), message_id
+    except OverflowError as error:
+        raise ValueError(f"Timestamp out of range: {microseconds}") from error
+
+def get_messages_page(chat, cursor=None, limit=None):
+    """
+    Fetch the newest `limit` messages older than `cursor` in chronological order,
+    along with the cursor of the next (older) page or None if this is the oldest.
+    """
+    limit = limit or settings.CHAT_MESSAGES_PAGE_SIZE
+    messages = chat.messages.order_by("-timestamp", "-id")
+
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor)
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+    # one extra row tells whether an older page exists
+    page = list(messages[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+
+    next_cursor = encode_cursor(page[0]) if has_more else None
+    return page, next_cursor
+
+def get_messages_after(chat, message_id, limit=None):
+    """
+    Messages of the chat stored after `message_id`, oldest first, or None if there are more than `limit`.
+    """
+    limit = limit or settings.CHAT_REPLAY_LIMIT
+    # ids only grow, a primary key range scan is cheap for the short gaps of a reconnect
+    page = list(chat.messages.filter(id__gt=message_id).select_related("user").order_by("id")[:limit + 1])
+    return None if len(page) > limit else page
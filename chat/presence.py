@@ -0,0 +1,207 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from django.conf import settings
+
+
+def to_status(online, last_seen):
+    return {
+        "online": online,
+        "last_seen": datetime.fromtimestamp(float(last_seen), tz=timezone.utc) if last_seen else None,
+    }
+
+
+class MemoryPresence:
+    """
+    In-process stand-in for RedisPresence, used in DEBUG where the channel layer lives in memory as well.
+    """
+
+    def __init__(self):
+        # user id -> {channel name: expiry}, connections expire unless heartbeats keep them alive
+        self.connections = {}
+        self.seen = {}
+
+    def live_channels(self, user_id, now):
+        channels = self.connections.get(user_id, {})
+        return [channel for channel, expiry in list(channels.items()) if expiry > now]
+
+    async def connect(self, user_id, channel_name):
+        """
+        Register a connection, returns True if it is the only live one of the user.
+        """
+        now = time.time()
+        first = not self.live_channels(user_id, now)
+        await self.heartbeat(user_id, channel_name)
+        return first
+
+    async def heartbeat(self, user_id, channel_name):
+        now = time.time()
+        self.connections.setdefault(user_id, {})[channel_name] = now + settings.PRESENCE_TTL
+        self.seen[user_id] = now
+
+    async def disconnect(self, user_id, channel_name):
+        """
+        Drop a connection, returns True if the user has no live connections left.
+        """
+        now = time.time()
+        self.connections.get(user_id, {}).pop(channel_name, None)
+        self.seen[user_id] = now
+        return not self.live_channels(user_id, now)
+
+    def lookup(self, user_ids):
+        now = time.time()
+        return {
+            user_id: to_status(bool(self.live_channels(user_id, now)), self.seen.get(user_id)) for user_id in user_ids
+        }
+
+    async def alookup(self, user_ids):
+        return self.lookup(user_ids)
+
+
+class RedisPresence:
+    """
+    Presence kept in Redis, one sorted set of connections per user scored by expiry plus a last-seen hash.
+    """
+
+    SEEN_KEY = "presence:seen"
+
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+        self.async_client = None
+
+    def key(self, user_id):
+        return f"presence:{user_id}"
+
+    def get_client(self):
+        if self.client is None:
+            import redis
+
+            self.client = redis.Redis.from_url(self.url)
+        return self.client
+
+    def get_async_client(self):
+        if self.async_client is None:
+            import redis.asyncio
+
+            self.async_client = redis.asyncio.Redis.from_url(self.url)
+        return self.async_client
+
+    async def connect(self, user_id, channel_name):
+        now = time.time()
+        key = self.key(user_id)
+        async with self.get_async_client().pipeline() as pipe:
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.zcard(key)
+            pipe.zadd(key, {channel_name: now + settings.PRESENCE_TTL})
+            pipe.expire(key, settings.PRESENCE_TTL)
+            pipe.hset(self.SEEN_KEY, user_id, now)
+            _, live, *_ = await pipe.execute()
+        return live == 0
+
+    async def heartbeat(self, user_id, channel_name):
+        now = time.time()
+        key = self.key(user_id)
+        async with self.get_async_client().pipeline() as pipe:
+            pipe.zadd(key, {channel_name: now + settings.PRESENCE_TTL})
+            pipe.expire(key, settings.PRESENCE_TTL)
+            pipe.hset(self.SEEN_KEY, user_id, now)
+            await pipe.execute()
+
+    async def disconnect(self, user_id, channel_name):
+        now = time.time()
+        key = self.key(user_id)
+        async with self.get_async_client().pipeline() as pipe:
+            pipe.zrem(key, channel_name)
+            pipe.zcount(key, now, "+inf")
+            pipe.hset(self.SEEN_KEY, user_id, now)
+            _, live, _ = await pipe.execute()
+        return live == 0
+
+    def build_lookup(self, pipe, user_ids):
+        now = time.time()
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), now, "+inf")
+        pipe.hmget(self.SEEN_KEY, user_ids)
+
+    def parse_lookup(self, user_ids, results):
+        *live, seen = results
+        return {user_id: to_status(count > 0, last_seen) for user_id, count, last_seen in zip(user_ids, live, seen)}
+
+    def lookup(self, user_ids):
+        """
+        Status of many users in a single round trip.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        with self.get_client().pipeline(transaction=False) as pipe:
+            self.build_lookup(pipe, user_ids)
+            return self.parse_lookup(user_ids, pipe.execute())
+
+    async def alookup(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        async with self.get_async_client().pipeline(transaction=False) as pipe:
+            self.build_lookup(pipe, user_ids)
+            return self.parse_lookup(user_ids, await pipe.execute())
+
+
+_presence = None
+
+def get_presence():
+    """
+    The process wide presence backend, Redis when PRESENCE_REDIS_URL is set.
+    """
+    global _presence
+    if _presence is None:
+        _presence = RedisPresence(settings.PRESENCE_REDIS_URL) if settings.PRESENCE_REDIS_URL else MemoryPresence()
+    return _presence
+
+
+class TypingIndicator:
+    """
+    Coalesces typing frames of one connection into a start and a stop broadcast.
+
+    The first keystroke calls `broadcast(True)`, further keystrokes only push the deadline
+    back and `broadcast(False)` follows once none arrived for `timeout` seconds.
+    """
+
+    def __init__(self, broadcast, timeout=None):
+        self.broadcast = broadcast
+        self.timeout = timeout
+        self.deadline = 0
+        self.task = None
+
+    @property
+    def active(self):
+        return self.task is not None
+
+    async def keystroke(self):
+        loop = asyncio.get_running_loop()
+        timeout = settings.CHAT_TYPING_TIMEOUT if self.timeout is None else self.timeout
+        self.deadline = loop.time() + timeout
+        if not self.active:
+            self.task = asyncio.create_task(self.expire())
+            await self.broadcast(True)
+
+    async def expire(self):
+        loop = asyncio.get_running_loop()
+        while (delay := self.deadline - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        self.task = None
+        await self.broadcast(False)
+
+    def reset(self):
+        """
+        Stop without broadcasting, clients clear the indicator when the message arrives.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def stop(self):
+        if self.active:
+            self.reset()
+            await self.broadcast(False)
@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+rate_limit_checks = registry.counter("chat_rate_limit_checks_total", "Actions checked against a rate limit.")
+rate_limit_rejections = registry.counter("chat_rate_limit_rejections_total", "Actions refused by a rate limit.")
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens and regains `rate` per second, every action takes one.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """
+        Take a token, returns 0 on success or the seconds until one is available.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class MemoryRateLimiter:
+    """
+    Buckets kept in this process, every worker enforces the limits on its own.
+    """
+
+    # full buckets are forgotten once this many are tracked, they hold no state worth keeping
+    MAX_BUCKETS = 10_000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        with self.lock:
+            if key not in self.buckets and len(self.buckets) >= self.MAX_BUCKETS:
+                self.prune()
+            bucket = self.buckets.setdefault(key, TokenBucket(rate, burst))
+            bucket.rate, bucket.burst = rate, burst
+            return bucket.take()
+
+    async def atake(self, key, rate, burst):
+        return self.take(key, rate, burst)
+
+    def prune(self):
+        now = time.monotonic()
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if bucket.tokens + (now - bucket.updated) * bucket.rate < bucket.burst
+        }
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisRateLimiter:
+    """
+    Buckets shared by every worker, one Redis hash per bucket updated atomically by a script.
+    """
+
+    # KEYS[1] bucket, ARGV rate, burst; returns 0 or the milliseconds until a token is available.
+    # the clock is Redis' own, workers with skewed clocks would otherwise refill each other's buckets
+    SCRIPT = """
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local time = redis.call("TIME")
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+    local tokens = math.min(burst, (tonumber(state[1]) or burst) + (now - (tonumber(state[2]) or now)) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = math.ceil((1 - tokens) / rate * 1000) end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+    redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000))
+    return wait
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.script = None
+        self.async_script = None
+
+    def key(self, key):
+        return f"ratelimit:{key}"
+
+    def take(self, key, rate, burst):
+        if self.script is None:
+            import redis
+
+            self.script = redis.Redis.from_url(self.url).register_script(self.SCRIPT)
+        return self.script(keys=[self.key(key)], args=[rate, burst]) / 1000
+
+    async def atake(self, key, rate, burst):
+        if self.async_script is None:
+            import redis.asyncio
+
+            self.async_script = redis.asyncio.Redis.from_url(self.url).register_script(self.SCRIPT)
+        return await self.async_script(keys=[self.key(key)], args=[rate, burst]) / 1000
+
+
+_rate_limiter = None
+
+def get_rate_limiter():
+    """
+    The process wide limiter for per-user limits, shared through Redis when RATE_LIMIT_REDIS_URL is set.
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        url = settings.RATE_LIMIT_REDIS_URL
+        _rate_limiter = RedisRateLimiter(url) if url else MemoryRateLimiter()
+    return _rate_limiter
+
+def take_token(scope, bucket):
+    """
+    check_rate() for a bucket owned by the caller, e.g. one per websocket connection.
+    """
+    rate_limit_checks.inc(scope=scope)
+    wait = bucket.take()
+    if wait:
+        rate_limit_rejections.inc(scope=scope)
+    return wait
+
+def check_rate(scope, user):
+    """
+    Take a token from the user's bucket for `scope`, a key of CHAT_RATE_LIMITS.
+    Returns 0 if the action may go ahead or the seconds to wait before retrying.
+    """
+    rate, burst = settings.CHAT_RATE_LIMITS[scope]
+    rate_limit_checks.inc(scope=scope)
+    try:
+        wait = get_rate_limiter().take(f"{scope}:{user.id}", rate, burst)
+    except Exception:
+        # a limiter outage must not take the chat down with it
+        logger.warning("Rate limiter unavailable, allowing %s", scope, exc_info=True)
+        return 0
+    if wait:
+        rate_limit_rejections.inc(scope=scope)
+    return wait
+
+async def acheck_rate(scope, user):
+    rate, burst = settings.CHAT_RATE_LIMITS[scope]
+    rate_limit_checks.inc(scope=scope)
+    try:
+        wait = await get_rate_limiter().atake(f"{scope}:{user.id}", rate, burst)
+    except Exception:
+        logger.warning("Rate limiter unavailable, allowing %s", scope, exc_info=True)
+        return 0
+    if wait:
+        rate_limit_rejections.inc(scope=scope)
+    return wait
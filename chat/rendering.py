@@ -0,0 +1,22 @@
+import re
+from django.utils.html import conditional_escape, format_html
+from django.utils.safestring import mark_safe
+
+# compiled once per process, the capture group makes re.split() keep the urls
+URL_PATTERN = re.compile(r"(https?://[^\s<>\"']+)")
+
+def render_content(content):
+    """
+    Escaped message text with urls turned into links, safe to output as is.
+    """
+    parts = URL_PATTERN.split(content)
+    # split() alternates between plain text and urls
+    html = "".join(
+        format_html('<a href="{}" target="_blank" rel="noopener noreferrer" class="text-white">{}</a>', part, part)
+        if index % 2 else conditional_escape(part)
+        for index, part in enumerate(parts)
+    )
+    return mark_safe(html)
+
+def content_flags(content):
+    return {"has_link": URL_PATTERN.search(content) is not None, "has_mention": "@" in content}
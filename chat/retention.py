@@ -0,0 +1,119 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from .fragments import invalidate_fragments
+from .models import PREVIEW_LENGTH, ArchivedMessage, Message, PrivateChat
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIRECTORIES = ("chat_images", "chat_images/uploads")
+
+def archive_messages(older_than, batch_size=1_000):
+    """
+    Move messages sent before `older_than` into ArchivedMessage, one batch per transaction.
+    Their image files stay in storage and remain referenced by the archived rows, the messages
+    themselves are no longer part of the chat history. Returns how many messages were archived.
+    """
+    archived = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Message.objects.filter(timestamp__lt=older_than).order_by("id")
+                .only("id", "chat_id", "user_id", "content", "image", "thumbnail", "timestamp")[:batch_size]
+            )
+            if not batch:
+                break
+            # ignore_conflicts makes a batch that was archived but not deleted before a crash harmless
+            ArchivedMessage.objects.bulk_create(
+                [ArchivedMessage.from_message(message) for message in batch], ignore_conflicts=True,
+            )
+            Message.objects.filter(id__in=[message.id for message in batch]).delete()
+            repair_summaries({message.chat_id for message in batch})
+        invalidate_fragments([(message.chat_id, message.id, message.timestamp) for message in batch])
+        archived += len(batch)
+    return archived
+
+def repair_summaries(chat_ids):
+    """
+    Point the summary of each chat back at its newest remaining message and recount the unread
+    messages from what is left, like PrivateChat.remove_message() does for a single message.
+    """
+    for chat in PrivateChat.objects.select_for_update().filter(id__in=chat_ids).order_by("id"):
+        latest = chat.messages.order_by("-timestamp", "-id").first()
+        PrivateChat.objects.filter(id=chat.id).update(
+            last_message=latest,
+            last_message_preview=latest.content[:PREVIEW_LENGTH] if latest else "",
+            last_message_timestamp=latest.timestamp if latest else None,
+            # anything past a participant's read marker sent by the other one is still unread
+            user1_unread_count=chat.messages.filter(user_id=chat.user2_id, id__gt=chat.user1_last_read_id).count(),
+            user2_unread_count=chat.messages.filter(user_id=chat.user1_id, id__gt=chat.user2_last_read_id).count(),
+        )
+
+def sweep_orphaned_images(grace=timedelta(days=1), batch_size=500, dry_run=False):
+    """
+    Delete chat image files no message (live or archived) refers to anymore, i.e. images of deleted
+    messages and uploads that were never sent. Files younger than `grace` are kept, an upload may
+    still be waiting for its message. Returns the number of files deleted and the bytes reclaimed.
+    """
+    cutoff = datetime.now(timezone.utc) - grace
+    deleted = reclaimed = 0
+    batch = []
+    for name in list_images():
+        batch.append(name)
+        if len(batch) >= batch_size:
+            count, size = sweep_batch(batch, cutoff, dry_run)
+            deleted, reclaimed, batch = deleted + count, reclaimed + size, []
+    if batch:
+        count, size = sweep_batch(batch, cutoff, dry_run)
+        deleted, reclaimed = deleted + count, reclaimed + size
+    return deleted, reclaimed
+
+def list_images():
+    for directory in IMAGE_DIRECTORIES:
+        try:
+            _, files = default_storage.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for filename in files:
+            yield f"{directory}/{filename}"
+
+def full_image_name(name):
+    # chat_images/<uuid>_thumb.webp belongs to chat_images/<uuid>.webp
+    stem, extension = os.path.splitext(name)
+    return f"{stem.removesuffix('_thumb')}{extension}"
+
+def referenced_names(names):
+    """
+    The subset of `names` used as an image or thumbnail by any message, in one query per table.
+    """
+    candidates = set(names) | {full_image_name(name) for name in names}
+    referenced = set()
+    for model in (Message, ArchivedMessage):
+        for image, thumbnail in model.objects.filter(
+            Q(image__in=candidates) | Q(thumbnail__in=candidates)
+        ).values_list("image", "thumbnail"):
+            referenced.update((image, thumbnail))
+    return {name for name in names if name in referenced or full_image_name(name) in referenced}
+
+def sweep_batch(names, cutoff, dry_run):
+    # raw uploads are never referenced, the pipeline replaces them with variants
+    candidates = [name for name in names if not name.startswith("chat_images/uploads/")]
+    orphans = set(names) - referenced_names(candidates)
+
+    deleted = reclaimed = 0
+    for name in sorted(orphans):
+        try:
+            if default_storage.get_modified_time(name) >= cutoff:
+                continue
+            size = default_storage.size(name)
+            if not dry_run:
+                default_storage.delete(name)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+        reclaimed += size
+        logger.debug("Deleted orphaned image %s (%d bytes)", name, size)
+    return deleted, reclaimed
@@ -1,6 +1,7 @@
 from django.urls import re_path
-from .consumers import Chat
+from .consumers import Chat, UserChat
 
 websocket_urlpatterns = [
+    re_path(r"^ws/chat/$", UserChat.as_asgi()),
     re_path(r"^ws/chat/(?P<username>\w+)/(?P<other_username>\w+)/$", Chat.as_asgi()),
 ]
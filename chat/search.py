@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from .models import Message
+
+# text search configuration of the postgres index, "simple" does no stemming so it works for any language
+SEARCH_CONFIG = "simple"
+# sqlite fts5 table mirroring Message.content, kept in sync by triggers (see migration 0008)
+FTS_TABLE = "chat_message_fts"
+# deeper pages cost a huge offset scan, and a page number the database cannot hold fails the query
+MAX_PAGE = 1_000
+
+SQLITE_TRIGGERS = {
+    "chat_message_fts_insert": (
+        "AFTER INSERT ON chat_message BEGIN "
+        "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END"
+    ),
+    "chat_message_fts_delete": (
+        "AFTER DELETE ON chat_message BEGIN "
+        "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+    ),
+    "chat_message_fts_update": (
+        "AFTER UPDATE OF content ON chat_message BEGIN "
+        "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END"
+    ),
+}
+
+def repair_sqlite_index(connection):
+    """
+    Restore the fts5 triggers, sqlite drops them whenever a migration rebuilds chat_message.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE 'chat_message_fts%'")
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = set(SQLITE_TRIGGERS) - existing
+        if FTS_TABLE not in existing or not missing:
+            return
+
+        for name in missing:
+            cursor.execute(f"CREATE TRIGGER {name} {SQLITE_TRIGGERS[name]}")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+def search_messages(user, query, page=1, limit=None):
+    """
+    Messages of the user's chats matching `query`, best match first.
+    Returns a page of messages and whether there is a next one.
+    """
+    limit = limit or settings.CHAT_SEARCH_PAGE_SIZE
+    terms = query.split()
+    if not terms:
+        return [], False
+
+    # one extra row tells whether there is a next page
+    offset = (page - 1) * limit
+    if connection.vendor == "postgresql":
+        ids = postgres_search(user, " ".join(terms), offset, limit + 1)
+    elif connection.vendor == "sqlite":
+        ids = sqlite_search(user, terms, offset, limit + 1)
+    else:
+        ids = fallback_search(user, terms, offset, limit + 1)
+
+    messages = Message.objects.select_related("chat__user1", "chat__user2", "user").in_bulk(ids[:limit])
+    return [messages[message_id] for message_id in ids[:limit] if message_id in messages], len(ids) > limit
+
+def user_messages(user):
+    return Message.objects.filter(Q(chat__user1=user) | Q(chat__user2=user))
+
+def postgres_search(user, query, offset, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+    from django.db.models.expressions import RawSQL
+
+    # must match the expression of the chat_message_search_idx GIN index to use it
+    vector = RawSQL(
+        f"to_tsvector('{SEARCH_CONFIG}'::regconfig, {Message._meta.db_table}.content)", [],
+        output_field=SearchVectorField(),
+    )
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type="plain")
+    return list(
+        user_messages(user)
+        .annotate(search=vector, rank=SearchRank(vector, search_query))
+        .filter(search=search_query)
+        .order_by("-rank", "-id")
+        .values_list("id", flat=True)[offset:offset + limit]
+    )
+
+def sqlite_search(user, terms, offset, limit):
+    # every term as a quoted string, fts5 query syntax in user input must not reach MATCH
+    match = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT message.id FROM {FTS_TABLE}
+            JOIN chat_message message ON message.id = {FTS_TABLE}.rowid
+            JOIN chat_privatechat chat ON chat.id = message.chat_id
+            WHERE {FTS_TABLE} MATCH %s AND (chat.user1_id = %s OR chat.user2_id = %s)
+            ORDER BY bm25({FTS_TABLE}), message.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [match, user.id, user.id, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+def fallback_search(user, terms, offset, limit):
+    # unindexed scan for other backends, newest first
+    messages = user_messages(user)
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    return list(messages.order_by("-id").values_list("id", flat=True)[offset:offset + limit])
@@ -0,0 +1,24 @@
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from .metrics import record_query
+from .models import PrivateChat
+from .search import repair_sqlite_index
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+@receiver(post_migrate)
+def repair_search_index(sender, using, **kwargs):
+    if sender.name == "chat" and connections[using].vendor == "sqlite":
+        repair_sqlite_index(connections[using])
+
+@receiver(post_save, sender=PrivateChat)
+@receiver(post_delete, sender=PrivateChat)
+def invalidate_chat_pair(sender, instance, created=True, **kwargs):
+    if created:
+        cache.delete(PrivateChat.pair_key(instance.user1_id, instance.user2_id))
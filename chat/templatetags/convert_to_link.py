@@ -1,16 +1,11 @@
-import re
 from django import template
-from django.utils.html import format_html
+from ..rendering import render_content
 
 register = template.Library()
 
 @register.filter
 def convert_to_link(value):
     """
-    Convert text urls to clickable links.
+    Convert text urls to clickable links, for messages stored before content_html existed.
     """
-    url_pattern = re.compile(r"((http|https)://[^\s]+)")
-    return url_pattern.sub(lambda match: format_html(
-        '<a href="{}" target="_blank" rel="noopener noreferrer" class="text-white">{}</a>', match.group(0), match.group(0)),
-        value,
-    )
+    return render_content(value)
@@ -0,0 +1,86 @@
+import asyncio
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from channels.db import database_sync_to_async
+from ..buffer import MessageBuffer
+from ..models import PrivateChat, Message
+
+
+class MessageBufferTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+
+    def make_message(self, content):
+        return Message(chat=self.chat, user=self.user1, content=content)
+
+    async def test_flush_when_batch_is_full(self):
+        buffer = MessageBuffer(max_size=3, max_delay=60)
+        futures = [await buffer.add(self.make_message(f"Message {i}")) for i in range(3)]
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 3)
+
+        await database_sync_to_async(self.chat.refresh_from_db)()
+        self.assertEqual(self.chat.last_message_preview, "Message 2")
+        self.assertEqual(self.chat.user2_unread_count, 3)
+
+    async def test_flush_after_delay(self):
+        buffer = MessageBuffer(max_size=100, max_delay=0.01)
+        future = await buffer.add(self.make_message("Hello"))
+        self.assertFalse(future.done())
+
+        message = await asyncio.wait_for(future, timeout=5)
+        self.assertIsNotNone(message.id)
+        self.assertTrue(await database_sync_to_async(Message.objects.filter(content="Hello").exists)())
+        # bulk inserts skip save(), the buffer renders the content itself
+        self.assertEqual(message.content_html, "Hello")
+
+    async def test_failed_flush_is_reported_to_waiters(self):
+        buffer = MessageBuffer(max_size=1, max_delay=60)
+        message = self.make_message("Hello")
+        message.user_id = 9999  # violates the foreign key
+        with self.assertLogs("chat.buffer", level="ERROR"):
+            future = await buffer.add(message)
+        with self.assertRaises(Exception):
+            await future
+
+    async def test_failed_rows_do_not_fail_the_batch(self):
+        user3 = await database_sync_to_async(User.objects.create_user)(username="user3", password="Str0ng_p@ssword")
+        deleted_chat = await database_sync_to_async(PrivateChat.objects.create)(user1=self.user1, user2=user3)
+        await database_sync_to_async(PrivateChat.objects.filter(id=deleted_chat.id).delete)()
+
+        buffer = MessageBuffer(max_size=100, max_delay=60)
+        valid = await buffer.add(self.make_message("Valid"))
+        orphan = await buffer.add(Message(chat=deleted_chat, user=self.user1, content="Orphan"))
+        other = await buffer.add(self.make_message("Also valid"))
+        with self.assertLogs("chat.buffer", level="ERROR"):
+            await buffer.flush()
+
+        self.assertEqual((await valid).content, "Valid")
+        self.assertEqual((await other).content, "Also valid")
+        with self.assertRaises(Exception):
+            await orphan
+        contents = await database_sync_to_async(lambda: set(Message.objects.values_list("content", flat=True)))()
+        self.assertEqual(contents, {"Valid", "Also valid"})
+        await database_sync_to_async(self.chat.refresh_from_db)()
+        self.assertEqual(self.chat.user2_unread_count, 2)
+
+    async def test_flush_skips_cancelled_waiters(self):
+        buffer = MessageBuffer(max_size=100, max_delay=60)
+        cancelled = await buffer.add(self.make_message("Cancelled"))
+        waiting = await buffer.add(self.make_message("Waiting"))
+        cancelled.cancel()
+
+        await buffer.flush()
+        self.assertEqual((await waiting).content, "Waiting")
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+
+    def test_flush_sync_writes_pending_messages(self):
+        buffer = MessageBuffer(max_size=100, max_delay=60)
+        buffer.pending.append((self.make_message("Pending"), None))
+        buffer.flush_sync()
+        self.assertTrue(Message.objects.filter(content="Pending").exists())
+        self.assertEqual(buffer.pending, [])
@@ -0,0 +1,157 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import TransactionTestCase
+from ..models import PrivateChat, Message
+
+
+class BenchmarkChatQueriesCommandTests(TransactionTestCase):
+
+    def test_benchmark_reports_plans_in_test_database(self):
+        out = StringIO()
+        creation = connection.creation
+        with mock.patch.object(creation, "create_test_db", wraps=creation.create_test_db) as create, \
+                mock.patch.object(creation, "destroy_test_db", wraps=creation.destroy_test_db) as destroy:
+            call_command("benchmark_chat_queries", messages=100, chats=3, runs=1, database="default", stdout=out)
+
+        output = out.getvalue()
+        self.assertIn("Without indexes", output)
+        self.assertIn("With indexes", output)
+        self.assertIn("chat_message_chat_ts_id_idx", output)
+        create.assert_called_once()
+        destroy.assert_called_once()
+
+    def test_indexes_restored_after_benchmark(self):
+        call_command("benchmark_chat_queries", messages=10, chats=1, runs=1, database="default", stdout=StringIO())
+
+        user1 = User.objects.create(username="user1")
+        user2 = User.objects.create(username="user2")
+        PrivateChat.objects.create(user1=user1, user2=user2)
+        with self.assertRaises(IntegrityError):
+            PrivateChat.objects.create(user1=user1, user2=user2)
+
+    def test_benchmark_refuses_default_database_without_debug(self):
+        with self.assertRaisesMessage(CommandError, "DEBUG off"):
+            call_command("benchmark_chat_queries", messages=10, chats=1, runs=1, stdout=StringIO())
+        self.assertFalse(User.objects.exists())
+
+
+class LoadtestChatCommandTests(TransactionTestCase):
+
+    def test_loadtest_reports_json_in_test_database(self):
+        out = StringIO()
+        creation = connection.creation
+        with mock.patch.object(creation, "create_test_db", wraps=creation.create_test_db) as create, \
+                mock.patch.object(creation, "destroy_test_db", wraps=creation.destroy_test_db) as destroy:
+            call_command("loadtest_chat", conversations=2, messages=3, rate=100, database="default", stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["messages_sent"], 6)
+        self.assertEqual(report["messages_delivered"], 6)
+        self.assertEqual(report["errors"], 0)
+        self.assertIsNotNone(report["latency_ms"]["p99"])
+        self.assertGreater(report["queries_per_message"], 0)
+        create.assert_called_once()
+        destroy.assert_called_once()
+
+    def test_loadtest_refuses_default_database_without_debug(self):
+        with self.assertRaisesMessage(CommandError, "DEBUG off"):
+            call_command("loadtest_chat", conversations=1, messages=1, stdout=StringIO())
+        self.assertFalse(User.objects.exists())
+
+
+class RenderMessagesCommandTests(TransactionTestCase):
+
+    def test_backfills_unrendered_messages(self):
+        user1 = User.objects.create(username="user1")
+        user2 = User.objects.create(username="user2")
+        chat = PrivateChat.objects.create(user1=user1, user2=user2)
+        message = chat.add_message(user1, "hi @user2 https://example.com")
+        Message.objects.filter(id=message.id).update(content_html="", has_link=False, has_mention=False)
+        chat.add_message(user1, "")
+
+        out = StringIO()
+        call_command("render_messages", batch_size=1, stdout=out)
+
+        message.refresh_from_db()
+        self.assertIn('<a href="https://example.com"', message.content_html)
+        self.assertTrue(message.has_link)
+        self.assertTrue(message.has_mention)
+        self.assertIn("Rendered 1 messages.", out.getvalue())
+
+
+class TransferChatsCommandTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username="user1")
+        self.user2 = User.objects.create(username="user2")
+        self.user3 = User.objects.create(username="user3")
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        for i in range(5):
+            chat.add_message(self.user1 if i % 2 else self.user2, f"message {i} https://example.com")
+        other = PrivateChat.objects.create(user1=self.user2, user2=self.user3)
+        other.add_message(self.user3, "not exported")
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def export_and_wipe(self, filename):
+        path = os.path.join(self.directory.name, filename)
+        err = StringIO()
+        call_command("export_chats", path, user="user1", chunk_size=2, stderr=err)
+        self.assertIn("Exported 6 records.", err.getvalue())
+        self.exported = list(
+            Message.objects.filter(chat__user1=self.user1).order_by("id").values_list("content", "timestamp", "user__username")
+        )
+        Message.objects.all().delete()
+        PrivateChat.objects.all().delete()
+        User.objects.exclude(username="user2").delete()
+        return path
+
+    def assert_imported(self):
+        chat = PrivateChat.objects.get()
+        # user1 is recreated, user2 kept its row
+        self.assertEqual({chat.user1.username, chat.user2.username}, {"user1", "user2"})
+        self.assertFalse(User.objects.get(username="user1").has_usable_password())
+        imported = list(chat.messages.order_by("id").values_list("content", "timestamp", "user__username"))
+        self.assertEqual(imported, self.exported)
+        self.assertTrue(all(message.has_link for message in chat.messages.all()))
+        self.assertEqual(chat.last_message_preview, "message 4 https://example.com")
+        self.assertEqual((chat.user1_unread_count, chat.user2_unread_count), (0, 0))
+        self.assertEqual(chat.user1_last_read_id, chat.last_message_id)
+
+    def test_jsonl_round_trip(self):
+        path = self.export_and_wipe("chats.jsonl")
+        out = StringIO()
+        call_command("import_chats", path, batch_size=2, stdout=out)
+
+        self.assertIn("Imported 5 messages into 1 chats.", out.getvalue())
+        self.assert_imported()
+
+    def test_msgpack_round_trip(self):
+        path = self.export_and_wipe("chats.msgpack")
+        with open(path, "rb") as file:
+            self.assertNotEqual(file.read(1), b"{")
+        call_command("import_chats", path, stdout=StringIO())
+
+        self.assert_imported()
+
+    def test_resumes_from_checkpoint(self):
+        path = self.export_and_wipe("chats.jsonl")
+        checkpoint = os.path.join(self.directory.name, "checkpoint.json")
+        with open(checkpoint, "w") as file:
+            json.dump({"messages": 3}, file)
+
+        out = StringIO()
+        call_command("import_chats", path, checkpoint=checkpoint, stdout=out)
+
+        self.assertIn("Resuming after 3 messages.", out.getvalue())
+        self.assertIn("Imported 2 messages into 1 chats.", out.getvalue())
+        self.assertEqual(list(Message.objects.order_by("id").values_list("content", flat=True)), [
+            "message 3 https://example.com", "message 4 https://example.com",
+        ])
+        self.assertFalse(os.path.exists(checkpoint))
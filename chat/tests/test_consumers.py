@@ -1,5 +1,8 @@
+import asyncio
+import json
 import os
-from django.test import TransactionTestCase
+import msgpack
+from django.test import Client, SimpleTestCase, TransactionTestCase, override_settings
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.contrib.auth.models import User
@@ -7,7 +10,8 @@ from channels.auth import AuthMiddlewareStack
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
 import chat.routing
-from ..consumers import Chat
+from ..consumers import MSGPACK_PROTOCOL, OUTBOX_OVERFLOW_CLOSE_CODE, PROTOCOL_VERSION, Chat, UserChat, outbox_frames
+from ..metrics import handler_pool_wait, handler_queries
 from ..models import PrivateChat, Message
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
@@ -31,6 +35,12 @@ class ChatTests(TransactionTestCase):
 
         self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
 
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+        self.session_headers = [(b"cookie", f"sessionid={self.client.cookies['sessionid'].value}".encode())]
+
+    def make_communicator(self, path="/ws/chat/user1/user2/", headers=None):
+        return WebsocketCommunicator(application, path, headers=self.session_headers if headers is None else headers)
+
     async def connect_communicator(self, communicator):
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
@@ -39,12 +49,42 @@ class ChatTests(TransactionTestCase):
         await communicator.disconnect()
 
     async def test_connect_and_disconnect(self):
-        communicator = WebsocketCommunicator(application, f"/ws/chat/user1/user2/")
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+        await self.disconnect_communicator(communicator)
+
+    async def test_connect_rejected_for_anonymous_user(self):
+        communicator = self.make_communicator(headers=[])
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_connect_rejected_for_other_users_chat(self):
+        communicator = self.make_communicator("/ws/chat/user2/user1/")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_connect_rejected_for_unknown_user(self):
+        communicator = self.make_communicator("/ws/chat/user1/nobody/")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_sender_comes_from_session(self):
+        communicator = self.make_communicator()
         await self.connect_communicator(communicator)
+
+        await communicator.send_json_to({"message": "spoofed", "username": "user2"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["username"], "user1")
+
+        saved_message = await database_sync_to_async(Message.objects.filter)(
+            chat=self.chat, user=self.user1, content="spoofed"
+        )
+        self.assertTrue(await database_sync_to_async(saved_message.exists)())
+
         await self.disconnect_communicator(communicator)
 
     async def test_receive_message(self):
-        communicator = WebsocketCommunicator(application, f"/ws/chat/user1/user2/")
+        communicator = self.make_communicator()
         await self.connect_communicator(communicator)
 
         message = {"message": "test message", "username": "user1"}
@@ -58,7 +98,7 @@ class ChatTests(TransactionTestCase):
         await self.disconnect_communicator(communicator)
 
     async def test_receive_and_save_image(self):
-        communicator = WebsocketCommunicator(application, f"/ws/chat/user1/user2/")
+        communicator = self.make_communicator()
         await self.connect_communicator(communicator)
 
         message = {
@@ -82,8 +122,34 @@ class ChatTests(TransactionTestCase):
 
         await self.disconnect_communicator(communicator)
 
+    async def test_receive_image_references_thumbnail(self):
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+
+        await communicator.send_json_to({"image_name": "chat_images/photo.webp", "image_width": 800, "image_height": 600})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["image_url"], "/media/chat_images/photo.webp")
+        self.assertEqual(response["thumbnail_url"], "/media/chat_images/photo_thumb.webp")
+        self.assertEqual((response["image_width"], response["image_height"]), (800, 600))
+
+        saved_message = await database_sync_to_async(Message.objects.get)(chat=self.chat, image="chat_images/photo.webp")
+        self.assertEqual(saved_message.thumbnail.name, "chat_images/photo_thumb.webp")
+        self.assertEqual(saved_message.image_width, 800)
+
+        await self.disconnect_communicator(communicator)
+
+    async def test_receive_ignores_foreign_image_names(self):
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+
+        await communicator.send_json_to({"message": "hi", "image_name": "../settings.py"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["image_url"], "")
+
+        await self.disconnect_communicator(communicator)
+
     async def test_save_message_to_database(self):
-        communicator = WebsocketCommunicator(application, f"/ws/chat/user1/user2/")
+        communicator = self.make_communicator()
         await self.connect_communicator(communicator)
 
         message = {"message": "test message", "username": "user1"}
@@ -98,6 +164,165 @@ class ChatTests(TransactionTestCase):
 
         await self.disconnect_communicator(communicator)
 
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_DELAY=0.01)
+    async def test_write_behind_saves_message_before_ack(self):
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+
+        await communicator.send_json_to({"message": "buffered"})
+        await communicator.receive_json_from()
+
+        saved_message = await database_sync_to_async(Message.objects.filter)(chat=self.chat, content="buffered")
+        self.assertTrue(await database_sync_to_async(saved_message.exists)())
+
+        await self.disconnect_communicator(communicator)
+
+    @override_settings(CHAT_BROADCAST_BEFORE_PERSIST=True)
+    async def test_broadcast_before_persist_reports_status(self):
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+
+        await communicator.send_json_to({"message": "fast"})
+        message = await communicator.receive_json_from()
+        status = await communicator.receive_json_from()
+
+        self.assertEqual(message["message"], "fast")
+        self.assertEqual(status["type"], "status")
+        self.assertEqual(status["status"], "persisted")
+        self.assertEqual(status["client_id"], message["client_id"])
+
+        saved_message = await database_sync_to_async(Message.objects.get)(content="fast")
+        self.assertEqual(status["message_id"], saved_message.id)
+
+        await self.disconnect_communicator(communicator)
+
+    @override_settings(CHAT_BROADCAST_BEFORE_PERSIST=True)
+    async def test_broadcast_before_persist_reports_failure(self):
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+        await database_sync_to_async(PrivateChat.objects.filter(id=self.chat.id).delete)()
+
+        with self.assertLogs("chat.consumers", level="ERROR"):
+            await communicator.send_json_to({"message": "lost"})
+            message = await communicator.receive_json_from()
+            status = await communicator.receive_json_from()
+
+        self.assertEqual(message["message"], "lost")
+        self.assertEqual(status["status"], "failed")
+
+        await self.disconnect_communicator(communicator)
+
+    async def test_receive_is_instrumented(self):
+        labels = (("event", "websocket.receive"), ("kind", "websocket"), ("route", "Chat"))
+        queries_before = handler_queries.values.get(labels, 0)
+
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+        await communicator.send_json_to({"message": "measured"})
+        await communicator.receive_json_from()
+        await self.disconnect_communicator(communicator)
+
+        self.assertGreater(handler_queries.values[labels], queries_before)
+        self.assertIn(labels, handler_pool_wait.values)
+
+    def other_session_headers(self):
+        client = Client()
+        client.login(username="user2", password="Str0ng_p@ssword")
+        return [(b"cookie", f"sessionid={client.cookies['sessionid'].value}".encode())]
+
+    async def test_message_sent_pre_rendered(self):
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+
+        await communicator.send_json_to({"message": "<i>@user2</i> https://example.com"})
+        response = await communicator.receive_json_from()
+        self.assertTrue(response["message_html"].startswith("&lt;i&gt;@user2&lt;/i&gt; <a href="))
+        self.assertTrue(response["has_mention"])
+
+        await self.disconnect_communicator(communicator)
+
+    async def test_presence_broadcast_to_room(self):
+        headers = await database_sync_to_async(self.other_session_headers)()
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+
+        other = self.make_communicator("/ws/chat/user2/user1/", headers=headers)
+        await self.connect_communicator(other)
+        presence = await communicator.receive_json_from()
+        self.assertEqual(presence["type"], "presence")
+        self.assertEqual(presence["username"], "user2")
+        self.assertTrue(presence["online"])
+
+        await self.disconnect_communicator(other)
+        presence = await communicator.receive_json_from()
+        self.assertFalse(presence["online"])
+
+        await self.disconnect_communicator(communicator)
+
+    async def test_presence_broadcast_only_when_user_comes_online(self):
+        headers = await database_sync_to_async(self.other_session_headers)()
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+        first = self.make_communicator("/ws/chat/user2/user1/", headers=headers)
+        await self.connect_communicator(first)
+        self.assertTrue((await communicator.receive_json_from())["online"])
+
+        # a second tab of an online user changes nothing
+        second = self.make_communicator("/ws/chat/user2/user1/", headers=headers)
+        await self.connect_communicator(second)
+        await self.disconnect_communicator(second)
+        self.assertTrue(await communicator.receive_nothing())
+
+        await self.disconnect_communicator(first)
+        self.assertFalse((await communicator.receive_json_from())["online"])
+        await self.disconnect_communicator(communicator)
+
+    @override_settings(CHAT_TYPING_TIMEOUT=0.1)
+    async def test_typing_frames_are_coalesced(self):
+        headers = await database_sync_to_async(self.other_session_headers)()
+        other = self.make_communicator("/ws/chat/user2/user1/", headers=headers)
+        await self.connect_communicator(other)
+        communicator = self.make_communicator()
+        await self.connect_communicator(communicator)
+        await other.receive_json_from()  # presence
+
+        for _ in range(5):
+            await communicator.send_json_to({"type": "typing"})
+        started = await other.receive_json_from()
+        stopped = await other.receive_json_from()
+        self.assertEqual((started["type"], started["typing"]), ("typing", True))
+        self.assertEqual((stopped["type"], stopped["typing"]), ("typing", False))
+        self.assertTrue(await other.receive_nothing())
+
+        # typing frames are never echoed back to the sender
+        self.assertTrue(await communicator.receive_nothing())
+
+        await self.disconnect_communicator(communicator)
+        await self.disconnect_communicator(other)
+
+    async def test_reconnect_replays_messages_after_last_id(self):
+        seen = await database_sync_to_async(self.chat.add_message)(self.user2, "seen")
+        missed = await database_sync_to_async(self.chat.add_message)(self.user2, "missed")
+
+        communicator = self.make_communicator(f"/ws/chat/user1/user2/?last_id={seen.id}")
+        await self.connect_communicator(communicator)
+        replayed = await communicator.receive_json_from()
+        self.assertEqual((replayed["message_id"], replayed["message"]), (missed.id, "missed"))
+        self.assertTrue(await communicator.receive_nothing())
+
+        await self.disconnect_communicator(communicator)
+
+    async def test_connect_ignores_invalid_last_id(self):
+        await database_sync_to_async(self.chat.add_message)(self.user2, "seen")
+
+        # "²" passes str.isdigit() but is not a number
+        for last_id in ("abc", "%C2%B2"):
+            communicator = self.make_communicator(f"/ws/chat/user1/user2/?last_id={last_id}")
+            with self.assertLogs("chat.consumers", level="WARNING"):
+                await self.connect_communicator(communicator)
+            self.assertTrue(await communicator.receive_nothing())
+            await self.disconnect_communicator(communicator)
+
     async def test_create_group_name(self):
         consumer = Chat(scope={"type": "websocket"})
         group_name = consumer.create_group_name("user1", "user2")
@@ -106,3 +331,353 @@ class ChatTests(TransactionTestCase):
         # reversed usernames
         group_name_reverse = consumer.create_group_name("user2", "user1")
         self.assertEqual(group_name_reverse, "user1_user2")
+
+
+class UserChatTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+
+    def session_headers(self, username):
+        client = Client()
+        client.login(username=username, password="Str0ng_p@ssword")
+        return [(b"cookie", f"sessionid={client.cookies['sessionid'].value}".encode())]
+
+    async def connect(self, username):
+        headers = await database_sync_to_async(self.session_headers)(username)
+        communicator = WebsocketCommunicator(application, "/ws/chat/", headers=headers)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_connect_rejected_for_anonymous_user(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_subscribe_and_send(self):
+        communicator = await self.connect("user1")
+        await communicator.send_json_to({"type": "subscribe", "chat": "user2"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "subscribed", "chat": "user2"})
+
+        await communicator.send_json_to({"chat": "user2", "message": "multiplexed"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["chat"], "user2")
+        self.assertEqual(response["username"], "user1")
+        self.assertEqual(response["message"], "multiplexed")
+
+        saved_message = await database_sync_to_async(Message.objects.get)(content="multiplexed")
+        self.assertEqual(saved_message.chat_id, self.chat.id)
+
+        await communicator.disconnect()
+
+    async def test_message_requires_subscription(self):
+        communicator = await self.connect("user1")
+        await communicator.send_json_to({"chat": "user2", "message": "nope"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "error")
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+
+        await communicator.send_json_to({"type": "subscribe", "chat": "user1"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["error"], "Unknown user.")
+
+        await communicator.disconnect()
+
+    async def test_conversation_update_pushed_to_both_participants(self):
+        sender = await self.connect("user1")
+        recipient = await self.connect("user2")
+        await sender.send_json_to({"type": "subscribe", "chat": "user2"})
+        await sender.receive_json_from()
+
+        await sender.send_json_to({"chat": "user2", "message": "ping"})
+        update = await recipient.receive_json_from()
+        self.assertEqual(update["type"], "conversation_updated")
+        self.assertEqual(update["chat"], "user1")
+        self.assertEqual(update["preview"], "ping")
+        self.assertTrue(update["unread"])
+        self.assertIsNotNone(update["message_id"])
+
+        # the sender's own inbox moves the conversation up as well, after the message itself
+        await sender.receive_json_from()
+        update = await sender.receive_json_from()
+        self.assertEqual(update["type"], "conversation_updated")
+        self.assertEqual(update["chat"], "user2")
+        self.assertFalse(update["unread"])
+
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_read_receipt_broadcast_to_room(self):
+        message = await database_sync_to_async(self.chat.add_message)(self.user2, "Hello")
+        sender = await self.connect("user2")
+        reader = await self.connect("user1")
+        for communicator, username in ((sender, "user1"), (reader, "user2")):
+            await communicator.send_json_to({"type": "subscribe", "chat": username})
+            await communicator.receive_json_from()
+        await sender.receive_json_from()  # presence of the reader
+
+        await reader.send_json_to({"type": "read", "chat": "user2", "message_id": message.id})
+        receipt = await sender.receive_json_from()
+        self.assertEqual(receipt, {"type": "read", "username": "user1", "message_id": message.id, "chat": "user1"})
+
+        await database_sync_to_async(self.chat.refresh_from_db)()
+        self.assertEqual((self.chat.user1_last_read_id, self.chat.user1_unread_count), (message.id, 0))
+
+        await sender.disconnect()
+        await reader.disconnect()
+
+    async def test_frames_name_their_conversation(self):
+        user3 = await database_sync_to_async(User.objects.create_user)(username="user3", password="Str0ng_p@ssword")
+        communicator = await self.connect("user1")
+        for username in ("user2", "user3"):
+            await communicator.send_json_to({"type": "subscribe", "chat": username})
+            await communicator.receive_json_from()
+
+        await communicator.send_json_to({"chat": "user3", "message": "third"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["chat"], "user3")
+        chat = await database_sync_to_async(PrivateChat.objects.get)(user2=user3)
+        self.assertTrue(await database_sync_to_async(chat.messages.exists)())
+
+        await communicator.disconnect()
+
+    async def test_subscribe_replays_missed_messages(self):
+        seen = await database_sync_to_async(self.chat.add_message)(self.user1, "seen")
+        missed = [await database_sync_to_async(self.chat.add_message)(self.user2, f"missed {i}") for i in range(2)]
+        communicator = await self.connect("user1")
+
+        await communicator.send_json_to({"type": "subscribe", "chat": "user2", "last_id": seen.id})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "subscribed", "chat": "user2"})
+        for message in missed:
+            replayed = await communicator.receive_json_from()
+            self.assertEqual(replayed["message_id"], message.id)
+            self.assertEqual(replayed["message"], message.content)
+            self.assertEqual(replayed["username"], "user2")
+            self.assertEqual(replayed["chat"], "user2")
+            self.assertTrue(replayed["replayed"])
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    @override_settings(CHAT_REPLAY_LIMIT=2)
+    async def test_large_gaps_ask_for_resync(self):
+        for i in range(3):
+            await database_sync_to_async(self.chat.add_message)(self.user2, f"missed {i}")
+        communicator = await self.connect("user1")
+
+        await communicator.send_json_to({"type": "subscribe", "chat": "user2", "last_id": 0})
+        await communicator.receive_json_from()
+        self.assertEqual(await communicator.receive_json_from(), {"type": "resync", "chat": "user2"})
+
+        await communicator.disconnect()
+
+
+class MsgpackProtocolTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+
+    async def connect(self, username, subprotocols=None):
+        def session_headers():
+            client = Client()
+            client.login(username=username, password="Str0ng_p@ssword")
+            return [(b"cookie", f"sessionid={client.cookies['sessionid'].value}".encode())]
+
+        headers = await database_sync_to_async(session_headers)()
+        communicator = WebsocketCommunicator(application, "/ws/chat/", headers=headers, subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def send_frames(self, communicator, *frames, version=PROTOCOL_VERSION):
+        await communicator.send_to(bytes_data=msgpack.packb({"v": version, "frames": list(frames)}))
+
+    async def receive_frames(self, communicator):
+        envelope = msgpack.unpackb(await communicator.receive_from(), raw=False)
+        self.assertEqual(envelope["v"], PROTOCOL_VERSION)
+        return envelope["frames"]
+
+    async def test_negotiated_by_subprotocol(self):
+        communicator, subprotocol = await self.connect("user1", [MSGPACK_PROTOCOL])
+        self.assertEqual(subprotocol, MSGPACK_PROTOCOL)
+
+        await self.send_frames(communicator, {"type": "subscribe", "chat": "user2"})
+        self.assertEqual(await self.receive_frames(communicator), [{"type": "subscribed", "chat": "user2"}])
+        await self.send_frames(communicator, {"chat": "user2", "message": "binary"})
+        frames = await self.receive_frames(communicator)
+        self.assertEqual(frames[0]["message"], "binary")
+        self.assertTrue(await database_sync_to_async(Message.objects.filter(content="binary").exists)())
+
+        await communicator.disconnect()
+
+    async def test_json_clients_unaffected(self):
+        sender, subprotocol = await self.connect("user1", [MSGPACK_PROTOCOL])
+        recipient, json_subprotocol = await self.connect("user2")
+        self.assertEqual(subprotocol, MSGPACK_PROTOCOL)
+        self.assertIsNone(json_subprotocol)
+        await self.send_frames(sender, {"type": "subscribe", "chat": "user2"})
+        await recipient.send_json_to({"type": "subscribe", "chat": "user1"})
+        await recipient.receive_json_from()
+
+        await self.send_frames(sender, {"chat": "user2", "message": "mixed"})
+        frames = []
+        while not any(frame.get("message") == "mixed" for frame in frames):
+            frame = await recipient.receive_json_from()
+            frames.append(frame)
+        self.assertEqual(frames[-1]["chat"], "user1")
+
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_queued_frames_are_batched(self):
+        consumer = UserChat()
+        consumer.protocol = MSGPACK_PROTOCOL
+        consumer.open_outbox()
+        sent = []
+
+        async def slow_send(bytes_data):
+            sent.append(msgpack.unpackb(bytes_data, raw=False))
+            await asyncio.sleep(0.01)
+        consumer.send = slow_send
+
+        await consumer.send_payload({"message": 0})
+        await asyncio.sleep(0)
+        await consumer.send_payload({"message": 1})
+        await consumer.send_payload({"message": 2})
+        await consumer.flusher
+
+        # the first frame goes out at once, the rest queue up behind it and share one
+        self.assertEqual([[frame["message"] for frame in envelope["frames"]] for envelope in sent], [[0], [1, 2]])
+        self.assertTrue(all(envelope["v"] == PROTOCOL_VERSION for envelope in sent))
+
+    async def test_unsupported_versions_are_dropped(self):
+        communicator, _ = await self.connect("user1", [MSGPACK_PROTOCOL])
+        await self.send_frames(communicator, {"type": "subscribe", "chat": "user2"}, version=2)
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    async def test_malformed_envelopes_are_dropped(self):
+        communicator, _ = await self.connect("user1", [MSGPACK_PROTOCOL])
+        malformed = [
+            b"\xc1",  # never used in msgpack
+            msgpack.packb({"v": PROTOCOL_VERSION, "frames": []}) + b"\x01",
+            msgpack.packb([PROTOCOL_VERSION]),
+            msgpack.packb({"v": PROTOCOL_VERSION, "frames": "subscribe"}),
+            msgpack.packb({"v": PROTOCOL_VERSION, "frames": [["subscribe", "user2"]]}),
+        ]
+        for bytes_data in malformed:
+            with self.assertLogs("chat.consumers", level="WARNING"):
+                await communicator.send_to(bytes_data=bytes_data)
+                self.assertTrue(await communicator.receive_nothing())
+
+        # the connection survives and keeps working
+        await self.send_frames(communicator, {"type": "subscribe", "chat": "user2"})
+        self.assertEqual(await self.receive_frames(communicator), [{"type": "subscribed", "chat": "user2"}])
+
+        await communicator.disconnect()
+
+        communicator, _ = await self.connect("user1")
+        malformed = [
+            "{not json",
+            "[1]",
+            json.dumps({"chat": "user2", "image_name": None}),
+            json.dumps({"chat": "user2", "message": ["hello"]}),
+            json.dumps({"type": "subscribe", "chat": {"user": "user2"}}),
+        ]
+        for text_data in malformed:
+            with self.assertLogs("chat.consumers", level="WARNING"):
+                await communicator.send_to(text_data=text_data)
+                self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_json_to({"type": "subscribe", "chat": "user2"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "subscribed", "chat": "user2"})
+
+        await communicator.disconnect()
+
+
+@override_settings(CHAT_OUTBOX_LIMIT=2)
+class OutboxTests(SimpleTestCase):
+
+    def make_consumer(self):
+        consumer = UserChat()
+        consumer.protocol = None
+        consumer.open_outbox()
+        consumer.sent = []
+        consumer.closed = []
+
+        async def send(text_data):
+            consumer.sent.append(json.loads(text_data))
+
+        async def close(code=None):
+            consumer.closed.append(code)
+        consumer.send, consumer.close = send, close
+        return consumer
+
+    def queued(self):
+        return outbox_frames.values.get((), 0)
+
+    async def test_failed_send_closes_the_outbox(self):
+        consumer = self.make_consumer()
+        consumer.channel_name = "test.channel"
+        queued = self.queued()
+
+        async def send(text_data):
+            raise ConnectionResetError("gone")
+        consumer.send = send
+
+        with self.assertLogs("chat.consumers", level="ERROR") as logs:
+            await consumer.send_payload({"message": 0})
+            await consumer.send_payload({"message": 1})
+            with self.assertRaises(ConnectionResetError):
+                await consumer.flusher
+            await asyncio.sleep(0)
+        self.assertIn("ConnectionResetError", logs.output[0])
+
+        self.assertFalse(consumer.outbox_open)
+        self.assertEqual(self.queued(), queued)
+        await consumer.send_payload({"message": 2})
+        self.assertEqual(list(consumer.outbox), [])
+
+    @override_settings(CHAT_OUTBOX_POLICY="drop")
+    async def test_drop_discards_frames_beyond_the_limit(self):
+        consumer = self.make_consumer()
+        queued = self.queued()
+        for i in range(4):
+            await consumer.send_payload({"message": i})
+        self.assertEqual(self.queued(), queued + 2)
+
+        await consumer.flusher
+        self.assertEqual(consumer.sent, [{"message": 0}, {"message": 1}])
+        self.assertEqual(self.queued(), queued)
+
+    @override_settings(CHAT_OUTBOX_POLICY="coalesce")
+    async def test_coalesce_replaces_pending_frames_with_resync(self):
+        consumer = self.make_consumer()
+        await consumer.send_payload({"chat": "user2", "message": 0})
+        await consumer.send_payload({"chat": "user3", "message": 1})
+        await consumer.send_payload({"chat": "user2", "message": 2})
+        await consumer.send_payload({"chat": "user3", "message": 3})
+
+        await consumer.flusher
+        self.assertEqual(consumer.sent, [
+            {"type": "resync", "missed": 2, "chat": "user2"},
+            {"type": "resync", "missed": 2, "chat": "user3"},
+        ])
+
+    @override_settings(CHAT_OUTBOX_POLICY="disconnect")
+    async def test_disconnect_closes_the_socket(self):
+        consumer = self.make_consumer()
+        queued = self.queued()
+        for i in range(3):
+            await consumer.send_payload({"message": i})
+        await consumer.send_payload({"message": "after close"})
+
+        self.assertEqual(consumer.closed, [OUTBOX_OVERFLOW_CLOSE_CODE])
+        self.assertEqual(self.queued(), queued)
+        self.assertEqual(consumer.sent, [])
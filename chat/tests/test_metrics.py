@@ -0,0 +1,63 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from ..metrics import Registry
+
+
+class RegistryTests(TestCase):
+
+    def test_render_counter_with_escaped_labels(self):
+        metrics = Registry()
+        metrics.counter("test_total", "Test counter.").inc(2, route='say "hi"')
+        output = metrics.render()
+        self.assertIn("# TYPE test_total counter", output)
+        self.assertIn('test_total{route="say \\"hi\\""} 2', output)
+
+    def test_render_histogram(self):
+        metrics = Registry()
+        histogram = metrics.histogram("test_seconds", "Test histogram.")
+        histogram.observe(0.02, route="a")
+        histogram.observe(3, route="a")
+        output = metrics.render()
+        self.assertIn('test_seconds_bucket{route="a",le="0.025"} 1', output)
+        self.assertIn('test_seconds_bucket{route="a",le="+Inf"} 2', output)
+        self.assertIn('test_seconds_count{route="a"} 2', output)
+
+
+class MetricsViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="Str0ng_p@ssword")
+        self.url = reverse("metrics")
+
+    def test_forbidden_for_regular_users(self):
+        self.client.login(username="user", password="Str0ng_p@ssword")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_requests_are_recorded(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username="user", password="Str0ng_p@ssword")
+        self.client.get(reverse("chat:chat_list"))
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        output = response.content.decode()
+        self.assertIn('chat_handler_duration_seconds_count{event="GET",kind="http",route="chat:chat_list"}', output)
+        self.assertIn('chat_handler_db_queries_total{event="GET",kind="http",route="chat:chat_list"}', output)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token_authentication(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        for authorization in ("Bearer wrong", "Bearer sécret"):
+            self.assertEqual(self.client.get(self.url, headers={"Authorization": authorization}).status_code, 403)
+        response = self.client.get(self.url, headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("chat_handler_duration_seconds", response.content.decode())
+
+    @override_settings(METRICS_LOG=True)
+    def test_structured_log_lines(self):
+        with self.assertLogs("chat.metrics", level="INFO") as logs:
+            self.client.get(reverse("users:login"))
+        self.assertIn('"route": "users:login"', logs.output[0])
@@ -1,6 +1,8 @@
 import io
 from PIL import Image
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from ..models import PrivateChat, Message
 
@@ -21,6 +23,84 @@ class PrivateChatModelTests(TestCase):
         self.user1.delete()
         self.assertFalse(PrivateChat.objects.filter(id=chat.id).exists())
 
+    def test_add_message_updates_summary(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        message = chat.add_message(self.user1, "Hello World!")
+        chat.refresh_from_db()
+        self.assertEqual(chat.last_message, message)
+        self.assertEqual(chat.last_message_preview, "Hello World!")
+        self.assertEqual(chat.last_message_timestamp, message.timestamp)
+        self.assertEqual(chat.user1_unread_count, 0)
+        self.assertEqual(chat.user2_unread_count, 1)
+
+    def test_remove_message_restores_previous_summary(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        first = chat.add_message(self.user2, "First")
+        second = chat.add_message(self.user2, "Second")
+        chat.remove_message(second)
+        chat.refresh_from_db()
+        self.assertEqual(chat.last_message, first)
+        self.assertEqual(chat.last_message_preview, "First")
+        self.assertEqual(chat.user1_unread_count, 1)
+
+    def test_remove_only_message_clears_summary(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        chat.remove_message(chat.add_message(self.user1, "Only"))
+        chat.refresh_from_db()
+        self.assertIsNone(chat.last_message)
+        self.assertIsNone(chat.last_message_timestamp)
+        self.assertEqual(chat.user2_unread_count, 0)
+
+    def test_mark_read(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        chat.add_message(self.user1, "Hello")
+        chat.mark_read(self.user2)
+        chat.refresh_from_db()
+        self.assertEqual(chat.user2_unread_count, 0)
+
+    def test_between_caches_pair(self):
+        chat = PrivateChat.between(self.user2, self.user1)
+        self.assertEqual((chat.user1, chat.user2), (self.user1, self.user2))
+
+        with self.assertNumQueries(0):
+            stub = PrivateChat.between(self.user1, self.user2, fetch=False)
+        self.assertEqual(stub.id, chat.id)
+
+        chat.delete()
+        self.assertNotEqual(PrivateChat.between(self.user1, self.user2).id, chat.id)
+
+    def test_mark_read_moves_marker(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        first = chat.add_message(self.user1, "First")
+        second = chat.add_message(self.user1, "Second")
+
+        self.assertEqual(chat.mark_read(self.user2, first.id), first.id)
+        self.assertEqual(chat.user2_unread_count, 2)
+        # already read up to there
+        self.assertIsNone(chat.mark_read(self.user2, first.id))
+
+        self.assertEqual(chat.mark_read(self.user2), second.id)
+        self.assertEqual((chat.user2_last_read_id, chat.user2_unread_count), (second.id, 0))
+        self.assertIsNone(chat.mark_read(self.user2))
+
+    def test_mark_read_not_past_last_message(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        message = chat.add_message(self.user1, "Hello")
+        self.assertEqual(chat.mark_read(self.user2, message.id + 100), message.id)
+        self.assertEqual(chat.user2_unread_count, 0)
+
+    def test_remove_read_message_keeps_unread_count(self):
+        chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        read = chat.add_message(self.user1, "Read")
+        chat.mark_read(self.user2)
+        chat.add_message(self.user1, "Unread")
+
+        with CaptureQueriesContext(connection) as queries:
+            chat.remove_message(read)
+        chat.refresh_from_db()
+        self.assertEqual(chat.user2_unread_count, 1)
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries.captured_queries))
+
     def test_cascade_deletion_user2(self):
         chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
         self.user2.delete()
@@ -52,6 +132,23 @@ class MessageModelTests(TestCase):
         self.assertEqual(message.content, "")
         self.assertEqual(message.image, image_data)
 
+    def test_content_rendered_on_save(self):
+        message = Message.objects.create(chat=self.chat, user=self.user1, content="<b>hi</b> @user2 https://example.com/?a=1&b=2")
+        self.assertEqual(
+            message.content_html,
+            '&lt;b&gt;hi&lt;/b&gt; @user2 <a href="https://example.com/?a=1&amp;b=2" target="_blank" '
+            'rel="noopener noreferrer" class="text-white">https://example.com/?a=1&amp;b=2</a>',
+        )
+        self.assertTrue(message.has_link)
+        self.assertTrue(message.has_mention)
+
+        message.content = "plain"
+        message.save(update_fields=["content"])
+        message.refresh_from_db()
+        self.assertEqual(message.content_html, "plain")
+        self.assertFalse(message.has_link)
+        self.assertFalse(message.has_mention)
+
     def test_cascade_deletion_chat(self):
         message = Message.objects.create(chat=self.chat, user=self.user1, content="Goodbye!")
         self.chat.delete()
@@ -0,0 +1,59 @@
+import asyncio
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from ..presence import MemoryPresence, TypingIndicator
+
+
+class MemoryPresenceTests(SimpleTestCase):
+
+    async def test_online_until_last_connection_closes(self):
+        presence = MemoryPresence()
+        self.assertTrue(await presence.connect(1, "a"))
+        self.assertFalse(await presence.connect(1, "b"))
+
+        self.assertFalse(await presence.disconnect(1, "a"))
+        self.assertTrue(await presence.disconnect(1, "b"))
+
+        status = presence.lookup([1, 2])
+        self.assertFalse(status[1]["online"])
+        self.assertIsNotNone(status[1]["last_seen"])
+        self.assertEqual(status[2], {"online": False, "last_seen": None})
+
+    @override_settings(PRESENCE_TTL=60)
+    async def test_connection_expires_without_heartbeat(self):
+        presence = MemoryPresence()
+        await presence.connect(1, "a")
+        self.assertTrue(presence.lookup([1])[1]["online"])
+
+        with mock.patch("chat.presence.time.time", return_value=presence.connections[1]["a"] + 1):
+            self.assertFalse(presence.lookup([1])[1]["online"])
+            self.assertTrue(await presence.connect(1, "b"))
+
+
+class TypingIndicatorTests(SimpleTestCase):
+
+    async def test_keystrokes_are_coalesced(self):
+        broadcasts = []
+
+        async def broadcast(typing):
+            broadcasts.append(typing)
+
+        typing = TypingIndicator(broadcast, timeout=0.05)
+        for _ in range(10):
+            await typing.keystroke()
+        self.assertEqual(broadcasts, [True])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(broadcasts, [True, False])
+
+    async def test_reset_does_not_broadcast(self):
+        broadcasts = []
+
+        async def broadcast(typing):
+            broadcasts.append(typing)
+
+        typing = TypingIndicator(broadcast, timeout=0.05)
+        await typing.keystroke()
+        typing.reset()
+        await asyncio.sleep(0.1)
+        self.assertEqual(broadcasts, [True])
@@ -0,0 +1,126 @@
+from unittest import skipUnless
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from ..metrics import registry
+from ..models import PrivateChat
+from ..ratelimit import RedisRateLimiter, TokenBucket, check_rate, get_rate_limiter
+from .test_consumers import application
+
+try:
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
+
+
+class TokenBucketTests(TestCase):
+
+    def test_refills_at_rate_up_to_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.updated
+
+        self.assertEqual([bucket.take(now) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(now), 0.5)
+        self.assertEqual(bucket.take(now + 0.5), 0)
+        # idle time never banks more than the burst
+        self.assertEqual([bucket.take(now + 60) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(bucket.take(now + 60), 0)
+
+
+
+@skipUnless(fakeredis, "fakeredis[lua] is not installed")
+class RedisRateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.limiter = RedisRateLimiter("redis://localhost")
+        server = fakeredis.FakeServer()
+        self.limiter.script = fakeredis.FakeRedis(server=server).register_script(RedisRateLimiter.SCRIPT)
+        self.limiter.async_script = fakeredis.FakeAsyncRedis(server=server).register_script(RedisRateLimiter.SCRIPT)
+
+    def test_bucket_shared_by_sync_and_async_callers(self):
+        self.assertEqual(self.limiter.take("frame:1", 0.5, 2), 0)
+        self.assertEqual(async_to_sync(self.limiter.atake)("frame:1", 0.5, 2), 0)
+        # empty, one token takes two seconds to come back
+        self.assertGreater(self.limiter.take("frame:1", 0.5, 2), 1.5)
+        self.assertEqual(self.limiter.take("frame:2", 0.5, 2), 0)
+
+    def test_bucket_expires_once_full_again(self):
+        self.limiter.take("frame:1", 1, 2)
+        # refilling two tokens at one per second takes two seconds
+        ttl = self.limiter.script.registered_client.pttl("ratelimit:frame:1")
+        self.assertTrue(1000 < ttl <= 2000)
+
+@override_settings(CHAT_RATE_LIMITS={"upload": (0.001, 2), "create_chat": (0.001, 1)})
+class RateLimitViewTests(TestCase):
+
+    def setUp(self):
+        get_rate_limiter().reset()
+        self.addCleanup(get_rate_limiter().reset)
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+
+    def test_limits_are_per_user(self):
+        self.assertEqual(check_rate("create_chat", self.user1), 0)
+        self.assertGreater(check_rate("create_chat", self.user1), 0)
+        self.assertEqual(check_rate("create_chat", self.user2), 0)
+
+    def test_uploads_are_limited(self):
+        url = reverse("chat:upload_image", args=["user1", "user2"])
+        self.assertEqual(self.client.post(url).status_code, 400)
+        self.assertEqual(self.client.post(url).status_code, 400)
+
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(response.json()["retry_after"], 0)
+        self.assertIn("Retry-After", response)
+
+    def test_create_chat_is_limited(self):
+        rejections = registry.metrics["chat_rate_limit_rejections_total"]
+        rejected = rejections.values.get((("scope", "create_chat"),), 0)
+
+        self.client.post(reverse("chat:create_chat"), {"username": "user2"})
+        response = self.client.post(reverse("chat:create_chat"), {"username": "user2"})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(rejections.values[(("scope", "create_chat"),)], rejected + 1)
+
+
+@override_settings(CHAT_RATE_LIMITS={"connection": (0.001, 2), "frame": (1000, 1000)})
+class RateLimitConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        get_rate_limiter().reset()
+        self.addCleanup(get_rate_limiter().reset)
+        user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        PrivateChat.objects.create(user1=user1, user2=user2)
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+        self.headers = [(b"cookie", f"sessionid={self.client.cookies['sessionid'].value}".encode())]
+
+    async def test_frames_beyond_the_limit_are_refused(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/", headers=self.headers)
+        await communicator.connect()
+        await communicator.send_json_to({"type": "subscribe", "chat": "user2"})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({"chat": "user2", "message": "allowed"})
+        self.assertEqual((await communicator.receive_json_from())["message"], "allowed")
+
+        await communicator.send_json_to({"chat": "user2", "message": "flood"})
+        rejection = await communicator.receive_json_from()
+        self.assertEqual(rejection["type"], "rate_limited")
+        self.assertEqual((rejection["chat"], rejection["frame"], rejection["message"]), ("user2", "message", "flood"))
+        self.assertGreater(rejection["retry_after"], 0)
+
+        # a new connection has its own budget
+        other = WebsocketCommunicator(application, "/ws/chat/", headers=self.headers)
+        await other.connect()
+        await other.send_json_to({"type": "subscribe", "chat": "user2"})
+        self.assertEqual(await other.receive_json_from(), {"type": "subscribed", "chat": "user2"})
+
+        await communicator.disconnect()
+        await other.disconnect()
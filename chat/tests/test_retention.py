@@ -0,0 +1,99 @@
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from ..models import ArchivedMessage, PrivateChat, Message
+from ..retention import archive_messages, sweep_orphaned_images
+
+
+class ArchiveMessagesTests(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username="user1")
+        self.user2 = User.objects.create(username="user2")
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+
+    def test_moves_old_messages_to_archive(self):
+        old = self.chat.add_message(self.user1, "old", image="chat_images/old.webp")
+        Message.objects.filter(id=old.id).update(timestamp=datetime.now(timezone.utc) - timedelta(days=400))
+        recent = self.chat.add_message(self.user2, "recent")
+
+        archived = archive_messages(datetime.now(timezone.utc) - timedelta(days=365), batch_size=1)
+
+        self.assertEqual(archived, 1)
+        self.assertEqual(list(Message.objects.values_list("id", flat=True)), [recent.id])
+        archive = ArchivedMessage.objects.get()
+        self.assertEqual((archive.id, archive.content, archive.image), (old.id, "old", "chat_images/old.webp"))
+        self.assertEqual(archive.chat, self.chat)
+
+        # the unread old message no longer counts, the summary still shows the recent one
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.user1_unread_count, self.chat.user2_unread_count), (1, 0))
+        self.assertEqual(self.chat.last_message_id, recent.id)
+
+    def test_repairs_summary_of_fully_archived_chat(self):
+        for content in ("first", "second"):
+            message = self.chat.add_message(self.user1, content)
+            Message.objects.filter(id=message.id).update(timestamp=datetime.now(timezone.utc) - timedelta(days=400))
+
+        archive_messages(datetime.now(timezone.utc) - timedelta(days=365))
+
+        self.chat.refresh_from_db()
+        self.assertIsNone(self.chat.last_message)
+        self.assertEqual((self.chat.last_message_preview, self.chat.last_message_timestamp), ("", None))
+        self.assertEqual(self.chat.user2_unread_count, 0)
+
+
+class SweepOrphanedImagesTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        user1 = User.objects.create(username="user1")
+        user2 = User.objects.create(username="user2")
+        self.chat = PrivateChat.objects.create(user1=user1, user2=user2)
+        self.user = user1
+
+    def store(self, name, size=10, age=timedelta(days=2)):
+        name = default_storage.save(name, ContentFile(b"x" * size))
+        timestamp = (datetime.now(timezone.utc) - age).timestamp()
+        os.utime(default_storage.path(name), (timestamp, timestamp))
+        return name
+
+    def test_deletes_unreferenced_images_only(self):
+        sent = self.store("chat_images/sent.webp")
+        sent_thumb = self.store("chat_images/sent_thumb.webp")
+        self.chat.add_message(self.user, image=sent, thumbnail=sent_thumb)
+        archived = self.store("chat_images/archived.webp")
+        ArchivedMessage.objects.create(
+            id=1000, chat=self.chat, user=self.user, image=archived, timestamp=datetime.now(timezone.utc),
+        )
+        deleted = self.store("chat_images/deleted.webp", size=20)
+        deleted_thumb = self.store("chat_images/deleted_thumb.webp", size=5)
+        stale_upload = self.store("chat_images/uploads/stale.png", size=7)
+        fresh = self.store("chat_images/fresh.webp", age=timedelta(minutes=5))
+
+        self.assertEqual(sweep_orphaned_images(grace=timedelta(hours=1), batch_size=2), (3, 32))
+
+        for name in (sent, sent_thumb, archived, fresh):
+            self.assertTrue(default_storage.exists(name), name)
+        for name in (deleted, deleted_thumb, stale_upload):
+            self.assertFalse(default_storage.exists(name), name)
+
+    def test_command_dry_run_keeps_files(self):
+        orphan = self.store("chat_images/orphan.webp", size=42)
+
+        out = StringIO()
+        call_command("apply_retention", dry_run=True, grace_hours=1, stdout=out)
+
+        self.assertIn("Would delete 1 orphaned images, 42 bytes reclaimed.", out.getvalue())
+        self.assertTrue(default_storage.exists(orphan))
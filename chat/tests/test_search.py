@@ -0,0 +1,65 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from ..models import PrivateChat
+from ..search import search_messages
+
+
+class SearchMessagesTests(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="password123")
+        self.user2 = User.objects.create_user(username="user2", password="password123")
+        self.user3 = User.objects.create_user(username="user3", password="password123")
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        self.other_chat = PrivateChat.objects.create(user1=self.user2, user2=self.user3)
+
+    def test_scoped_to_users_chats(self):
+        own = self.chat.add_message(self.user2, "see you at the station")
+        self.other_chat.add_message(self.user3, "the station is closed")
+
+        results, has_next = search_messages(self.user1, "station")
+        self.assertEqual(results, [own])
+        self.assertFalse(has_next)
+
+    def test_all_terms_must_match(self):
+        match = self.chat.add_message(self.user1, "lunch at noon")
+        self.chat.add_message(self.user1, "lunch tomorrow")
+
+        results, _ = search_messages(self.user1, "noon lunch")
+        self.assertEqual(results, [match])
+
+    def test_ranked_by_relevance(self):
+        weak = self.chat.add_message(self.user1, "a long message that mentions pizza only once among many other words")
+        strong = self.chat.add_message(self.user1, "pizza pizza")
+
+        results, _ = search_messages(self.user1, "pizza")
+        self.assertEqual(results, [strong, weak])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = self.chat.add_message(self.user1, "original")
+        message.content = "edited"
+        message.save()
+        self.assertEqual(search_messages(self.user1, "original")[0], [])
+        self.assertEqual(search_messages(self.user1, "edited")[0], [message])
+
+        self.chat.remove_message(message)
+        self.assertEqual(search_messages(self.user1, "edited")[0], [])
+
+    @override_settings(CHAT_SEARCH_PAGE_SIZE=2)
+    def test_paginated(self):
+        for i in range(3):
+            self.chat.add_message(self.user1, f"report {i}")
+
+        first, has_next = search_messages(self.user1, "report")
+        self.assertEqual(len(first), 2)
+        self.assertTrue(has_next)
+
+        second, has_next = search_messages(self.user1, "report", page=2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(has_next)
+        self.assertFalse(set(first) & set(second))
+
+    def test_query_syntax_is_escaped(self):
+        message = self.chat.add_message(self.user1, 'he said "hi" OR NOT')
+        self.assertEqual(search_messages(self.user1, '"hi" OR NOT')[0], [message])
+        self.assertEqual(search_messages(self.user1, "   ")[0], [])
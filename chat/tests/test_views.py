@@ -1,10 +1,26 @@
 import io
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
 from PIL import Image
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User
+from django.template.loader import render_to_string
 from django.urls import reverse
+from ..fragments import chat_versions, fragment_key
+from ..images import thumbnail_name_for
 from ..models import PrivateChat, Message
+from ..presence import MemoryPresence
+
+try:
+    import boto3
+    import requests
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
 
 
 class ChatListViewTests(TestCase):
@@ -18,8 +34,8 @@ class ChatListViewTests(TestCase):
         self.chat1 = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
         self.chat2 = PrivateChat.objects.create(user1=self.user1, user2=self.user3)
 
-        Message.objects.create(chat=self.chat1, user=self.user1, content="Hello!")
-        Message.objects.create(chat=self.chat2, user=self.user3, content="Hey there!")
+        self.chat1.add_message(self.user1, "Hello!")
+        self.chat2.add_message(self.user3, "Hey there!")
 
         self.url = reverse("chat:chat_list")
 
@@ -33,9 +49,38 @@ class ChatListViewTests(TestCase):
         chats = response.context["chats_with_last_messages"]
         self.assertEqual(len(chats), 2)
 
-        results = {(entry[0].username, entry[1].content) for entry in chats}
+        results = {(entry[0].username, entry[1].last_message_preview) for entry in chats}
         self.assertEqual(results, {("user2", "Hello!"), ("user3", "Hey there!")})
 
+    def test_view_orders_chats_by_last_message(self):
+        self.chat1.add_message(self.user2, "Latest")
+        response = self.client.get(self.url)
+        chats = response.context["chats_with_last_messages"]
+        self.assertEqual([entry[0].username for entry in chats], ["user2", "user3"])
+
+    def test_view_contains_unread_counts(self):
+        response = self.client.get(self.url)
+        unread = {entry[0].username: entry[3] for entry in response.context["chats_with_last_messages"]}
+        self.assertEqual(unread, {"user2": 0, "user3": 1})
+
+    def test_view_contains_presence(self):
+        presence = MemoryPresence()
+        async_to_sync(presence.connect)(self.user2.id, "channel")
+
+        with mock.patch("chat.views.get_presence", return_value=presence):
+            response = self.client.get(self.url)
+        online = {entry[0].username: entry[4]["online"] for entry in response.context["chats_with_last_messages"]}
+        self.assertEqual(online, {"user2": True, "user3": False})
+
+    def test_view_query_count_independent_of_chat_count(self):
+        for i in range(5):
+            other = User.objects.create_user(username=f"other{i}", password="Str0ng_p@ssword")
+            PrivateChat.objects.create(user1=self.user1, user2=other).add_message(other, "Hi")
+
+        # session, user, chats
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+
 
 class CreateChatViewTests(TestCase):
 
@@ -92,6 +137,8 @@ class CreateChatViewTests(TestCase):
 class ChatViewTests(TestCase):
 
     def setUp(self):
+        # the cache outlives the test transaction and chat ids get reused
+        caches["fragments"].clear()
         self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
         self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
         self.user3 = User.objects.create_user(username="user3", password="Str0ng_p@ssword")
@@ -115,12 +162,122 @@ class ChatViewTests(TestCase):
         response = self.client.get(self.chat_url)
         self.assertRedirects(response, self.chat_list_url)
 
+    def test_chat_view_marks_read_and_sends_receipt(self):
+        message = self.chat1.add_message(self.user2, "Unread")
+        with mock.patch("chat.views.get_channel_layer") as get_channel_layer:
+            get_channel_layer.return_value.group_send = mock.AsyncMock()
+            self.client.get(self.chat_url)
+            self.client.get(self.chat_url)
+
+        self.chat1.refresh_from_db()
+        self.assertEqual(self.chat1.user1_last_read_id, message.id)
+        # nothing new to mark on the second visit
+        get_channel_layer.return_value.group_send.assert_called_once_with(
+            "chat_user1_user2",
+            {"type": "read_receipt", "room": "chat_user1_user2", "username": "user1", "message_id": message.id},
+        )
+
+    def test_chat_view_caches_message_bodies(self):
+        with mock.patch("chat.fragments.render_to_string", wraps=render_to_string) as render:
+            first = self.client.get(self.chat_url)
+            second = self.client.get(self.chat_url)
+
+        # rendered on the first visit only, once per message
+        self.assertEqual(render.call_count, 2)
+        self.assertContains(first, "Hello!")
+        self.assertContains(second, "Hello!")
+        self.assertIsNotNone(caches["fragments"].get(fragment_key(self.message1.id, self.message1.timestamp, "own")))
+        self.assertIsNotNone(caches["fragments"].get(fragment_key(self.message2.id, self.message2.timestamp, "other")))
+
+    def test_chat_view_keeps_image_urls_out_of_cached_bodies(self):
+        message = self.chat1.add_message(self.user1, "Look", image="chat_images/a.webp", thumbnail="chat_images/a_thumb.webp")
+        response = self.client.get(self.chat_url)
+
+        # storage urls may be signed and expire, they are rendered on every request
+        self.assertContains(response, "chat_images/a_thumb.webp")
+        self.assertNotIn("chat_images", caches["fragments"].get(fragment_key(message.id, message.timestamp, "own")))
+
     def test_chat_view_redirects_if_same_user_in_url(self):
         url = reverse("chat:chat", args=[self.user1.username, self.user1.username])
         response = self.client.get(url)
         self.assertRedirects(response, self.chat_list_url)
 
+    def test_chat_view_resets_unread_count(self):
+        self.chat1.add_message(self.user2, "Unread")
+        self.client.get(self.chat_url)
+        self.chat1.refresh_from_db()
+        self.assertEqual(self.chat1.user1_unread_count, 0)
+
+
+    @override_settings(CHAT_MESSAGES_PAGE_SIZE=1)
+    def test_chat_view_renders_newest_page_only(self):
+        response = self.client.get(self.chat_url)
+        messages = [message for message, _ in response.context["messages_with_prev"]]
+        self.assertEqual(messages, [self.message2])
+        self.assertIsNotNone(response.context["next_cursor"])
+
+
+@override_settings(CHAT_MESSAGES_PAGE_SIZE=2)
+class MessageHistoryViewTests(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        self.messages = [self.chat.add_message(self.user1, f"Message {i}") for i in range(5)]
+
+        self.chat_url = reverse("chat:chat", args=[self.user1.username, self.user2.username])
+        self.url = reverse("chat:message_history", args=[self.user1.username, self.user2.username])
+
+    def test_unauthenticated_user_redirects_to_login(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+
+    def test_forbidden_for_other_user(self):
+        url = reverse("chat:message_history", args=[self.user2.username, self.user1.username])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_pages_walk_back_through_history(self):
+        cursor = self.client.get(self.chat_url).context["next_cursor"]
+        pages = []
+        while cursor:
+            data = self.client.get(self.url, {"before": cursor}).json()
+            pages.append(data["html"])
+            cursor = data["next_cursor"]
+
+        self.assertEqual(len(pages), 2)
+        self.assertIn("Message 2", pages[0])
+        self.assertIn("Message 1", pages[0])
+        self.assertNotIn("Message 3", pages[0])
+        self.assertIn("Message 0", pages[1])
+
+    def test_messages_with_same_timestamp_are_not_skipped(self):
+        Message.objects.filter(chat=self.chat).update(timestamp=self.messages[0].timestamp)
+        cursor = self.client.get(self.chat_url).context["next_cursor"]
+        html = ""
+        while cursor:
+            data = self.client.get(self.url, {"before": cursor}).json()
+            html += data["html"]
+            cursor = data["next_cursor"]
+
+        for i in range(3):
+            self.assertIn(f"Message {i}", html)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "invalid"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_out_of_range_cursor(self):
+        for cursor in (f"{10**20}_1", f"0_{2**64}"):
+            response = self.client.get(self.url, {"before": cursor})
+            self.assertEqual(response.status_code, 400)
 
+
+@override_settings(BACKGROUND_WORKERS=0)
 class UploadImageViewTests(TestCase):
 
     def setUp(self):
@@ -130,27 +287,200 @@ class UploadImageViewTests(TestCase):
 
         self.url = reverse("chat:upload_image", args=[self.user1.username, self.user2.username])
 
+    def make_image(self, size=(100, 100)):
+        img = Image.new("RGB", size, color="red")
+        byte_arr = io.BytesIO()
+        img.save(byte_arr, format="PNG")
+        byte_arr.seek(0)
+        return SimpleUploadedFile("test.png", byte_arr.read(), content_type="image/png")
+
+    def delete_variants(self, image_name):
+        self.addCleanup(default_storage.delete, image_name)
+        self.addCleanup(default_storage.delete, thumbnail_name_for(image_name))
+
     def test_upload_image_no_file(self):
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 400)
 
     def test_upload_image_success(self):
-        img = Image.new("RGB", (100, 100), color="red")
-        byte_arr = io.BytesIO()
-        img.save(byte_arr, format="PNG")
-        byte_arr.seek(0)
-
-        image = SimpleUploadedFile("test.png", byte_arr.read(), content_type="image/png")
-        response = self.client.post(self.url, {"image": image})
+        response = self.client.post(self.url, {"image": self.make_image()})
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertIn("image_name", data)
         self.assertIn("image_url", data)
+        self.delete_variants(data["image_name"])
+
+    def test_upload_image_not_an_image(self):
+        upload = SimpleUploadedFile("test.png", b"not an image", content_type="image/png")
+        response = self.client.post(self.url, {"image": upload})
+        self.assertEqual(response.status_code, 400)
+
+    def test_upload_image_above_pixel_limit(self):
+        with self.settings(CHAT_IMAGE_MAX_PIXELS=100 * 100):
+            response = self.client.post(self.url, {"image": self.make_image((200, 100))})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Image too large.")
+
+    def test_upload_image_decompression_bomb(self):
+        # pillow refuses to open images above twice its own limit
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 1000):
+            response = self.client.post(self.url, {"image": self.make_image()})
+        self.assertEqual(response.status_code, 400)
+
+    def test_upload_image_creates_bounded_variants(self):
+        response = self.client.post(self.url, {"image": self.make_image((3200, 1600))})
+        data = response.json()
+        thumbnail_name = thumbnail_name_for(data["image_name"])
+        self.delete_variants(data["image_name"])
+
+        self.assertEqual((data["image_width"], data["image_height"]), (1600, 800))
+        with default_storage.open(data["image_name"]) as file:
+            self.assertEqual(Image.open(file).size, (1600, 800))
+        with default_storage.open(thumbnail_name) as file:
+            self.assertEqual(Image.open(file).size, (400, 200))
+        self.assertEqual(default_storage.listdir("chat_images/uploads")[1], [])
+
+
+@override_settings(BACKGROUND_WORKERS=0)
+class DirectImageUploadViewTests(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+
+        args = [self.user1.username, self.user2.username]
+        self.create_url = reverse("chat:create_image_upload", args=args)
+        self.finalize_url = reverse("chat:finalize_image_upload", args=args)
+
+    def make_image(self, content=None):
+        if content is None:
+            byte_arr = io.BytesIO()
+            Image.new("RGB", (3200, 1600), color="red").save(byte_arr, format="PNG")
+            content = byte_arr.getvalue()
+        return SimpleUploadedFile("test.png", content, content_type="image/png")
+
+    def create_upload(self, image):
+        response = self.client.post(
+            self.create_url, {"filename": image.name, "content_type": image.content_type, "size": image.size},
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def delete_variants(self, image_name):
+        self.addCleanup(default_storage.delete, image_name)
+        self.addCleanup(default_storage.delete, thumbnail_name_for(image_name))
+
+    def test_upload_and_finalize(self):
+        image = self.make_image()
+        upload = self.create_upload(image)
+        self.assertEqual(upload["fields"], {})
+
+        response = self.client.post(upload["url"], {"file": image})
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(self.finalize_url, {"token": upload["token"]})
+        data = response.json()
+        self.delete_variants(data["image_name"])
+
+        self.assertEqual((data["image_width"], data["image_height"]), (1600, 800))
+        with default_storage.open(data["image_name"]) as file:
+            self.assertEqual(Image.open(file).size, (1600, 800))
+        self.assertEqual(default_storage.listdir("chat_images/uploads")[1], [])
+
+    def test_rejects_non_images_and_large_files(self):
+        response = self.client.post(self.create_url, {"filename": "a.txt", "content_type": "text/plain", "size": 10})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.create_url, {"filename": "a.png", "content_type": "image/png", "size": 10 ** 9})
+        self.assertEqual(response.status_code, 400)
+
+    def test_finalize_deletes_invalid_upload(self):
+        image = self.make_image(b"not an image")
+        upload = self.create_upload(image)
+        self.client.post(upload["url"], {"file": image})
+
+        response = self.client.post(self.finalize_url, {"token": upload["token"]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(default_storage.listdir("chat_images/uploads")[1], [])
+
+    def test_finalize_deletes_upload_above_pixel_limit(self):
+        image = self.make_image()
+        upload = self.create_upload(image)
+        self.client.post(upload["url"], {"file": image})
+
+        with self.settings(CHAT_IMAGE_MAX_PIXELS=1600 * 1600):
+            response = self.client.post(self.finalize_url, {"token": upload["token"]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(default_storage.listdir("chat_images/uploads")[1], [])
+
+    def test_tokens_are_bound_to_the_uploader(self):
+        image = self.make_image()
+        upload = self.create_upload(image)
+        self.client.post(upload["url"], {"file": image})
+
+        self.client.login(username="user2", password="Str0ng_p@ssword")
+        response = self.client.post(self.finalize_url, {"token": upload["token"]})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(reverse("chat:direct_upload", args=["forged"]), {"file": image})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+        data = self.client.post(self.finalize_url, {"token": upload["token"]}).json()
+        self.delete_variants(data["image_name"])
+
+
+@skipUnless(mock_aws, "moto is not installed")
+@override_settings(
+    BACKGROUND_WORKERS=0,
+    STORAGES={
+        **settings.STORAGES,
+        "default": {
+            "BACKEND": "storages.backends.s3.S3Storage",
+            "OPTIONS": {"bucket_name": "chat-test", "region_name": "us-east-1", "access_key": "test", "secret_key": "test"},
+        },
+    },
+)
+class PresignedImageUploadViewTests(TestCase):
+
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="chat-test")
+
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+        self.args = [self.user1.username, self.user2.username]
+
+    def test_upload_goes_straight_to_the_bucket(self):
+        byte_arr = io.BytesIO()
+        Image.new("RGB", (800, 400), color="red").save(byte_arr, format="PNG")
+        response = self.client.post(
+            reverse("chat:create_image_upload", args=self.args),
+            {"filename": "test.png", "content_type": "image/png", "size": len(byte_arr.getvalue())},
+        )
+        upload = response.json()
+        self.assertIn("chat-test", upload["url"])
+        self.assertEqual(upload["fields"]["Content-Type"], "image/png")
+
+        response = requests.post(upload["url"], data=upload["fields"], files={"file": byte_arr.getvalue()})
+        self.assertLess(response.status_code, 300)
+        response = self.client.post(reverse("chat:finalize_image_upload", args=self.args), {"token": upload["token"]})
+
+        data = response.json()
+        self.assertEqual((data["image_width"], data["image_height"]), (800, 400))
+        with default_storage.open(thumbnail_name_for(data["image_name"])) as file:
+            self.assertEqual(Image.open(file).size, (400, 200))
+        self.assertEqual(default_storage.listdir("chat_images/uploads")[1], [])
 
 
 class DeleteChatViewTests(TestCase):
 
     def setUp(self):
+        # the cache outlives the test transaction and chat ids get reused
+        caches["fragments"].clear()
         self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
         self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
         self.user3 = User.objects.create_user(username="user3", password="Str0ng_p@ssword")
@@ -177,6 +507,12 @@ class DeleteChatViewTests(TestCase):
         self.assertFalse(Message.objects.filter(id=self.message1.id).exists())
         self.assertFalse(Message.objects.filter(id=self.message2.id).exists())
 
+    def test_delete_chat_invalidates_fragments(self):
+        self.client.get(reverse("chat:chat", args=["user1", "user2"]))
+        self.client.post(self.url)
+        # the old bodies are left to expire, their keys are never looked up again
+        self.assertEqual(chat_versions(caches["fragments"], [self.chat1.id]), {self.chat1.id: 1})
+
     def test_delete_chat_forbidden_for_non_participant(self):
         self.client.login(username="user3", password="Str0ng_p@ssword")
         self.client.post(self.url)
@@ -186,6 +522,8 @@ class DeleteChatViewTests(TestCase):
 class DeleteMessageViewTests(TestCase):
 
     def setUp(self):
+        # the cache outlives the test transaction and chat ids get reused
+        caches["fragments"].clear()
         self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
         self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
         self.client.login(username="user1", password="Str0ng_p@ssword")
@@ -207,6 +545,23 @@ class DeleteMessageViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertFalse(Message.objects.filter(id=self.message1.id).exists())
 
+    def test_delete_last_message_updates_summary(self):
+        message = self.chat.add_message(self.user1, "Latest")
+        self.client.post(reverse("chat:delete_message", args=[message.id]))
+
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, self.message2.id)
+        self.assertEqual(self.chat.last_message_preview, "Hi")
+        self.assertEqual(self.chat.user2_unread_count, 0)
+
+    def test_delete_message_invalidates_fragment(self):
+        self.client.get(reverse("chat:chat", args=["user1", "user2"]))
+        key = fragment_key(self.message1.id, self.message1.timestamp, "own")
+        self.assertIsNotNone(caches["fragments"].get(key))
+
+        self.client.post(self.url)
+        self.assertIsNone(caches["fragments"].get(key))
+
     def test_delete_message_forbidden_for_other_user(self):
         url = reverse("chat:delete_message", args=[self.message2.id])
         response = self.client.post(url)
@@ -216,3 +571,35 @@ class DeleteMessageViewTests(TestCase):
     def test_delete_message_not_exist(self):
         response = self.client.post(reverse("chat:delete_message", args=[9999]))
         self.assertEqual(response.status_code, 404)
+
+
+class SearchViewTests(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="Str0ng_p@ssword")
+        self.user2 = User.objects.create_user(username="user2", password="Str0ng_p@ssword")
+        self.client.login(username="user1", password="Str0ng_p@ssword")
+        self.chat = PrivateChat.objects.create(user1=self.user1, user2=self.user2)
+        self.url = reverse("chat:search")
+
+    def test_unauthenticated_user_redirects_to_login(self):
+        self.client.logout()
+        response = self.client.get(self.url, {"q": "hello"})
+        self.assertEqual(response.status_code, 302)
+
+    def test_search_results(self):
+        message = self.chat.add_message(self.user2, "hello there")
+        response = self.client.get(self.url, {"q": "hello"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["results"], [message])
+        self.assertEqual(response.context["results"][0].other_user, self.user2)
+        self.assertContains(response, "hello there")
+
+    def test_invalid_page_falls_back_to_first(self):
+        response = self.client.get(self.url, {"q": "hello", "page": "abc"})
+        self.assertEqual(response.context["page"], 1)
+
+    def test_out_of_range_page_falls_back_to_first(self):
+        response = self.client.get(self.url, {"q": "hello", "page": "99999999999999999999"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["page"], 1)
@@ -0,0 +1,37 @@
+import json
+import msgpack
+
+# record streams used by the export_chats/import_chats commands, chats come before their messages:
+#   {"type": "chat", "id": ..., "user1": "<username>", "user2": "<username>"}
+#   {"type": "message", "id": ..., "chat": <chat id>, "user": "<username>", "content": ..., "timestamp": "<iso>", ...}
+FORMATS = ("jsonl", "msgpack")
+
+def guess_format(path):
+    return "msgpack" if path.endswith((".msgpack", ".mpk")) else "jsonl"
+
+def write_records(file, records, format):
+    """
+    Stream records to a binary file, one at a time. Returns how many were written.
+    """
+    count = 0
+    if format == "msgpack":
+        packer = msgpack.Packer()
+        for record in records:
+            file.write(packer.pack(record))
+            count += 1
+    else:
+        for record in records:
+            file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+            count += 1
+    return count
+
+def read_records(file, format):
+    """
+    Iterate over the records of a binary file without loading it as a whole.
+    """
+    if format == "msgpack":
+        yield from msgpack.Unpacker(file, raw=False)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
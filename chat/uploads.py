@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from .models import chat_upload_path
+
+SIGNING_SALT = "chat.uploads"
+
+def create_upload(user, filename, content_type):
+    """
+    Reserve a key for a direct upload and return where and how the browser should POST the file:
+    a presigned POST straight to the bucket on S3, the signed direct_upload endpoint otherwise.
+    The token identifies the upload when it is finalized.
+    """
+    key = chat_upload_path(filename)
+    token = signing.dumps({"key": key, "user": user.id}, salt=SIGNING_SALT)
+    ttl = settings.CHAT_UPLOAD_URL_TTL
+
+    if hasattr(default_storage, "bucket_name"):
+        # S3 enforces type, size and expiry itself, the file never touches a worker
+        post = default_storage.connection.meta.client.generate_presigned_post(
+            default_storage.bucket_name,
+            default_storage._normalize_name(key),
+            Fields={"Content-Type": content_type},
+            Conditions=[{"Content-Type": content_type}, ["content-length-range", 1, settings.CHAT_UPLOAD_MAX_BYTES]],
+            ExpiresIn=ttl,
+        )
+        return {"url": post["url"], "fields": post["fields"], "token": token}
+
+    return {"url": reverse("chat:direct_upload", args=[token]), "fields": {}, "token": token}
+
+def read_token(token, max_age, user=None):
+    """
+    Storage key of an upload token, None if it is forged, older than max_age seconds or was issued to someone else.
+    """
+    try:
+        data = signing.loads(token, salt=SIGNING_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+    if user is not None and data["user"] != user.id:
+        return None
+    return data["key"]
@@ -5,8 +5,16 @@ app_name = "chat"
 urlpatterns = [
     path("", views.chat_list, name="chat_list"),
     path("chat/create/", views.create_chat, name="create_chat"),
+    path("search/", views.search, name="search"),
     path("chat/<str:username>/<str:other_username>/", views.chat, name="chat"),
+    path("chat/<str:username>/<str:other_username>/messages/", views.message_history, name="message_history"),
     path("chat/<str:username>/<str:other_username>/upload_image/", views.upload_image, name="upload_image"),
+    path("chat/<str:username>/<str:other_username>/upload_url/", views.create_image_upload, name="create_image_upload"),
+    path(
+        "chat/<str:username>/<str:other_username>/finalize_upload/", views.finalize_image_upload,
+        name="finalize_image_upload",
+    ),
+    path("uploads/<str:token>/", views.direct_upload, name="direct_upload"),
     path("chat/<str:username>/<str:other_username>/delete/", views.delete_chat, name="delete_chat"),
     path("message/<int:message_id>/delete/", views.delete_message, name="delete_message"),
 ]
@@ -1,34 +1,67 @@
+import math
+from PIL import Image, UnidentifiedImageError
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponseRedirect, HttpResponseForbidden, JsonResponse
+from django.db.models import F, Q
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.template.loader import render_to_string
 from django.urls import reverse
-from .models import PrivateChat, Message
+from main import background
+from users.cache import get_cached_user
+from .events import read_receipt_event, room_group_name
+from .fragments import attach_fragments, invalidate_chat_fragments, invalidate_fragments
+from .models import PrivateChat, Message, chat_upload_path
 from .forms import PrivateChatForm
+from .images import bounded_size, process_upload, read_size, variant_names
+from .pagination import get_messages_page
+from .presence import get_presence
+from .ratelimit import check_rate
+from .search import MAX_PAGE, search_messages
+from .uploads import create_upload, read_token
 
 @login_required
 def chat_list(request):
-    chats = PrivateChat.objects.filter(user1=request.user) | PrivateChat.objects.filter(user2=request.user)
+    # the summary columns make this a single query, no per-chat message lookups
+    chats = (
+        PrivateChat.objects.filter(Q(user1=request.user) | Q(user2=request.user))
+        .select_related("user1__profile", "user2__profile")
+        .order_by(F("last_message_timestamp").desc(nulls_last=True), "-id")
+    )
+    chats = list(chats)
+    # presence of every listed user in one lookup
+    presence = get_presence().lookup(
+        chat.user1_id if chat.user2_id == request.user.id else chat.user2_id for chat in chats
+    )
     chats_with_last_messages = []
 
     for chat in chats:
-        last_message = chat.messages.order_by("-timestamp").first()
-        time_diff = last_message.get_time_diff() if last_message else "No messages yet"
-        other_user = chat.user1 if chat.user2 == request.user else chat.user2
-        chats_with_last_messages.append((other_user, last_message, time_diff))
+        other_user = chat.user1 if chat.user2_id == request.user.id else chat.user2
+        chats_with_last_messages.append(
+            (other_user, chat, chat.get_time_diff(), chat.unread_count_for(request.user), presence[other_user.id])
+        )
 
-    context = {"chats_with_last_messages": chats_with_last_messages}
+    context = {"chats_with_last_messages": chats_with_last_messages, "ws_protocol": settings.CHAT_CLIENT_PROTOCOL}
     return render(request, "chat/chat_list.html", context)
 
 @login_required
 def create_chat(request):
     if request.method == "POST":
         form = PrivateChatForm(request.POST)
+        wait = check_rate("create_chat", request.user)
+        if wait:
+            messages.error(request, f"You are starting chats too quickly, try again in {math.ceil(wait)} seconds.")
+            return render(request, "chat/create_chat.html", {"form": form}, status=429)
         if form.is_valid():
             username = form.cleaned_data["username"]
-            other_user = User.objects.filter(username=username).first()
+            other_user = get_cached_user(username)
 
             if not other_user:
                 messages.error(request, "Username doesn't exist.")
@@ -39,10 +72,7 @@ def create_chat(request):
                 return redirect("chat:create_chat")
 
             # fetch/create chat
-            if request.user.id < other_user.id:
-                PrivateChat.objects.get_or_create(user1=request.user, user2=other_user)
-            else:
-                PrivateChat.objects.get_or_create(user1=other_user, user2=request.user)
+            PrivateChat.between(request.user, other_user)
 
             return HttpResponseRedirect(reverse("chat:chat", args=[request.user.username, other_user.username]))
 
@@ -53,49 +83,209 @@ def create_chat(request):
 
 @login_required
 def chat(request, username, other_username):
-    user1 = get_object_or_404(User, username=username)
-    user2 = get_object_or_404(User, username=other_username)
+    user1 = get_user_or_404(username)
+    user2 = get_user_or_404(other_username)
 
     if user1 == user2:
         return redirect("chat:chat_list")
 
     if request.user == user1:
         # fetch/create chat
-        if user1.id < user2.id:
-            chat, _ = PrivateChat.objects.get_or_create(user1=user1, user2=user2)
-        else:
-            chat, _ = PrivateChat.objects.get_or_create(user1=user2, user2=user1)
+        chat = PrivateChat.between(user1, user2)
     else:
         return redirect("chat:chat_list")
 
-    messages = Message.objects.filter(chat=chat).order_by("timestamp")
+    marker = chat.mark_read(request.user)
+    if marker is not None:
+        async_to_sync(get_channel_layer().group_send)(
+            room_group_name(user1.username, user2.username),
+            read_receipt_event(room_group_name(user1.username, user2.username), user1, marker),
+        )
+    # only the newest page is rendered, older ones are fetched by message_history
+    messages, next_cursor = get_messages_page(chat)
+    attach_fragments(messages, request.user)
+
+    context = {
+        "messages_with_prev": zip_with_prev(messages),
+        "next_cursor": next_cursor,
+        "current_user": user1,
+        "other_user": user2,
+        "other_last_read_id": chat.last_read_id_for(user2),
+        "other_user_presence": get_presence().lookup([user2.id])[user2.id],
+        "ws_protocol": settings.CHAT_CLIENT_PROTOCOL,
+    }
+    return render(request, "chat/chat.html", context)
+
+@login_required
+def message_history(request, username, other_username):
+    if request.user.username != username:
+        return HttpResponseForbidden("Not allowed to read this chat.")
+
+    other_user = get_user_or_404(other_username)
+    if request.user.id < other_user.id:
+        chat = get_object_or_404(PrivateChat, user1=request.user, user2=other_user)
+    else:
+        chat = get_object_or_404(PrivateChat, user1=other_user, user2=request.user)
+
+    try:
+        messages, next_cursor = get_messages_page(chat, request.GET.get("before"))
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor."}, status=400)
+    attach_fragments(messages, request.user)
+
+    html = render_to_string("chat/messages.html", {
+        "messages_with_prev": zip_with_prev(messages), "next_cursor": next_cursor,
+        "other_last_read_id": chat.last_read_id_for(other_user)}, request=request,
+    )
+    return JsonResponse({"html": html, "next_cursor": next_cursor})
 
-    # zip with previous message
+@login_required
+def search(request):
+    query = request.GET.get("q", "").strip()
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+        if page > MAX_PAGE:
+            raise ValueError(f"Page out of range: {page}")
+    except ValueError:
+        page = 1
+
+    results, has_next = search_messages(request.user, query, page) if query else ([], False)
+    for message in results:
+        message.other_user = message.chat.user1 if message.chat.user2_id == request.user.id else message.chat.user2
+
+    context = {"query": query, "results": results, "page": page, "has_next": has_next}
+    return render(request, "chat/search.html", context)
+
+def get_user_or_404(username):
+    user = get_cached_user(username)
+    if user is None:
+        raise Http404("No such user.")
+    return user
+
+def zip_with_prev(messages):
+    """
+    Pair every message with its predecessor, used to render date separators.
+    """
     messages_with_prev = []
     prev = None
     for message in messages:
         messages_with_prev.append((message, prev))
         prev = message
-
-    context = {"messages_with_prev": messages_with_prev, "current_user": user1, "other_user": user2}
-    return render(request, "chat/chat.html", context)
+    return messages_with_prev
 
 @login_required
 @require_POST
 def upload_image(request, username, other_username):
+    wait = check_rate("upload", request.user)
+    if wait:
+        return rate_limited(wait)
+
     image = request.FILES.get("image")
     if not image:
         return JsonResponse({"error": "No image provided."}, status=400)
 
-    message = Message(user=request.user, chat_id=0)
-    message.image.save(image.name, image, save=False)
-    return JsonResponse({"image_name": message.image.name, "image_url": message.image.url})
+    try:
+        width, height = read_size(image)
+    except Image.DecompressionBombError:
+        return JsonResponse({"error": "Image too large."}, status=400)
+    except (UnidentifiedImageError, OSError):
+        return JsonResponse({"error": "Invalid image."}, status=400)
+
+    # store the raw upload and re-encode it off the request
+    upload_name = default_storage.save(chat_upload_path(image.name), image)
+    return process_image(upload_name, width, height)
+
+@login_required
+@require_POST
+def create_image_upload(request, username, other_username):
+    """
+    First step of a direct upload, the browser then POSTs the file to the returned url itself.
+    """
+    wait = check_rate("upload", request.user)
+    if wait:
+        return rate_limited(wait)
+
+    content_type = request.POST.get("content_type", "")
+    try:
+        size = int(request.POST.get("size", ""))
+    except ValueError:
+        return JsonResponse({"error": "No image provided."}, status=400)
+    if not content_type.startswith("image/"):
+        return JsonResponse({"error": "Invalid image."}, status=400)
+    if size > settings.CHAT_UPLOAD_MAX_BYTES:
+        return JsonResponse({"error": "Image too large."}, status=400)
+
+    return JsonResponse(create_upload(request.user, request.POST.get("filename", "image"), content_type))
+
+@csrf_exempt
+@require_POST
+def direct_upload(request, token):
+    """
+    Local stand-in for the presigned bucket POST, the signed token is the only credential like on S3.
+    """
+    key = read_token(token, settings.CHAT_UPLOAD_URL_TTL)
+    file = request.FILES.get("file")
+    if key is None:
+        return HttpResponseForbidden("Invalid or expired upload.")
+    if not file or file.size > settings.CHAT_UPLOAD_MAX_BYTES or default_storage.exists(key):
+        return JsonResponse({"error": "Invalid upload."}, status=400)
+
+    default_storage.save(key, file)
+    return HttpResponse(status=204)
+
+@login_required
+@require_POST
+def finalize_image_upload(request, username, other_username):
+    """
+    Validate a direct upload once it is in storage and hand it to the image pipeline.
+    """
+    # the upload may start at the very end of its ttl
+    key = read_token(request.POST.get("token", ""), settings.CHAT_UPLOAD_URL_TTL * 2, user=request.user)
+    if key is None:
+        return HttpResponseForbidden("Invalid or expired upload.")
+    if not default_storage.exists(key):
+        return JsonResponse({"error": "No image provided."}, status=400)
+
+    try:
+        if default_storage.size(key) > settings.CHAT_UPLOAD_MAX_BYTES:
+            raise OSError("upload too large")
+        with default_storage.open(key) as file:
+            width, height = read_size(file)
+    except Image.DecompressionBombError:
+        default_storage.delete(key)
+        return JsonResponse({"error": "Image too large."}, status=400)
+    except (UnidentifiedImageError, OSError):
+        default_storage.delete(key)
+        return JsonResponse({"error": "Invalid image."}, status=400)
+
+    return process_image(key, width, height)
+
+def rate_limited(wait):
+    response = JsonResponse({"error": "Too many requests.", "retry_after": round(wait, 3)}, status=429)
+    response["Retry-After"] = str(math.ceil(wait))
+    return response
+
+def process_image(upload_name, width, height):
+    # re-encoded off the request, the variant names and displayed size are known upfront
+    background.submit(process_upload, upload_name)
+
+    image_name, thumbnail_name = variant_names(upload_name)
+    image_width, image_height = bounded_size(width, height, settings.CHAT_IMAGE_FULL_SIZE)
+    return JsonResponse({
+        "image_name": image_name,
+        "image_url": default_storage.url(image_name),
+        "thumbnail_url": default_storage.url(thumbnail_name),
+        "image_width": image_width,
+        "image_height": image_height,
+    })
 
 @login_required
 def delete_chat(request, username, other_username):
     try:
-        user1 = User.objects.get(username=username)
-        user2 = User.objects.get(username=other_username)
+        user1 = get_cached_user(username)
+        user2 = get_cached_user(other_username)
+        if user1 is None or user2 is None:
+            raise User.DoesNotExist
 
         if request.user != user1 and request.user != user2:
             messages.error(request, "Not authorized to delete this chat.")
@@ -105,7 +295,9 @@ def delete_chat(request, username, other_username):
             chat = PrivateChat.objects.get(user1=user1, user2=user2)
         else:
             chat = PrivateChat.objects.get(user1=user2, user2=user1)
+        chat_id = chat.id
         chat.delete()
+        invalidate_chat_fragments(chat_id)
         messages.success(request, "Chat has been successfully deleted.")
 
     except User.DoesNotExist:
@@ -126,6 +318,8 @@ def delete_message(request, message_id):
 
     chat = message.chat
     other_user = chat.user2 if chat.user1 == request.user else chat.user1
-    message.delete()
+    deleted = (chat.id, message.id, message.timestamp)
+    chat.remove_message(message)
+    invalidate_fragments([deleted])
 
     return redirect("chat:chat", username=request.user.username, other_username=other_user.username)
@@ -0,0 +1,39 @@
+"""
+Shared thread pool for work that should not hold up a request or websocket handler.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+def submit(func, *args, **kwargs):
+    """
+    Run func in the background pool, or inline when BACKGROUND_WORKERS is 0 (e.g. in tests).
+    """
+    if settings.BACKGROUND_WORKERS == 0:
+        func(*args, **kwargs)
+        return None
+
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix="background")
+
+    future = _executor.submit(_run, func, *args, **kwargs)
+    future.add_done_callback(_log_failure)
+    return future
+
+def _run(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Background task failed", exc_info=future.exception())
@@ -55,6 +55,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "chat.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -96,6 +97,9 @@ if DEBUG:
     CHANNEL_LAYERS = {
         "default": {
             "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {
+                "capacity": int(os.getenv("CHANNEL_CAPACITY", "100")),
+            },
         }
     }
 else:
@@ -105,6 +109,8 @@ else:
             "BACKEND": "channels_redis.core.RedisChannelLayer",
             "CONFIG": {
                 "hosts": [(os.getenv("REDIS_URL"))],
+                # events waiting per channel, group sends to a full channel are dropped
+                "capacity": int(os.getenv("CHANNEL_CAPACITY", "100")),
             },
         },
     }
@@ -194,3 +200,99 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = "users:login"
 LOGIN_REDIRECT_URL = "chat:chat_list"
 LOGOUT_REDIRECT_URL = "/"
+
+# chat settings
+CHAT_MESSAGES_PAGE_SIZE = int(os.getenv("CHAT_MESSAGES_PAGE_SIZE", "50"))
+
+# write-behind buffering of websocket messages, CHAT_WRITE_BEHIND_ACK is "flush" (ack once the
+# message is stored) or "immediate" (ack right away, a crash may lose the last batch)
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "False") == "True"
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", "100"))
+CHAT_WRITE_BEHIND_DELAY = float(os.getenv("CHAT_WRITE_BEHIND_DELAY", "0.05"))
+CHAT_WRITE_BEHIND_ACK = os.getenv("CHAT_WRITE_BEHIND_ACK", "flush")
+
+# broadcast websocket messages while they are being stored, followed by a persisted/failed status event
+CHAT_BROADCAST_BEFORE_PERSIST = os.getenv("CHAT_BROADCAST_BEFORE_PERSIST", "False") == "True"
+
+# per request/websocket event instrumentation, scraped from /metrics/ with METRICS_TOKEN as bearer token
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True") == "True"
+METRICS_LOG = os.getenv("METRICS_LOG", "False") == "True"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# background thread pool (main.background), 0 runs tasks inline
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "4"))
+
+# chat image uploads are re-encoded to CHAT_IMAGE_FORMAT ("WEBP" or "JPEG") in bounded sizes
+CHAT_IMAGE_FORMAT = os.getenv("CHAT_IMAGE_FORMAT", "WEBP")
+CHAT_IMAGE_FULL_SIZE = int(os.getenv("CHAT_IMAGE_FULL_SIZE", "1600"))
+CHAT_IMAGE_THUMBNAIL_SIZE = int(os.getenv("CHAT_IMAGE_THUMBNAIL_SIZE", "400"))
+# uploads decoding to more pixels than this are refused, a tiny png can hold a huge canvas
+CHAT_IMAGE_MAX_PIXELS = int(os.getenv("CHAT_IMAGE_MAX_PIXELS", str(50_000_000)))
+
+# presence is kept in the channel layer Redis (in memory in DEBUG), connections expire after
+# PRESENCE_TTL seconds without a heartbeat, typing indicators stop after CHAT_TYPING_TIMEOUT seconds
+PRESENCE_REDIS_URL = "" if DEBUG else os.getenv("REDIS_URL", "")
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "60"))
+PRESENCE_HEARTBEAT = int(os.getenv("PRESENCE_HEARTBEAT", "25"))
+CHAT_TYPING_TIMEOUT = float(os.getenv("CHAT_TYPING_TIMEOUT", "3"))
+
+# full-text message search, postgres GIN index in prod and an sqlite fts5 table in dev
+CHAT_SEARCH_PAGE_SIZE = int(os.getenv("CHAT_SEARCH_PAGE_SIZE", "20"))
+
+# caches, redis (the channel layer instance) in prod and per-process memory in dev, rendered
+# message bodies go to CHAT_FRAGMENT_CACHE for CHAT_FRAGMENT_CACHE_TIMEOUT seconds
+if DEBUG:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "fragments": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "fragments"},
+    }
+else:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": os.getenv("REDIS_URL")},
+        "fragments": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+            "KEY_PREFIX": "fragments",
+        },
+    }
+CHAT_FRAGMENT_CACHE = os.getenv("CHAT_FRAGMENT_CACHE", "fragments")
+CHAT_FRAGMENT_CACHE_TIMEOUT = int(os.getenv("CHAT_FRAGMENT_CACHE_TIMEOUT", str(60 * 60 * 24 * 7)))
+
+# user/profile lookups by username and user pair -> chat id lookups are cached for this many seconds
+USER_CACHE_TIMEOUT = int(os.getenv("USER_CACHE_TIMEOUT", str(60 * 60)))
+
+# retention (manage.py apply_retention), messages older than CHAT_ARCHIVE_AFTER_DAYS move to the archive
+# table (0, the default, keeps them in place), unreferenced chat images older than CHAT_ORPHAN_GRACE_HOURS
+# are deleted. archived rows stay in the database (admin, sql) but are no longer shown in any chat history
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "0"))
+CHAT_ORPHAN_GRACE_HOURS = int(os.getenv("CHAT_ORPHAN_GRACE_HOURS", "24"))
+
+# direct image uploads, the browser POSTs to a presigned bucket url (a signed local endpoint in dev)
+# valid for CHAT_UPLOAD_URL_TTL seconds, files above CHAT_UPLOAD_MAX_BYTES are refused
+CHAT_UPLOAD_URL_TTL = int(os.getenv("CHAT_UPLOAD_URL_TTL", "300"))
+CHAT_UPLOAD_MAX_BYTES = int(os.getenv("CHAT_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# reconnecting sockets get up to CHAT_REPLAY_LIMIT missed messages replayed, a resync frame beyond that
+CHAT_REPLAY_LIMIT = int(os.getenv("CHAT_REPLAY_LIMIT", "200"))
+
+# websocket frames the browser asks for, "json" text frames or the batched "msgpack" binary protocol
+CHAT_CLIENT_PROTOCOL = os.getenv("CHAT_CLIENT_PROTOCOL", "json")
+
+# per-connection outbound queue of websocket frames, on overflow CHAT_OUTBOX_POLICY either
+# "drop"s the frame, "coalesce"s the queue into resync frames or "disconnect"s the client.
+# it only bounds frames the consumer has not handed to the server yet: daphne accepts every frame
+# at once into its (unbounded) twisted transport buffer, so a slow client rarely overflows it
+CHAT_OUTBOX_LIMIT = int(os.getenv("CHAT_OUTBOX_LIMIT", "256"))
+CHAT_OUTBOX_POLICY = os.getenv("CHAT_OUTBOX_POLICY", "coalesce")
+
+# token bucket rate limits as (tokens per second, burst), "connection" applies to the frames of each
+# websocket and the other scopes to each user, shared through Redis in prod and per process in dev
+RATE_LIMIT_REDIS_URL = "" if DEBUG else os.getenv("REDIS_URL", "")
+CHAT_RATE_LIMITS = {
+    "connection": (
+        float(os.getenv("CHAT_CONNECTION_FRAME_RATE", "10")), int(os.getenv("CHAT_CONNECTION_FRAME_BURST", "50")),
+    ),
+    "frame": (float(os.getenv("CHAT_USER_FRAME_RATE", "20")), int(os.getenv("CHAT_USER_FRAME_BURST", "100"))),
+    "upload": (float(os.getenv("CHAT_UPLOAD_RATE", "1")), int(os.getenv("CHAT_UPLOAD_BURST", "20"))),
+    "create_chat": (float(os.getenv("CHAT_CREATE_RATE", "0.5")), int(os.getenv("CHAT_CREATE_BURST", "20"))),
+}
@@ -1,31 +1,36 @@
-import { convertLinks, autoScrollMessages } from './utils.js';
+import { autoScrollMessages } from './utils.js';
 import { sendImage } from './file_upload.js';
+import { openSocket, readFrames, sendFrame } from './protocol.js';
 
 document.addEventListener('DOMContentLoaded', function () {
     setupWebSocketConnection();
     setupMessageInputHandlers();
+    setupHistoryLoader();
     autoScrollMessages();
 });
 
+// the current socket, replaced on every reconnect
+let chatSocket = null;
+let reconnectDelay = 1000;
+let sendErrorTimer = null;
+
 function setupWebSocketConnection() {
-    const username = document.getElementById('username').value;
     const otherUsername = document.getElementById('otherUsername').value;
-    const chatSocket = new WebSocket(`ws://${window.location.host}/ws/chat/${username}/${otherUsername}/`);
-
-    chatSocket.onopen = function (e) {
-        console.log("WebSocket connection established.");
-    };
-
-    chatSocket.onclose = function (e) {
-        console.log("WebSocket connection closed.");
-    };
-
-    chatSocket.onmessage = handleIncomingMessage;
+    connectWebSocket();
 
     document.querySelector("#message_send_button").onclick = function (e) {
         sendMessage(chatSocket);
     };
 
+    // the server coalesces these into start/stop events, a frame per second keeps it alive
+    let lastTypingFrame = 0;
+    document.querySelector("#message_send_input").addEventListener("input", function () {
+        if (chatSocket && chatSocket.readyState === WebSocket.OPEN && Date.now() - lastTypingFrame > 1000) {
+            lastTypingFrame = Date.now();
+            sendFrame(chatSocket, { type: "typing", chat: otherUsername });
+        }
+    });
+
     document.querySelector("#image_send_button").onclick = function (e) {
         document.querySelector("#image_input").click();
     };
@@ -35,6 +40,37 @@ function setupWebSocketConnection() {
     };
 }
 
+async function connectWebSocket() {
+    const otherUsername = document.getElementById('otherUsername').value;
+    // one socket per user, this page subscribes to the conversation it shows
+    chatSocket = await openSocket(`ws://${window.location.host}/ws/chat/`);
+
+    chatSocket.onopen = function (e) {
+        console.log("WebSocket connection established.");
+        reconnectDelay = 1000;
+        // the server replays whatever arrived after the newest message on the page
+        sendFrame(chatSocket, { type: "subscribe", chat: otherUsername, last_id: lastMessageId() });
+    };
+
+    chatSocket.onclose = function (e) {
+        console.log(`WebSocket connection closed, reconnecting in ${reconnectDelay / 1000}s.`);
+        setTimeout(connectWebSocket, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+    };
+
+    chatSocket.onmessage = function (e) {
+        readFrames(e).forEach(handleIncomingMessage);
+    };
+}
+
+function lastMessageId() {
+    let lastId = 0;
+    document.querySelectorAll("#messages-container [data-message-id]").forEach(div => {
+        lastId = Math.max(lastId, Number(div.dataset.messageId));
+    });
+    return lastId;
+}
+
 function setupMessageInputHandlers() {
     const messageInput = document.querySelector("#message_send_input");
     messageInput.focus();
@@ -45,27 +81,113 @@ function setupMessageInputHandlers() {
     };
 }
 
+function setupHistoryLoader() {
+    const container = document.querySelector("#messages-container");
+    let loading = false;
+
+    container.addEventListener("scroll", function () {
+        if (loading || container.scrollTop > 100 || !container.dataset.nextCursor) {
+            return;
+        }
+        loading = true;
+        loadOlderMessages(container).finally(() => { loading = false; });
+    });
+}
+
+function loadOlderMessages(container) {
+    const username = document.getElementById('username').value;
+    const otherUsername = document.getElementById('otherUsername').value;
+    const params = new URLSearchParams({ before: container.dataset.nextCursor });
+
+    return fetch(`/chat/${username}/${otherUsername}/messages/?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            const previousHeight = container.scrollHeight;
+            const firstElement = container.firstElementChild;
+            const template = document.createElement("template");
+            template.innerHTML = data.html;
+            const lastNewElement = template.content.lastElementChild;
+
+            // the old top separator is redundant if the older page ends on the same day
+            if (firstElement && firstElement.classList.contains("date-separator")
+                && lastNewElement && lastNewElement.dataset.date === firstElement.dataset.date) {
+                firstElement.remove();
+            }
+
+            container.prepend(template.content);
+            container.dataset.nextCursor = data.next_cursor || "";
+            // keep the message the user was looking at in place
+            container.scrollTop += container.scrollHeight - previousHeight;
+        });
+}
+
 function sendMessage(chatSocket) {
     const messageInput = document.querySelector("#message_send_input").value.trim();
     if (messageInput) {
-        chatSocket.send(JSON.stringify({
-            message: messageInput,
-            username: document.getElementById('username').value,
-        }));
+        const otherUsername = document.getElementById('otherUsername').value;
+        sendFrame(chatSocket, { chat: otherUsername, message: messageInput });
         document.querySelector("#message_send_input").value = "";
     }
 }
 
-function handleIncomingMessage(e) {
-    const data = JSON.parse(e.data);
+function handleIncomingMessage(data) {
+    // the socket carries every conversation of the user, only this one is rendered here
+    if (data.chat !== document.getElementById('otherUsername').value) {
+        return;
+    }
+    if (data.type === "subscribed" || data.type === "conversation_updated") {
+        return;
+    }
+    if (data.type === "error") {
+        console.error(data.error);
+        return;
+    }
+    if (data.type === "rate_limited") {
+        handleRateLimited(data);
+        return;
+    }
+    if (data.type === "status") {
+        handleMessageStatus(data);
+        return;
+    }
+    if (data.type === "presence") {
+        document.querySelector("#presence-status").textContent = data.online ? "online" : "last seen just now";
+        return;
+    }
+    if (data.type === "read") {
+        markSeen(data.message_id);
+        return;
+    }
+    if (data.type === "typing") {
+        document.querySelector("#typing-status").style.display = data.typing ? "" : "none";
+        return;
+    }
+    if (data.type === "resync") {
+        // missed too much to replay, or to keep up with
+        window.location.reload();
+        return;
+    }
+    // replayed messages may also have arrived live
+    if (data.message_id && document.querySelector(`#messages-container [data-message-id="${data.message_id}"]`)) {
+        return;
+    }
+    document.querySelector("#typing-status").style.display = "none";
+
     const div = document.createElement("div");
-    const messageContent = convertLinks(data.message);
-    const bgColor = data.message && data.message.includes('@') ? 'bg-warning' : '';
-    const imageContent = data.image_url ? `<img src="${data.image_url}" class="img-fluid rounded mb-1" style="max-width: 200px;"/>` : '';
+    // rendered and sanitized by the server, links included
+    const messageContent = data.message_html;
+    const bgColor = data.has_mention ? 'bg-warning' : '';
+    const imageContent = renderImage(data);
     div.classList.add("fade-in");
+    if (data.message_id) {
+        div.dataset.messageId = data.message_id;
+    }
+    if (data.client_id) {
+        div.dataset.clientId = data.client_id;
+    }
 
-    const now = new Date();
-    const timeString = new Date().toLocaleTimeString('en-US', { hour: '2-digit', minute: '2-digit', hour12: true, timeZone: 'UTC' });
+    // replayed messages carry their own time
+    const timeString = (data.timestamp ? new Date(data.timestamp) : new Date()).toLocaleTimeString('en-US', { hour: '2-digit', minute: '2-digit', hour12: true, timeZone: 'UTC' });
 
     if (data.username === document.getElementById('username').value) {
         div.classList.add("d-flex", "flex-row", "justify-content-end", "mb-3");
@@ -87,6 +209,100 @@ function handleIncomingMessage(e) {
         `;
     }
 
+    if (data.username !== document.getElementById('username').value && data.message_id) {
+        sendRead(chatSocket, data.message_id);
+    }
+
+    div.querySelectorAll("img[data-retries]").forEach(img => { img.onerror = retryImage; });
     document.querySelector("#messages-container").appendChild(div);
     document.querySelector("#messages-container").scrollTop = document.querySelector("#messages-container").scrollHeight;
 }
+
+// newest message of the other user seen on this page but not yet reported, while the tab is hidden
+let unreportedRead = null;
+
+function sendRead(chatSocket, messageId) {
+    if (document.visibilityState !== "visible") {
+        unreportedRead = { chatSocket, messageId };
+        return;
+    }
+    const otherUsername = document.getElementById('otherUsername').value;
+    sendFrame(chatSocket, { type: "read", chat: otherUsername, message_id: messageId });
+}
+
+document.addEventListener("visibilitychange", function () {
+    if (document.visibilityState === "visible" && unreportedRead) {
+        sendRead(unreportedRead.chatSocket, unreportedRead.messageId);
+        unreportedRead = null;
+    }
+});
+
+function markSeen(messageId) {
+    document.querySelectorAll("#messages-container .justify-content-end[data-message-id]").forEach(div => {
+        if (Number(div.dataset.messageId) <= messageId && !div.querySelector(".read-status")) {
+            const time = div.querySelector("p.text-muted");
+            time.insertAdjacentHTML("beforeend", '<span class="read-status"> · seen</span>');
+        }
+    });
+}
+
+function handleRateLimited(data) {
+    if (data.frame !== "message") {
+        console.warn(`Sending too fast, ${data.frame} frame refused, retry in ${data.retry_after}s.`);
+        return;
+    }
+
+    // put the refused text back unless something new was typed meanwhile
+    const messageInput = document.querySelector("#message_send_input");
+    if (data.message && !messageInput.value) {
+        messageInput.value = data.message;
+    }
+    const error = document.querySelector("#send-error");
+    error.textContent = `Sending too fast, not sent. Try again in ${Math.ceil(data.retry_after)}s.`;
+    error.style.display = "";
+    clearTimeout(sendErrorTimer);
+    sendErrorTimer = setTimeout(() => { error.style.display = "none"; }, data.retry_after * 1000);
+}
+
+function handleMessageStatus(data) {
+    const div = document.querySelector(`[data-client-id="${data.client_id}"]`);
+    if (!div) {
+        return;
+    }
+
+    if (data.status === "persisted") {
+        div.dataset.messageId = data.message_id;
+    } else {
+        // delivered to the room but never stored, it will be gone after a reload
+        div.classList.add("opacity-50");
+        div.querySelector("p.text-muted").textContent += " · not saved";
+    }
+}
+
+function renderImage(data) {
+    if (!data.image_url) {
+        return '';
+    }
+    if (!data.thumbnail_url) {
+        return `<img src="${data.image_url}" class="img-fluid rounded mb-1" style="max-width: 200px;"/>`;
+    }
+
+    const size = data.image_width ? `width="${data.image_width}" height="${data.image_height}"` : '';
+    return `<a href="${data.image_url}" target="_blank" rel="noopener noreferrer">
+        <img src="${data.thumbnail_url}" ${size} data-retries="0" class="img-fluid rounded mb-1" style="max-width: 200px; height: auto;"/>
+    </a>`;
+}
+
+function retryImage(e) {
+    // the thumbnail is generated in the background and may not exist yet
+    const img = e.target;
+    const retries = Number(img.dataset.retries);
+    if (retries < 5) {
+        img.dataset.retries = retries + 1;
+        const src = img.src;
+        setTimeout(() => {
+            img.removeAttribute("src");
+            img.src = src;
+        }, 500 * (retries + 1));
+    }
+}
@@ -1,3 +1,5 @@
+import { sendFrame } from './protocol.js';
+
 export function sendImage(chatSocket) {
     const file = document.querySelector("#image_input").files[0];
     if (!file) {
@@ -7,24 +9,52 @@ export function sendImage(chatSocket) {
     const username = document.getElementById("username").value;
     const otherUsername = document.getElementById("otherUsername").value;
     const csrfToken = document.querySelector("[name=csrfmiddlewaretoken]").value;
-    const formData = new FormData();
-    formData.append("image", file);
+    const chatUrl = `/chat/${username}/${otherUsername}`;
 
-    fetch(`/chat/${username}/${otherUsername}/upload_image/`, {
-        method: "POST",
-        headers: { "X-CSRFToken": csrfToken },
-        body: formData,
+    // the file goes straight to storage, the server only hands out the url and validates the result
+    postForm(`${chatUrl}/upload_url/`, { filename: file.name, content_type: file.type, size: file.size }, csrfToken)
+    .then(response => response.json())
+    .then(upload => {
+        if (!upload.url) {
+            throw new Error(upload.error);
+        }
+        const formData = new FormData();
+        for (const [name, value] of Object.entries(upload.fields)) {
+            formData.append(name, value);
+        }
+        // the bucket ignores fields after the file
+        formData.append("file", file);
+        return fetch(upload.url, { method: "POST", body: formData }).then(response => {
+            if (!response.ok) {
+                throw new Error("Upload failed.");
+            }
+            return postForm(`${chatUrl}/finalize_upload/`, { token: upload.token }, csrfToken);
+        });
     })
     .then(response => response.json())
     .then(data => {
         if (data.image_url) {
-            chatSocket.send(JSON.stringify({
-                username: username,
+            sendFrame(chatSocket, {
+                chat: otherUsername,
                 image_name: data.image_name,
-                image_url: data.image_url,
-            }));
+                image_width: data.image_width,
+                image_height: data.image_height,
+            });
         }
-    });
+    })
+    .catch(error => console.error(error));
 
     document.querySelector("#image_input").value = "";
 }
+
+function postForm(url, fields, csrfToken) {
+    const formData = new FormData();
+    for (const [name, value] of Object.entries(fields)) {
+        formData.append(name, value);
+    }
+    return fetch(url, {
+        method: "POST",
+        headers: { "X-CSRFToken": csrfToken },
+        body: formData,
+    });
+}
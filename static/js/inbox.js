@@ -0,0 +1,50 @@
+import { openSocket, readFrames } from './protocol.js';
+
+document.addEventListener('DOMContentLoaded', function () {
+    setupInboxConnection();
+});
+
+async function setupInboxConnection() {
+    // the per-user socket pushes a summary whenever one of the user's conversations changes
+    const inboxSocket = await openSocket(`ws://${window.location.host}/ws/chat/`);
+
+    inboxSocket.onopen = function (e) {
+        console.log("WebSocket connection established.");
+    };
+
+    inboxSocket.onclose = function (e) {
+        console.log("WebSocket connection closed.");
+    };
+
+    inboxSocket.onmessage = function (e) {
+        readFrames(e).forEach(data => {
+            if (data.type === "conversation_updated") {
+                updateConversation(data);
+            } else if (data.type === "resync") {
+                // the server gave up on sending this page everything it missed
+                window.location.reload();
+            }
+        });
+    };
+}
+
+function updateConversation(data) {
+    const inbox = document.querySelector("#inbox");
+    const item = inbox.querySelector(`li[data-chat="${CSS.escape(data.chat)}"]`);
+    if (!item) {
+        // a conversation this page has not rendered yet
+        window.location.reload();
+        return;
+    }
+
+    item.querySelector(".inbox-preview").textContent = data.preview || (data.has_image ? "Image" : "");
+    item.querySelector(".inbox-time").textContent = "just now";
+    if (data.unread) {
+        const badge = item.querySelector(".inbox-unread");
+        badge.textContent = (parseInt(badge.textContent, 10) || 0) + 1;
+        badge.style.display = "";
+    }
+
+    // most recent conversation first, as rendered by chat_list
+    inbox.prepend(item);
+}
@@ -0,0 +1,34 @@
+// websocket framing shared by the chat and inbox pages, see BaseChat in chat/consumers.py
+const MSGPACK_PROTOCOL = "chat.msgpack";
+const PROTOCOL_VERSION = 1;
+let msgpack = null;
+
+export async function openSocket(url) {
+    const protocol = document.getElementById("wsProtocol");
+    if (protocol && protocol.value === "msgpack") {
+        // only loaded by pages that opted in
+        msgpack = msgpack || await import("https://cdn.jsdelivr.net/npm/@msgpack/msgpack@3.1.2/+esm");
+        const socket = new WebSocket(url, [MSGPACK_PROTOCOL]);
+        socket.binaryType = "arraybuffer";
+        return socket;
+    }
+    return new WebSocket(url);
+}
+
+export function sendFrame(socket, frame) {
+    // a server without msgpack support accepts the socket without a protocol, JSON then
+    if (socket.protocol === MSGPACK_PROTOCOL) {
+        socket.send(msgpack.encode({ v: PROTOCOL_VERSION, frames: [frame] }));
+    } else {
+        socket.send(JSON.stringify(frame));
+    }
+}
+
+export function readFrames(e) {
+    if (typeof e.data === "string") {
+        return [JSON.parse(e.data)];
+    }
+    // the server batches frames queued while the previous message was in flight
+    const envelope = msgpack.decode(new Uint8Array(e.data));
+    return envelope.v === PROTOCOL_VERSION ? envelope.frames : [];
+}
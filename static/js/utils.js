@@ -5,8 +5,3 @@ export function autoScrollMessages() {
         behavior: 'smooth'
     });
 }
-
-export function convertLinks(text) {
-    const urlPattern = /((http|https):\/\/[^\s]+)/g;
-    return text.replace(urlPattern, '<a href="$1" target="_blank" rel="noopener noreferrer" class="text-white">$1</a>');
-}
@@ -0,0 +1,50 @@
+import io
+import os
+from PIL import Image, ImageOps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from .cache import invalidate_user
+from .models import Profile
+
+AVATAR_SIZE = 300
+# square variants, 60px for the chat list and 42px for the chat input bar
+THUMBNAIL_SIZE = 60
+ICON_SIZE = 42
+
+def encode(image):
+    output = io.BytesIO()
+    image.save(output, format="WEBP", quality=85)
+    return ContentFile(output.getvalue())
+
+def process_avatar(profile_id, avatar_name):
+    """
+    Shrink a newly uploaded avatar and generate its fixed size variants.
+    Reads and writes through the storage API so it works on S3 as well.
+    """
+    with default_storage.open(avatar_name) as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image.load()
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+
+    stem = os.path.splitext(avatar_name)[0]
+    names = {}
+    if image.width > AVATAR_SIZE or image.height > AVATAR_SIZE:
+        image.thumbnail((AVATAR_SIZE, AVATAR_SIZE))
+        names["avatar"] = default_storage.save(f"{stem}.webp", encode(image))
+    names["avatar_thumbnail"] = default_storage.save(
+        f"{stem}_{THUMBNAIL_SIZE}.webp", encode(ImageOps.fit(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE))),
+    )
+    names["avatar_icon"] = default_storage.save(
+        f"{stem}_{ICON_SIZE}.webp", encode(ImageOps.fit(image, (ICON_SIZE, ICON_SIZE))),
+    )
+
+    # the user may have uploaded another avatar in the meantime, only that one counts then
+    updated = Profile.objects.filter(id=profile_id, avatar=avatar_name).update(**names)
+    # update() sends no signals
+    invalidate_user(Profile.objects.filter(id=profile_id).values_list("user__username", flat=True).first())
+    if not updated:
+        for name in names.values():
+            default_storage.delete(name)
+    elif "avatar" in names:
+        default_storage.delete(avatar_name)
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from .models import Profile
+
+PROFILE_FIELDS = ("avatar", "avatar_thumbnail", "avatar_icon")
+
+def user_key(username):
+    return f"users:user:{username}"
+
+def get_cached_user(username):
+    """
+    The user with the given username, with their profile attached, None if there is none.
+    Served from the cache after the first lookup, the instances are only meant for reading.
+    """
+    data = cache.get(user_key(username))
+    if data is None:
+        user = User.objects.select_related("profile").filter(username=username).first()
+        if user is None:
+            return None
+        data = {"id": user.id, "username": user.username, "is_active": user.is_active, "profile": None}
+        if hasattr(user, "profile"):
+            data["profile"] = {"id": user.profile.id, **{field: getattr(user.profile, field).name for field in PROFILE_FIELDS}}
+        cache.set(user_key(username), data, settings.USER_CACHE_TIMEOUT)
+
+    user = User(id=data["id"], username=data["username"], is_active=data["is_active"])
+    user._state.adding = False
+    if data["profile"] is not None:
+        profile = Profile(user=user, **data["profile"])
+        profile._state.adding = False
+        profile._saved_avatar = profile.avatar.name
+        user.profile = profile
+    return user
+
+def invalidate_user(username):
+    cache.delete(user_key(username))
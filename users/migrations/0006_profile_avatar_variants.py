@@ -0,0 +1,23 @@
+# Generated by Django 6.0.5 on 2026-10-18 04:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_alter_profile_avatar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_icon',
+            field=models.ImageField(blank=True, upload_to='avatars/'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_thumbnail',
+            field=models.ImageField(blank=True, upload_to='avatars/'),
+        ),
+    ]
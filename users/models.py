@@ -1,20 +1,50 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from PIL import Image
+from main import background
 
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     avatar = models.ImageField(upload_to="avatars/", blank=True)
+    # fixed size variants generated by users.avatars.process_avatar()
+    avatar_thumbnail = models.ImageField(upload_to="avatars/", blank=True)
+    avatar_icon = models.ImageField(upload_to="avatars/", blank=True)
+
+    # avatar file name as last loaded from/saved to the database
+    _saved_avatar = ""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_avatar = instance.__dict__.get("avatar", "") or ""
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or "avatar" in fields:
+            self._saved_avatar = self.avatar.name or ""
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
-        if self.avatar:
-            img = Image.open(self.avatar.path)
-            if img.height > 300 or img.width > 300:
-                img.thumbnail((300, 300))
-                img.save(self.avatar.path)
+        # only process the avatar when a new file was uploaded, not on every profile save
+        if self.avatar and self.avatar.name != self._saved_avatar:
+            from .avatars import process_avatar
+
+            transaction.on_commit(lambda: background.submit(process_avatar, self.pk, self.avatar.name))
+        self._saved_avatar = self.avatar.name or ""
+
+    @property
+    def avatar_thumbnail_url(self):
+        if self.avatar_thumbnail:
+            return self.avatar_thumbnail.url
+        return self.avatar.url if self.avatar else None
+
+    @property
+    def avatar_icon_url(self):
+        if self.avatar_icon:
+            return self.avatar_icon.url
+        return self.avatar.url if self.avatar else None
 
     def __str__(self):
         return self.user.username
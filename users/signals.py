@@ -1,6 +1,7 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth.models import User
 from django.dispatch import receiver
+from .cache import invalidate_user
 from .models import Profile
 
 @receiver(post_save, sender=User)
@@ -9,5 +10,18 @@ def create_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
 
 @receiver(post_save, sender=User)
-def save_profile(sender, instance, **kwargs):
+def save_profile(sender, instance, update_fields=None, **kwargs):
+    # logins only touch last_login, nothing to save on the profile
+    if update_fields == frozenset({"last_login"}):
+        return
     instance.profile.save()
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, update_fields=None, **kwargs):
+    if update_fields != frozenset({"last_login"}):
+        invalidate_user(instance.username)
+
+@receiver(post_save, sender=Profile)
+def invalidate_cached_profile(sender, instance, **kwargs):
+    invalidate_user(instance.user.username)
@@ -0,0 +1,40 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.urls import reverse
+from ..cache import get_cached_user
+
+
+class CachedUserTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="Str0ng_p@ssword")
+
+    def test_lookup_cached(self):
+        get_cached_user("user")
+        with self.assertNumQueries(0):
+            user = get_cached_user("user")
+            self.assertEqual(user, self.user)
+            self.assertEqual(user.profile.user, user)
+            self.assertFalse(user.profile.avatar)
+
+    def test_unknown_user(self):
+        self.assertIsNone(get_cached_user("nobody"))
+
+    def test_invalidated_on_profile_change(self):
+        get_cached_user("user")
+        self.user.profile.avatar = "avatars/new.png"
+        self.user.profile.save()
+        self.assertEqual(get_cached_user("user").profile.avatar.name, "avatars/new.png")
+
+    def test_invalidated_on_delete(self):
+        get_cached_user("user")
+        self.user.delete()
+        self.assertIsNone(get_cached_user("user"))
+
+    def test_invalidated_on_username_change(self):
+        get_cached_user("user")
+        self.client.login(username="user", password="Str0ng_p@ssword")
+        self.client.post(reverse("users:account"), {"username": "renamed"})
+
+        self.assertIsNone(get_cached_user("user"))
+        self.assertEqual(get_cached_user("renamed"), self.user)
@@ -1,5 +1,6 @@
 import io
-from django.test import TestCase
+from unittest import mock
+from django.test import TestCase, override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User
 from PIL import Image
@@ -19,18 +20,45 @@ class ProfileModelTests(TestCase):
         profile, _ = Profile.objects.get_or_create(user=self.user)
         self.assertFalse(profile.avatar)
 
-    def test_avatar_resizing(self):
-        # temp 500x500 image
-        image = Image.new("RGB", (500, 500), "white")
+    def upload_avatar(self, profile, size=(500, 500)):
+        # temp image
+        image = Image.new("RGB", size, "white")
         byte_io = io.BytesIO()
         image.save(byte_io, format="JPEG")
         byte_io.seek(0)
 
-        avatar = SimpleUploadedFile("test_avatar.jpg", byte_io.getvalue(), content_type="image/jpeg")
+        profile.avatar = SimpleUploadedFile("test_avatar.jpg", byte_io.getvalue(), content_type="image/jpeg")
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        profile.refresh_from_db()
+
+    @override_settings(BACKGROUND_WORKERS=0)
+    def test_avatar_resizing(self):
         profile, _ = Profile.objects.get_or_create(user=self.user)
-        profile.avatar = avatar
-        profile.save()
+        self.upload_avatar(profile)
 
         img = Image.open(profile.avatar.path)
         self.assertLessEqual(img.height, 300)
         self.assertLessEqual(img.width, 300)
+
+    @override_settings(BACKGROUND_WORKERS=0)
+    def test_avatar_variants(self):
+        profile, _ = Profile.objects.get_or_create(user=self.user)
+        self.upload_avatar(profile, size=(200, 100))
+
+        self.assertEqual(Image.open(profile.avatar_thumbnail.path).size, (60, 60))
+        self.assertEqual(Image.open(profile.avatar_icon.path).size, (42, 42))
+        self.assertEqual(profile.avatar_thumbnail_url, profile.avatar_thumbnail.url)
+        self.assertEqual(profile.avatar_icon_url, profile.avatar_icon.url)
+
+    @override_settings(BACKGROUND_WORKERS=0)
+    def test_avatar_not_reprocessed(self):
+        profile, _ = Profile.objects.get_or_create(user=self.user)
+        self.upload_avatar(profile)
+
+        with mock.patch("users.avatars.process_avatar") as process:
+            with self.captureOnCommitCallbacks(execute=True):
+                profile.save()
+                self.client.login(username="user", password="password123")
+                Profile.objects.get(id=profile.id).save()
+        process.assert_not_called()
@@ -3,6 +3,7 @@ from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
 from django.contrib import messages
+from .cache import invalidate_user
 from .forms import RegistrationForm, UsernameUpdateForm, ProfileUpdateForm
 
 def register(request):
@@ -24,8 +25,11 @@ def account(request):
         username_form = UsernameUpdateForm(request.POST, instance=user)
         profile_form = ProfileUpdateForm(request.POST, request.FILES, instance=user.profile)
 
+        # the form writes the new username onto the instance while validating
+        old_username = user.username
         if username_form.is_valid() and profile_form.is_valid():
             username_form.save()
+            invalidate_user(old_username)
             profile_form.save()
 
             update_session_auth_hash(request, user)